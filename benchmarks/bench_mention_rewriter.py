@@ -0,0 +1,110 @@
+"""Slack markup rewriting cost in MessagesService on a synthetic message corpus.
+
+Compares the former rewriter, four patterns compiled and scanned twice on every
+call, with the single precompiled pattern of MessagesService.replace_mentions.
+
+    PYTHONPATH=. python benchmarks/bench_mention_rewriter.py
+"""
+import random
+import re
+import timeit
+
+from src.business.messages_service import MessagesService
+
+USERS = 2000
+CHANNELS = 300
+MESSAGES = 20000
+WORDS = ("the", "deploy", "is", "done", "please", "check", "logs", "for", "build", "failed", "again", "thanks",
+         "review", "this", "PR", "before", "release", "meeting", "moved", "to", "tomorrow", "ok")
+
+
+def make_corpus(users: dict, channels: dict) -> list:
+    user_ids = list(users)
+    channel_ids = list(channels)
+    corpus = []
+    for _ in range(MESSAGES):
+        tokens = [random.choice(WORDS) for _ in range(random.randint(3, 40))]
+        kind = random.random()
+        # Most messages are plain text, the rest carry one or a few tokens of markup
+        if kind > 0.55:
+            for _ in range(random.randint(1, 3)):
+                tokens.insert(random.randrange(len(tokens)), f"<@{random.choice(user_ids)}>")
+        if kind > 0.85:
+            channel_id = random.choice(channel_ids)
+            tokens.insert(random.randrange(len(tokens)), f"<#{channel_id}|{channels[channel_id]['name']}>")
+        if kind > 0.95:
+            tokens.insert(0, random.choice(("<!here>", "<!channel>")))
+        if random.random() > 0.8:
+            tokens.append("<https://example.com/build/123|build>")
+        corpus.append(" ".join(tokens))
+    return corpus
+
+
+class LegacyRewriter:
+    def __init__(self, users_list: dict, channels_list: dict):
+        self._users_list = users_list
+        self._channels_list = channels_list
+
+    def replace_user_function(self, match):
+        matched_text = match.group(0)
+        matched_text = matched_text[2:len(matched_text) - 1]
+        user_data = self._users_list.get(matched_text)
+        user_name = user_data["name"]
+        if user_name == '' or user_name is None:
+            user_name = match.group(0)
+        else:
+            user_name = "@" + user_data["name"]
+        return user_name
+
+    def replace_channel_function(self, match) -> str:
+        matched_text = match.group(0)
+        matched_text = matched_text[2:matched_text.find('|')]
+        channel_name = ''
+        channel_data = self._channels_list.get(matched_text)
+        if channel_data:
+            channel_name = channel_data["name"]
+        if channel_name == '' or channel_name is None:
+            channel_name = match.group(0)
+        else:
+            channel_name = "~" + channel_name
+        return channel_name
+
+    def replace_mentions(self, msg_text: str) -> str:
+        replaced_message = msg_text
+        for pattern, replacement in ((r'<@[\w\d]+>', self.replace_user_function),
+                                     (r'<#([\w\d]+)\|(.*?)>', self.replace_channel_function),
+                                     (r'<!here>', "@here"),
+                                     (r'<!channel>', "@channel")):
+            regex = re.compile(pattern)
+            match = re.search(regex, replaced_message)
+            if match:
+                replaced_message = re.sub(pattern, replacement, replaced_message)
+        return replaced_message
+
+
+def main():
+    random.seed(1)
+    users = {f"U{index:08d}": {"id": f"U{index:08d}", "name": f"user{index}"} for index in range(USERS)}
+    channels = {f"C{index:08d}": {"id": f"C{index:08d}", "name": f"channel-{index}"} for index in range(CHANNELS)}
+    corpus = make_corpus(users, channels)
+
+    legacy = LegacyRewriter(users, channels)
+    service = MessagesService(config_service=None, mattermost_upload_messages=None)
+    service.set_users_list(users)
+    service.set_channels_list(channels)
+    assert [legacy.replace_mentions(text) for text in corpus] == [service.replace_mentions(text) for text in corpus]
+
+    legacy_seconds = min(timeit.repeat(lambda: [legacy.replace_mentions(text) for text in corpus],
+                                       number=1, repeat=5))
+    service_seconds = min(timeit.repeat(lambda: [service.replace_mentions(text) for text in corpus],
+                                        number=1, repeat=5))
+
+    print(f"{MESSAGES} messages, {sum(len(text) for text in corpus) / MESSAGES:.0f} characters on average")
+    print(f"{'rewriter':>10} {'messages/s':>12} {'us/message':>11}")
+    for name, seconds in (("legacy", legacy_seconds), ("combined", service_seconds)):
+        print(f"{name:>10} {MESSAGES / seconds:>12.0f} {seconds / MESSAGES * 1e6:>11.2f}")
+    print(f"speedup {legacy_seconds / service_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Memory held by transformed threads in MessagesService, measured with tracemalloc.
+
+Compares the former nested dicts, a profile copy per message, reply and mention
+and a channel copy per reply, with the __slots__ records that share one profile
+per user and one channel record per channel.
+
+    PYTHONPATH=. python benchmarks/bench_message_records.py
+"""
+import random
+import time
+import tracemalloc
+
+from src.business.messages_service import MessagesService
+
+USERS = 500
+THREADS = 20
+REPLIES = 2000
+
+
+class AllowAll:
+    @staticmethod
+    def get_excluded_users() -> frozenset:
+        return frozenset()
+
+
+def make_users() -> dict:
+    return {f"U{index:08d}": {"id": f"U{index:08d}", "name": f"user{index}", "email": f"user{index}@example.com",
+                              "is_bot": False, "is_deleted": False, "first_name": f"First{index}",
+                              "last_name": f"Last{index}", "display_name": f"User {index}"}
+            for index in range(USERS)}
+
+
+def make_thread(user_ids: list, thread: int) -> dict:
+    replies = [{"ts": f"{1700000000 + thread * REPLIES + index}.000100", "user": random.choice(user_ids),
+                "text": f"reply {index} <@{random.choice(user_ids)}> looks good"} for index in range(REPLIES)]
+    return {"ts": f"{1600000000 + thread}.000100", "user": random.choice(user_ids), "channel": "C00000001",
+            "text": f"thread {thread} for <@{random.choice(user_ids)}>", "is_attached": False, "is_thread": True,
+            "reply": replies}
+
+
+def legacy_profile(users_list: dict, user_id: str) -> dict:
+    return {"user_id": user_id,
+            "user_name": users_list.get(user_id, {}).get("name"),
+            "user_email": users_list.get(user_id, {}).get("email"),
+            "user_is_bot": users_list.get(user_id, {}).get("is_bot"),
+            "user_first_name": users_list.get(user_id, {}).get("first_name"),
+            "user_last_name": users_list.get(user_id, {}).get("last_name"),
+            "user_is_deleted": users_list.get(user_id, {}).get("is_deleted"),
+            "user_display_name": users_list.get(user_id, {}).get("display_name")}
+
+
+def legacy_transform(service: MessagesService, users_list: dict, channels_list: dict, message: dict) -> dict:
+    """The former dict layout, the text rewriting is shared with the current service."""
+    text, users_mentions = service._rewrite_markup(message["text"])
+    channel = channels_list.get(message["channel"], {})
+    message_dict = {"text": text, "user": legacy_profile(users_list, message["user"]),
+                    "channel": {"channel_id": message["channel"], "channel_name": channel.get("name"),
+                                "channel_type": channel.get("type"), "channel_members": channel.get("members")},
+                    "ts": message["ts"], "is_attached": message["is_attached"], "is_thread": message["is_thread"]}
+    reply_list = []
+    for reply_message in message["reply"]:
+        reply_text, reply_mentions = service._rewrite_markup(reply_message["text"])
+        users_mentions.extend(reply_mentions)
+        reply_list.append({"text": reply_text, "user_id": reply_message["user"],
+                           "user": legacy_profile(users_list, reply_message["user"]),
+                           "channel": {"channel_id": message["channel"], "channel_name": channel.get("name"),
+                                       "channel_type": channel.get("type")},
+                           "ts": reply_message["ts"], "is_attached": False, "is_thread": True})
+    message_dict["reply"] = reply_list
+    message_dict["users_in_mentions"] = [legacy_profile(users_list, mention) for mention in users_mentions]
+    return message_dict
+
+
+def measure(transform, messages: list):
+    tracemalloc.start()
+    started = time.perf_counter()
+    results = [transform(message) for message in messages]
+    seconds = time.perf_counter() - started
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return held, peak, seconds
+
+
+def main():
+    random.seed(1)
+    users = make_users()
+    channels = {"C00000001": {"id": "C00000001", "name": "general", "type": "public",
+                              "members": frozenset(users)}}
+    threads = [make_thread(list(users), thread) for thread in range(THREADS)]
+
+    service = MessagesService(config_service=AllowAll(), mattermost_upload_messages=None)
+    service.set_users_list(users)
+    service.set_channels_list(channels)
+
+    legacy = measure(lambda message: legacy_transform(service, users, channels, message), threads)
+    records = measure(service.transform_message, threads)
+
+    print(f"{THREADS} threads of {REPLIES} replies, {USERS} users")
+    print(f"{'layout':>8} {'held MiB':>9} {'peak MiB':>9} {'seconds':>8}")
+    for name, (held, peak, seconds) in (("dicts", legacy), ("records", records)):
+        print(f"{name:>8} {held / 2 ** 20:>9.1f} {peak / 2 ** 20:>9.1f} {seconds:>8.2f}")
+    print(f"held memory {legacy[0] / records[0]:.1f}x smaller")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""End to end migration benchmark against the local Slack and Mattermost stand-ins.
+
+Starts the fake servers of fake_servers.py in a child process, so their memory is
+not counted, points the settings at them and runs one "all channels" job through
+the real Containers wiring: SlackLoadMessages, the channel pipelines,
+MessagesService, MattermostUploadMessages (or the bulk import sink) and the
+state and checkpoint stores, in a temporary WORKDIR.
+
+Reported: messages per second, Slack and Mattermost API calls per message, 429s
+answered, peak RSS of this process, and the seconds each pipeline stage was busy,
+summed over the channels. Slack tier limits are lifted by default so the run
+measures the migration code, pass --slack-tier-rates "" to keep the real ones.
+
+    PYTHONPATH=. python benchmarks/bench_migration.py --channels 10 --messages 1000
+    PYTHONPATH=. python benchmarks/bench_migration.py --slack-latency 0.05 --slack-429 0.02 --file-every 20
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import requests
+
+from benchmarks import fake_servers
+
+NO_TIER_LIMITS = "1:100000,2:100000,3:100000,4:100000"
+POLL_SECONDS = 0.1
+
+
+def serve_fakes(args, connection):
+    slack, mattermost = fake_servers.make_servers(args)
+    connection.send((slack.server_address[1], mattermost.server_address[1]))
+    while True:
+        time.sleep(3600)
+
+
+def configure(args, workdir: str, slack_port: int, mm_port: int):
+    os.makedirs(os.path.join(workdir, "log"))
+    with open(os.path.join(workdir, "config.json"), "w") as config_file:
+        json.dump({"slack_id": 1, "last_datetime_synchronize": {"all": "1970-01-02 00:00:00"},
+                   "excluded_channels": [], "excluded_users": []}, config_file)
+    os.environ.update({
+        "WORKDIR": workdir, "CONFIG_FILE": "config.json", "LOG_FILE": "bench.log",
+        "SLACK_BOT_TOKEN": "xoxb-bench", "SLACK_APP_TOKEN": "xapp-bench", "SLACK_SIGNING_SECRET": "bench",
+        "SLACK_API_URL": f"http://127.0.0.1:{slack_port}/api/",
+        "MATTERMOST_BOT_TOKEN": "bench", "MATTERMOST_URL": f"http://127.0.0.1:{mm_port}/api/v4",
+        "GET_CONFIG_COMMAND": "/get_config", "SET_EXCLUDED_CHANNELS_COMMAND": "/set_excluded_channels",
+        "SET_EXCLUDED_USERS_COMMAND": "/set_excluded_users", "SET_DATE_SYNC_COMMAND": "/set_date",
+        "START_INTEGRATION_COMMAND": "/start",
+        "SLACK_BACKEND": args.backend, "MATTERMOST_SINK": args.sink,
+        "CHANNELS_CONCURRENCY": str(args.concurrency)})
+    if args.sink == "bulk_import":
+        os.environ["MATTERMOST_TEAM_NAME"] = "bench"
+    if args.slack_tier_rates:
+        os.environ["SLACK_TIER_RATES"] = args.slack_tier_rates
+    logging.basicConfig(level=getattr(logging, args.log_level),
+                        format='%(asctime)s - %(levelname)s - %(message)s',
+                        handlers=[logging.FileHandler(os.path.join(workdir, "log", "bench.log"))])
+
+
+def run_migration():
+    from src.controller.containers import Containers
+
+    containers = Containers()
+    load_messages = containers.slack_load_messages()
+    manager = containers.migration_job_manager(slack_load_messages=load_messages)
+    started = time.perf_counter()
+    job, _ = manager.submit("all")
+    while job.is_active():
+        time.sleep(POLL_SECONDS)
+    elapsed = time.perf_counter() - started
+    containers.state_store().close()
+    return job, elapsed, load_messages.get_pipeline_stats()
+
+
+def report(args, job, elapsed: float, stage_stats: dict, slack_calls: dict, mm_calls: dict):
+    messages = max(job.messages, 1)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    slack_api_calls = sum(count for method, count in slack_calls.items() if method not in ("files", "rate_limited"))
+    mm_api_calls = sum(count for method, count in mm_calls.items() if method != "rate_limited")
+
+    print(f"workspace: {args.channels} channels x {args.messages} messages, thread every {args.thread_every} "
+          f"with {args.replies} replies, file every {args.file_every} ({args.file_bytes} bytes)")
+    print(f"job {job.state}: {job.channels_done}/{job.channels_total} channels, {job.channels_failed} failed")
+    print(f"messages delivered      {job.messages:10d}")
+    print(f"wall time               {elapsed:10.2f} s")
+    print(f"messages/s              {job.messages / elapsed:10.1f}")
+    print(f"Slack calls/message     {slack_api_calls / messages:10.3f}   ({slack_api_calls} calls, "
+          f"{slack_calls.get('files', 0)} downloads, {slack_calls.get('rate_limited', 0)} answered 429)")
+    print(f"Mattermost calls/message{mm_api_calls / messages:10.3f}   ({mm_api_calls} calls, "
+          f"{mm_calls.get('rate_limited', 0)} answered 429)")
+    print(f"peak RSS                {peak_rss:10.1f} MiB")
+    for stage, counter in (("fetch", "fetched"), ("transform", "transformed"), ("upload", "uploaded")):
+        seconds = stage_stats.get(f"{stage}_seconds", 0.0)
+        count = stage_stats.get(counter, 0)
+        print(f"{stage + ' stage':24s}{seconds:10.2f} s   ({count} messages, "
+              f"{seconds * 1000 / max(count, 1):.3f} ms each)")
+    if args.verbose:
+        print("Slack calls:", json.dumps(slack_calls, sort_keys=True))
+        print("Mattermost calls:", json.dumps(mm_calls, sort_keys=True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_servers.add_arguments(parser)
+    parser.add_argument("--backend", choices=("sync", "async"), default="sync")
+    parser.add_argument("--sink", choices=("rest", "bulk_import"), default="rest")
+    parser.add_argument("--concurrency", type=int, default=4, help="channels migrated at once")
+    parser.add_argument("--slack-tier-rates", default=NO_TIER_LIMITS)
+    parser.add_argument("--log-level", choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep the WORKDIR with logs and state")
+    parser.add_argument("--verbose", action="store_true", help="print the calls per API method")
+    args = parser.parse_args()
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=serve_fakes, args=(args, child_connection), daemon=True)
+    fakes.start()
+    slack_port, mm_port = parent_connection.recv()
+
+    workdir = tempfile.mkdtemp(prefix="bench_migration_")
+    try:
+        configure(args, workdir, slack_port, mm_port)
+        job, elapsed, stage_stats = run_migration()
+        slack_calls = requests.get(f"http://127.0.0.1:{slack_port}/_stats").json()
+        mm_calls = requests.get(f"http://127.0.0.1:{mm_port}/_stats").json()
+        report(args, job, elapsed, stage_stats, slack_calls, mm_calls)
+    finally:
+        fakes.terminate()
+        if args.keep_workdir:
+            print(f"WORKDIR kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Author lookup cost in MattermostUploadMessages as the Mattermost user count grows.
+
+Compares the former linear scan over the users list with MattermostUserDirectory.
+
+    PYTHONPATH=. python benchmarks/bench_user_lookup.py
+"""
+import random
+import timeit
+
+from src.controller.mattermost_user_directory import MattermostUserDirectory
+
+USER_COUNTS = (100, 1000, 10000, 40000)
+LOOKUPS = 2000
+
+
+def make_users(count: int) -> list:
+    return [{"id": f"mm{index:06d}", "username": f"user{index}", "email": f"User{index}@Example.com"}
+            for index in range(count)]
+
+
+def linear_lookup(users_list: list, slack_mail: str):
+    for user in users_list:
+        mm_mail = user["email"]
+        if mm_mail and slack_mail and mm_mail.lower() == slack_mail.lower():
+            return user["id"]
+    return None
+
+
+def main():
+    random.seed(1)
+    print(f"{'users':>8} {'linear us/lookup':>18} {'directory us/lookup':>20} {'speedup':>9}")
+    for count in USER_COUNTS:
+        users = make_users(count)
+        directory = MattermostUserDirectory(users)
+        emails = [f"user{random.randrange(count)}@example.com" for _ in range(LOOKUPS)]
+
+        linear_seconds = timeit.timeit(lambda: [linear_lookup(users, email) for email in emails], number=1)
+        directory_seconds = timeit.timeit(lambda: [directory.get_by_email(email) for email in emails], number=1)
+
+        print(f"{count:>8} {linear_seconds / LOOKUPS * 1e6:>18.2f} {directory_seconds / LOOKUPS * 1e6:>20.3f} "
+              f"{linear_seconds / directory_seconds:>8.0f}x")
+
+
+if __name__ == "__main__":
+    main()
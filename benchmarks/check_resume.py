@@ -0,0 +1,134 @@
+"""Resume check: kill a migration part way through and verify the rerun leaves no gaps.
+
+Runs an "all channels" job against the fake servers of fake_servers.py in a child
+process, kills it with SIGKILL once --kill-after posts reached the fake Mattermost,
+so with the default 100 messages per history page the channels are past their
+first page, then runs the job again to the end. Every top level Slack message must
+then be in Mattermost exactly once, in the order it was posted in Slack.
+
+    PYTHONPATH=. python benchmarks/check_resume.py --channels 2 --messages 350
+    PYTHONPATH=. python benchmarks/check_resume.py --backend async --kill-after 250
+
+Exits with status 1 and lists the missing, duplicated and out of order messages
+of each channel when the check fails.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+from benchmarks import bench_migration, fake_servers
+
+POLL_SECONDS = 0.05
+
+
+def migrate():
+    job, _, _ = bench_migration.run_migration()
+    sys.exit(0 if job.state == "finished" else 1)
+
+
+def count_posts(mm_url: str) -> int:
+    return requests.get(f"{mm_url}/_stats").json().get("POST /posts", 0)
+
+
+def run_until_killed(mm_url: str, kill_after: int) -> int:
+    migration = multiprocessing.Process(target=migrate)
+    migration.start()
+    while migration.is_alive() and count_posts(mm_url) < kill_after:
+        time.sleep(POLL_SECONDS)
+    migration.kill()
+    migration.join()
+    return count_posts(mm_url)
+
+
+def load_posted_ts(mm_url: str) -> dict:
+    """Maps each Slack channel id to the slack_ts of its top level posts, in the order they were created."""
+    posted = {}
+    channels = requests.get(f"{mm_url}/api/v4/channels", params={"per_page": 10000}).json()
+    for channel in channels:
+        posts = requests.get(f"{mm_url}/api/v4/channels/{channel['id']}/posts",
+                             params={"per_page": 1000000}).json()
+        # Newest first, as Mattermost lists them
+        for post_id in reversed(posts["order"]):
+            post = posts["posts"][post_id]
+            if post["root_id"] or "slack_ts" not in post["props"]:
+                continue
+            posted.setdefault(post["props"]["slack_channel_id"], []).append(post["props"]["slack_ts"])
+    return posted
+
+
+def check(args, posted: dict) -> list:
+    workspace = fake_servers.SyntheticWorkspace(channels=args.channels, messages=args.messages)
+    problems = []
+    for channel_index in range(args.channels):
+        channel_id = workspace.channel_id(channel_index)
+        expected = [workspace.message(channel_id, index)["ts"] for index in range(args.messages)]
+        posted_ts = posted.get(channel_id, [])
+        missing = sorted(set(expected) - set(posted_ts))
+        duplicated = sorted({ts for ts in posted_ts if posted_ts.count(ts) > 1})
+        out_of_order = [ts for previous, ts in zip(posted_ts, posted_ts[1:]) if float(ts) < float(previous)]
+        if missing or duplicated or out_of_order:
+            problems.append(f"{channel_id}: {len(missing)} missing (first {missing[:3]}), "
+                            f"{len(duplicated)} duplicated (first {duplicated[:3]}), "
+                            f"{len(out_of_order)} out of order (first {out_of_order[:3]})")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_servers.add_arguments(parser)
+    parser.set_defaults(channels=2, messages=350)
+    parser.add_argument("--backend", choices=("sync", "async"), default="sync")
+    parser.add_argument("--kill-after", type=int, default=150, help="posts to wait for before the kill")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep the WORKDIR with logs and state")
+    args = parser.parse_args()
+    # What configure() expects of the benchmark's arguments
+    args.sink = "rest"
+    args.concurrency = args.channels
+    args.slack_tier_rates = bench_migration.NO_TIER_LIMITS
+    args.log_level = "INFO"
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    fakes = multiprocessing.Process(target=bench_migration.serve_fakes, args=(args, child_connection), daemon=True)
+    fakes.start()
+    slack_port, mm_port = parent_connection.recv()
+    mm_url = f"http://127.0.0.1:{mm_port}"
+
+    workdir = tempfile.mkdtemp(prefix="check_resume_")
+    try:
+        bench_migration.configure(args, workdir, slack_port, mm_port)
+        # Save the checkpoint often, so the kill lands after some of it is written, and read back less
+        # than the synthetic history spans, so messages the checkpoint moved past are not read again
+        os.environ.setdefault("CHECKPOINT_FLUSH_MESSAGES", "10")
+        os.environ.setdefault("SLACK_THREAD_LOOKBACK_DAYS", "0.01")
+        killed_at = run_until_killed(mm_url, args.kill_after)
+        print(f"migration killed after {killed_at} posts")
+
+        rerun = multiprocessing.Process(target=migrate)
+        rerun.start()
+        rerun.join()
+        print(f"rerun finished with exit code {rerun.exitcode}, {count_posts(mm_url)} posts in total")
+
+        problems = check(args, load_posted_ts(mm_url))
+    finally:
+        fakes.terminate()
+        if args.keep_workdir:
+            print(f"WORKDIR kept at {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if problems:
+        print("resume check failed:")
+        for problem in problems:
+            print("  " + problem)
+        sys.exit(1)
+    print(f"resume check passed: {args.channels} channels x {args.messages} messages, each posted once and in order")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+"""Local stand-ins for the Slack Web API and the Mattermost v4 API, for offline benchmarks.
+
+The Slack server answers the methods SlackLoadMessages and SlackAsyncLoadMessages
+call (users.list, conversations.list, conversations.members, conversations.history,
+conversations.replies) and serves file downloads, all from a synthetic workspace
+that is generated on request instead of being held in memory. The Mattermost
+server keeps what is posted to it, without message texts or file contents.
+
+Both count their calls per method and can add latency to every call and answer a
+share of the calls with 429 and Retry-After. Counters are read from GET /_stats.
+Tests make chosen Slack calls fail with FaultInjector.fail_next.
+
+Run on their own, e.g. to point a real deployment at them:
+
+    PYTHONPATH=. python benchmarks/fake_servers.py --channels 10 --messages 1000
+"""
+import argparse
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BASE_TS = 1600000000
+MESSAGE_INTERVAL = 60
+DOWNLOAD_CHUNK = 65536
+
+
+class SyntheticWorkspace:
+    """Slack workspace whose channels, users, messages, threads and files follow from a few numbers.
+
+    Message i of a channel is posted at BASE_TS + i * MESSAGE_INTERVAL; every
+    thread_every-th message starts a thread of replies replies and every
+    file_every-th message carries a file of file_bytes bytes (0 turns either off).
+    """
+
+    def __init__(self, channels=10, users=50, messages=1000, members=20, thread_every=10, replies=5,
+                 file_every=0, file_bytes=65536, private_every=4):
+        self.channels = channels
+        self.users = users
+        self.messages = messages
+        self.members = min(members, users)
+        self.thread_every = thread_every
+        self.replies = replies
+        self.file_every = file_every
+        self.file_bytes = file_bytes
+        self.private_every = private_every
+        self.base_url = ""
+
+    def user_id(self, index: int) -> str:
+        return f"U{index:08d}"
+
+    def channel_id(self, index: int) -> str:
+        return f"C{index:08d}"
+
+    def user(self, index: int) -> dict:
+        name = f"bench.user{index}"
+        return {"id": self.user_id(index), "name": name, "real_name": f"Bench User {index}", "deleted": False,
+                "is_bot": False, "profile": {"email": f"{name}@example.com", "display_name": f"User {index}",
+                                             "first_name": "Bench", "last_name": f"User{index}"}}
+
+    def channel(self, index: int) -> dict:
+        return {"id": self.channel_id(index), "name": f"bench-{index:04d}",
+                "is_private": bool(self.private_every) and index % self.private_every == self.private_every - 1}
+
+    def channel_members(self, channel_id: str) -> list:
+        channel_index = self._channel_index(channel_id)
+        return [self.user_id((channel_index + offset) % self.users) for offset in range(self.members)]
+
+    def history(self, channel_id: str, oldest: float, latest=None) -> range:
+        """Indexes of the channel's messages newer than oldest and older than latest, newest first as Slack
+        returns them."""
+        first = 0
+        if oldest >= BASE_TS:
+            first = int((oldest - BASE_TS) // MESSAGE_INTERVAL) + 1
+        last = self.messages - 1
+        if latest is not None:
+            last = min(last, math.ceil((latest - BASE_TS) / MESSAGE_INTERVAL) - 1)
+        return range(last, min(first, self.messages) - 1, -1)
+
+    def message(self, channel_id: str, index: int) -> dict:
+        channel_index = self._channel_index(channel_id)
+        ts = self._ts(index, 0)
+        message = {"type": "message", "ts": ts, "user": self._author(channel_index, index),
+                   "text": f"message {index} for <@{self._author(channel_index, index + 1)}>, "
+                           f"see <#{channel_id}|bench-{channel_index:04d}> and _the notes_ :thumbsup:"}
+        if self.thread_every and self.replies and index % self.thread_every == 0:
+            message["thread_ts"] = ts
+            message["reply_count"] = self.replies
+            message["reply_users"] = sorted({self._author(channel_index, index + reply)
+                                             for reply in range(1, self.replies + 1)})
+            message["latest_reply"] = self._ts(index, self.replies)
+        if self.file_every and index % self.file_every == 0:
+            message["files"] = [self.file(channel_index, index, self._author(channel_index, index))]
+        return message
+
+    def replies_of(self, channel_id: str, thread_ts: str, oldest) -> list:
+        """The parent and its replies newer than oldest, oldest first."""
+        index = int(float(thread_ts)) - BASE_TS
+        if index % MESSAGE_INTERVAL or not 0 <= index // MESSAGE_INTERVAL < self.messages:
+            return []
+        index //= MESSAGE_INTERVAL
+        channel_index = self._channel_index(channel_id)
+        messages = [self.message(channel_id, index)]
+        for reply in range(1, self.replies + 1):
+            ts = self._ts(index, reply)
+            if oldest is not None and float(ts) <= float(oldest):
+                continue
+            messages.append({"type": "message", "ts": ts, "thread_ts": thread_ts,
+                             "user": self._author(channel_index, index + reply),
+                             "text": f"reply {reply} <@{self._author(channel_index, index)}> agreed"})
+        return messages
+
+    def file(self, channel_index: int, index: int, user_id: str) -> dict:
+        file_id = f"F{channel_index:04d}{index:08d}"
+        return {"id": file_id, "name": f"{file_id}.bin", "user": user_id, "size": self.file_bytes,
+                "url_private_download": f"{self.base_url}/files/{file_id}.bin"}
+
+    def _author(self, channel_index: int, index: int) -> str:
+        return self.user_id((channel_index + index % self.members) % self.users)
+
+    @staticmethod
+    def _ts(index: int, reply: int) -> str:
+        return f"{BASE_TS + index * MESSAGE_INTERVAL}.{reply:06d}"
+
+    @staticmethod
+    def _channel_index(channel_id: str) -> int:
+        return int(channel_id[1:])
+
+
+class FaultInjector:
+    """Adds latency to every call and answers a share of them with 429, or the next calls of a method."""
+
+    def __init__(self, latency=0.0, rate_limited_share=0.0, retry_after=1, seed=1):
+        self.latency = latency
+        self.rate_limited_share = rate_limited_share
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def fail_next(self, method: str, status: int, count: int = 1, **params):
+        """Answers the next count calls of a Slack method that have the given params with status, e.g.
+        fail_next("conversations.replies", 500, ts=thread_ts). The downloads are method "files" with the
+        file id as param "file". A 429 comes with Retry-After."""
+        with self._lock:
+            self._failures.setdefault(method, []).extend([(params, status)] * count)
+
+    def take_failure(self, method: str, params: dict):
+        """The status the call has to be answered with, or None."""
+        with self._lock:
+            failures = self._failures.get(method, [])
+            for index, (failure_params, status) in enumerate(failures):
+                if failure_params.items() <= params.items():
+                    del failures[index]
+                    return status
+        return None
+
+    def delay(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def is_rate_limited(self) -> bool:
+        if self.rate_limited_share <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.rate_limited_share
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, name: str):
+        with self.server.lock:
+            self.server.calls[name] += 1
+
+    def _send_json(self, status: int, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def _discard_body(self) -> int:
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            return len(self._read_body())
+        remaining = int(self.headers.get("Content-Length") or 0)
+        length = remaining
+        while remaining > 0:
+            remaining -= len(self.rfile.read(min(remaining, DOWNLOAD_CHUNK)))
+        return length
+
+    def _send_stats(self):
+        with self.server.lock:
+            self._send_json(200, dict(self.server.calls))
+
+
+class _SlackHandler(_Handler):
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        if url.path == "/_stats":
+            return self._send_stats()
+        if url.path.startswith("/files/"):
+            return self._send_file()
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        body = self._read_body() if self.command == "POST" else b""
+        if body:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update({name: values[-1] for name, values in parse_qs(body.decode()).items()})
+        method = url.path.rsplit("/", 1)[-1]
+        faults = self.server.faults
+        faults.delay()
+        status = faults.take_failure(method, params)
+        if status == 429 or status is None and faults.is_rate_limited():
+            self._count("rate_limited")
+            return self._send_json(429, {"ok": False, "error": "ratelimited"},
+                                   {"Retry-After": str(faults.retry_after)})
+        if status is not None:
+            return self._send_json(status, {"ok": False, "error": "internal_error"})
+        handler = getattr(self, "_" + method.replace(".", "_"), None)
+        if handler is None:
+            return self._send_json(200, {"ok": False, "error": "unknown_method"})
+        self._count(method)
+        self._send_json(200, dict(handler(params), ok=True))
+
+    def _send_file(self):
+        self._count("files")
+        self.server.faults.delay()
+        file_id = urlparse(self.path).path.rsplit("/", 1)[-1].split(".", 1)[0]
+        status = self.server.faults.take_failure("files", {"file": file_id})
+        if status is not None:
+            return self._send_json(status, {"ok": False, "error": "internal_error"})
+        size = self.server.workspace.file_bytes
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        chunk = b"\0" * DOWNLOAD_CHUNK
+        while size > 0:
+            self.wfile.write(chunk[:size])
+            size -= DOWNLOAD_CHUNK
+
+    @staticmethod
+    def _page(items, params: dict, default_limit: int) -> tuple:
+        start = int(params.get("cursor") or 0)
+        limit = int(params.get("limit") or default_limit)
+        page = items[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(items) else ""
+        return page, next_cursor
+
+    def _users_list(self, params: dict) -> dict:
+        workspace = self.server.workspace
+        # The synchronous loader reads a single page, as Slack answers without a limit
+        page, next_cursor = self._page(range(workspace.users), params, workspace.users)
+        return {"members": [workspace.user(index) for index in page],
+                "response_metadata": {"next_cursor": next_cursor}}
+
+    def _conversations_list(self, params: dict) -> dict:
+        workspace = self.server.workspace
+        if "public_channel" not in params.get("types", "public_channel"):
+            return {"channels": [], "response_metadata": {"next_cursor": ""}}
+        page, next_cursor = self._page(range(workspace.channels), params, 100)
+        return {"channels": [workspace.channel(index) for index in page],
+                "response_metadata": {"next_cursor": next_cursor}}
+
+    def _conversations_members(self, params: dict) -> dict:
+        page, next_cursor = self._page(self.server.workspace.channel_members(params["channel"]), params, 100)
+        return {"members": page, "response_metadata": {"next_cursor": next_cursor}}
+
+    def _conversations_history(self, params: dict) -> dict:
+        workspace = self.server.workspace
+        latest = params.get("latest")
+        history = workspace.history(params["channel"], float(params.get("oldest") or 0),
+                                    float(latest) if latest else None)
+        page, next_cursor = self._page(history, params, 100)
+        return {"messages": [workspace.message(params["channel"], index) for index in page],
+                "has_more": bool(next_cursor), "response_metadata": {"next_cursor": next_cursor}}
+
+    def _conversations_replies(self, params: dict) -> dict:
+        replies = self.server.workspace.replies_of(params["channel"], params["ts"], params.get("oldest"))
+        page, next_cursor = self._page(replies, params, 100)
+        return {"messages": page, "has_more": bool(next_cursor), "response_metadata": {"next_cursor": next_cursor}}
+
+
+class MattermostState:
+    """What was created in the fake Mattermost; posts keep their props only."""
+
+    # Mattermost ids are 26 characters long
+    TEAM_ID = "benchteam" + "0" * 17
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.users = []
+        self.channels = []
+        self.members = {}
+        self.posts = {}
+        self.file_bytes = 0
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}{next(self.ids):025d}"
+
+
+class _MattermostHandler(_Handler):
+
+    def do_GET(self):
+        self._dispatch(self._get)
+
+    def do_POST(self):
+        self._dispatch(self._post)
+
+    def do_PUT(self):
+        self._dispatch(self._post)
+
+    def _dispatch(self, handler):
+        url = urlparse(self.path)
+        if url.path == "/_stats":
+            return self._send_stats()
+        path = url.path[len("/api/v4"):] if url.path.startswith("/api/v4") else url.path
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        faults = self.server.faults
+        faults.delay()
+        if faults.is_rate_limited():
+            self._discard_body()
+            self._count("rate_limited")
+            return self._send_json(429, {"message": "too many requests"},
+                                   {"Retry-After": str(faults.retry_after), "X-RateLimit-Remaining": "0",
+                                    "X-RateLimit-Reset": str(faults.retry_after)})
+        # Named after the path with ids left out, e.g. "POST /channels/{id}/members"
+        parts = path.strip("/").split("/")
+        self._count(f"{self.command} /" + "/".join("{id}" if index % 2 else part
+                                                   for index, part in enumerate(parts)))
+        if self.command == "GET":
+            body = None
+        elif parts == ["files"]:
+            # File contents are only counted
+            body = self._discard_body()
+        else:
+            body = json.loads(self._read_body() or b"{}")
+        with self.server.lock:
+            status, response = handler(parts, params, body)
+        self._send_json(status, response, {"X-RateLimit-Remaining": "1000", "X-RateLimit-Reset": "1"})
+
+    @staticmethod
+    def _page(items: list, params: dict) -> list:
+        page = int(params.get("page", 0))
+        per_page = int(params.get("per_page", 60))
+        return items[page * per_page:(page + 1) * per_page]
+
+    def _get(self, parts: list, params: dict, body) -> tuple:
+        state = self.server.state
+        if parts == ["users"]:
+            return 200, self._page(state.users, params)
+        if parts == ["channels"]:
+            return 200, self._page(state.channels, params)
+        if parts == ["teams"]:
+            return 200, [{"id": state.TEAM_ID, "name": "bench"}]
+        if len(parts) == 3 and parts[0] == "channels" and parts[2] == "members":
+            return 200, self._page([{"channel_id": parts[1], "user_id": user_id}
+                                    for user_id in state.members.get(parts[1], [])], params)
+        if len(parts) == 3 and parts[0] == "channels" and parts[2] == "posts":
+            posts = [post for post in reversed(list(state.posts.values())) if post["channel_id"] == parts[1]]
+            posts = self._page(posts, params)
+            return 200, {"order": [post["id"] for post in posts], "posts": {post["id"]: post for post in posts}}
+        return 404, {"message": "not found"}
+
+    def _post(self, parts: list, params: dict, body) -> tuple:
+        state = self.server.state
+        if parts == ["files"]:
+            state.file_bytes += body
+            return 201, {"file_infos": [{"id": state.new_id("f"), "name": params.get("filename")}]}
+        if parts == ["posts"]:
+            post = {"id": state.new_id("p"), "channel_id": body.get("channel_id"), "root_id": body.get("root_id", ""),
+                    "create_at": body.get("create_at", 0), "props": body.get("props") or {}}
+            state.posts[post["id"]] = post
+            return 201, post
+        if parts == ["users"]:
+            user = {"id": state.new_id("u"), "username": body.get("username"), "email": body.get("email")}
+            state.users.append(user)
+            return 201, user
+        if parts == ["channels"]:
+            channel = {"id": state.new_id("c"), "name": body.get("name"), "display_name": body.get("display_name"),
+                       "type": body.get("type"), "team_id": body.get("team_id")}
+            state.channels.append(channel)
+            return 201, channel
+        if len(parts) == 3 and parts[0] == "channels" and parts[2] == "members":
+            state.members.setdefault(parts[1], []).append(body["user_id"])
+            return 201, {"channel_id": parts[1], "user_id": body["user_id"]}
+        if len(parts) == 3 and parts[0] == "teams" and parts[2] == "members":
+            return 201, {"team_id": parts[1], "user_id": body["user_id"]}
+        return 404, {"message": "not found"}
+
+
+class _Server(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # Clients that go away mid-request, e.g. a killed migration, are not worth a traceback
+        pass
+
+
+def _start(handler_class, port: int, **attributes) -> ThreadingHTTPServer:
+    server = _Server(("127.0.0.1", port), handler_class)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.calls = Counter()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, name=handler_class.__name__, daemon=True).start()
+    return server
+
+
+def start_slack(workspace: SyntheticWorkspace, faults: FaultInjector, port: int = 0) -> ThreadingHTTPServer:
+    """Serves the workspace on 127.0.0.1, the Web API is under /api/."""
+    server = _start(_SlackHandler, port, workspace=workspace, faults=faults)
+    workspace.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    return server
+
+
+def start_mattermost(faults: FaultInjector, port: int = 0) -> ThreadingHTTPServer:
+    """Serves an empty Mattermost with one team on 127.0.0.1, the API is under /api/v4."""
+    return _start(_MattermostHandler, port, state=MattermostState(), faults=faults)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--channels", type=int, default=10)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=1000, help="top level messages per channel")
+    parser.add_argument("--members", type=int, default=20, help="members per channel")
+    parser.add_argument("--thread-every", type=int, default=10, help="every n-th message starts a thread")
+    parser.add_argument("--replies", type=int, default=5, help="replies per thread")
+    parser.add_argument("--file-every", type=int, default=0, help="every n-th message has a file")
+    parser.add_argument("--file-bytes", type=int, default=65536)
+    parser.add_argument("--slack-latency", type=float, default=0.0, help="seconds added to every Slack call")
+    parser.add_argument("--mm-latency", type=float, default=0.0, help="seconds added to every Mattermost call")
+    parser.add_argument("--slack-429", type=float, default=0.0, help="share of Slack calls answered with 429")
+    parser.add_argument("--mm-429", type=float, default=0.0, help="share of Mattermost calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After seconds sent with a 429")
+
+
+def make_servers(args, slack_port: int = 0, mm_port: int = 0) -> tuple:
+    workspace = SyntheticWorkspace(channels=args.channels, users=args.users, messages=args.messages,
+                                   members=args.members, thread_every=args.thread_every, replies=args.replies,
+                                   file_every=args.file_every, file_bytes=args.file_bytes)
+    slack = start_slack(workspace, FaultInjector(args.slack_latency, args.slack_429, args.retry_after), slack_port)
+    mattermost = start_mattermost(FaultInjector(args.mm_latency, args.mm_429, args.retry_after, seed=2), mm_port)
+    return slack, mattermost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--slack-port", type=int, default=8801)
+    parser.add_argument("--mm-port", type=int, default=8802)
+    args = parser.parse_args()
+
+    slack, mattermost = make_servers(args, args.slack_port, args.mm_port)
+    print(f"SLACK_API_URL=http://127.0.0.1:{slack.server_address[1]}/api/")
+    print(f"MATTERMOST_URL=http://127.0.0.1:{mattermost.server_address[1]}/api/v4")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
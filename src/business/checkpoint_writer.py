@@ -0,0 +1,116 @@
+import atexit
+import logging
+import threading
+import time
+
+from src.util.settings_parser import SettingsParser
+
+
+class CheckpointWriter:
+    """Buffers per-channel sync watermarks and writes them to the config in batches.
+
+    A flush happens after checkpoint_flush_messages updates, every
+    checkpoint_flush_seconds while running, on close() and at interpreter exit,
+    so at most that window of progress is redone after a crash.
+    """
+
+    def __init__(self, config_service, state_store):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._config_service = config_service
+        self._state_store = state_store
+        self._channel_ids = {}
+        self._flush_messages = settings.checkpoint_flush_messages
+        self._flush_seconds = settings.checkpoint_flush_seconds
+        self._pending = {}
+        # When each channel with unsaved progress got it, for the checkpoint lag metric
+        self._pending_since = {}
+        self._updates = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flush_thread = None
+        atexit.register(self.flush)
+
+    def start(self):
+        with self._lock:
+            if self._flush_thread is not None:
+                return
+            self._stop.clear()
+            self._flush_thread = threading.Thread(target=self._flush_periodically, name="checkpoint-writer",
+                                                  daemon=True)
+            self._flush_thread.start()
+
+    def close(self):
+        with self._lock:
+            flush_thread = self._flush_thread
+            self._flush_thread = None
+        if flush_thread is not None:
+            self._stop.set()
+            flush_thread.join()
+        self.flush()
+
+    def set_last_synchronize_date_unix(self, timestmp: float, channel_name="all", channel_id=None):
+        with self._lock:
+            if channel_id is not None:
+                self._channel_ids[channel_name] = channel_id
+            if self._pending.get(channel_name, 0.0) < timestmp:
+                self._pending[channel_name] = timestmp
+            self._pending_since.setdefault(channel_name, time.monotonic())
+            self._updates += 1
+            flush_now = self._updates >= self._flush_messages
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._updates = 0
+            if not pending:
+                return
+            try:
+                saved = self._config_service.set_last_synchronize_dates_unix(pending) is not None
+                if saved:
+                    for channel_name, timestmp in pending.items():
+                        if channel_name in self._channel_ids:
+                            self._state_store.set_channel_watermark(self._channel_ids[channel_name], channel_name,
+                                                                    timestmp)
+                    self._state_store.flush()
+            except Exception:
+                self._requeue(pending)
+                raise
+            if not saved:
+                # The config repository has logged why, the next flush tries again
+                self._requeue(pending)
+                self._logger_bot.error("Checkpoint of %d channels not saved", len(pending))
+                return
+            with self._lock:
+                now = time.monotonic()
+                for channel_name in pending:
+                    if channel_name in self._pending:
+                        # Progress that came in during the flush is not saved yet
+                        self._pending_since[channel_name] = now
+                    else:
+                        self._pending_since.pop(channel_name, None)
+            self._logger_bot.info("Checkpoint saved for %d channels", len(pending))
+
+    def get_pending_since(self) -> dict:
+        """Maps channels whose progress is not saved yet to the time.monotonic() it is waiting since."""
+        with self._lock:
+            return dict(self._pending_since)
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self._flush_seconds):
+            try:
+                self.flush()
+            except Exception as err:
+                self._logger_bot.error("Error during saving checkpoint: %s", err)
+
+    def _requeue(self, pending: dict):
+        with self._lock:
+            for channel_name, timestmp in pending.items():
+                if self._pending.get(channel_name, 0.0) < timestmp:
+                    self._pending[channel_name] = timestmp
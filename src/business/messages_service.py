@@ -2,118 +2,117 @@ import logging
 import re
 from datetime import datetime
 
+from src.entity.message_record import ChannelInfo, MessageRecord, ReplyRecord, UserProfile
+
+# Slack markup rewritten for Mattermost, one alternative per token kind: user and channel mentions,
+# <!here> and <!channel>. The kind is the name of the group that matched.
+_MARKUP_PATTERN = re.compile(r'<@(?P<user>\w+)>|<#(?P<channel>\w+)\|.*?>|<!(?P<special>here|channel)>')
+
 
 class MessagesService:
     def __init__(self, config_service, mattermost_upload_messages):
         self._logger_bot = logging.getLogger("")
         self._users_list = {}
         self._channels_list = {}
+        # Profiles and channels shared by all transformed messages, built on first use
+        self._profiles = {}
+        self._channel_infos = {}
         self._config_service = config_service
         self.mm_upload_msg = mattermost_upload_messages
+        self._markup_rewriters = {"user": self._rewrite_user,
+                                  "channel": self._rewrite_channel,
+                                  "special": self._rewrite_special}
 
     def save_messages_to_dict(self, message: dict):
-        user_id = message["user"]
-        if not self._config_service.is_allowed_user(self._find_user_name_by_key(user_id)):
-            return
-
-        users_mentions = self._extract_users_from_message(message["text"])
-
-        message["text"] = self.replace_mentions(message["text"])
-
-        message_dict = {"text": message["text"],
-                        "user": {
-                            "user_id": message["user"],
-                            "user_name": self._users_list.get(message["user"], {}).get("name"),
-                            "user_email": self._users_list.get(message["user"], {}).get("email"),
-                            "user_is_bot": self._users_list.get(message["user"], {}).get("is_bot"),
-                            "user_first_name": self._users_list.get(message["user"], {}).get("first_name"),
-                            "user_last_name": self._users_list.get(message["user"], {}).get("last_name"),
-                            "user_is_deleted": self._users_list.get(message["user"], {}).get("is_deleted"),
-                            "user_display_name": self._users_list.get(message["user"], {}).get("display_name")},
-
-
-                        "channel":
-                            {"channel_id": message["channel"],
-                             "channel_name": self._channels_list.get(message["channel"], {}).get("name"),
-                             "channel_type": self._channels_list.get(message["channel"], {}).get("type"),
-                             "channel_members": self._channels_list.get(message["channel"], {}).get("members")},
-
-                        "ts": message["ts"], "is_attached": message["is_attached"],
-                        "is_thread": message["is_thread"]}
-
+        message_record = self.transform_message(message)
+        if message_record is not None:
+            self.mm_upload_msg.upload_messages(message_record)
+
+    def transform_message(self, message: dict):
+        return self.transform_page([message])[0]
+
+    def transform_page(self, page: list) -> list:
+        """Transforms a history page into upload-ready records, in page order, None where the author is excluded.
+
+        Excluded users are checked against one set, authors and mentioned users are resolved once
+        per page and the slack_ts stamps are formatted together. A page shares no state with other
+        pages but the interned profiles, so pages can be transformed in parallel.
+        """
+        excluded_users = self._config_service.get_excluded_users()
+        allowed = [self._find_user_name_by_key(message["user"]) not in excluded_users for message in page]
+        messages = [message for message, is_allowed in zip(page, allowed) if is_allowed]
+
+        texts = []
+        user_ids = set()
+        for message in messages:
+            text, users_mentions = self._rewrite_markup(self._message_text(message))
+            reply_texts = []
+            user_ids.add(message["user"])
+            if message["is_thread"]:
+                for reply_message in message["reply"]:
+                    reply_text, reply_mentions = self._rewrite_markup(reply_message["text"])
+                    reply_texts.append(reply_text)
+                    users_mentions.extend(reply_mentions)
+                    user_ids.add(reply_message["user"])
+            user_ids.update(users_mentions)
+            texts.append((text, reply_texts, users_mentions))
+        profiles = {user_id: self._get_profile(user_id) for user_id in user_ids}
+        stamps = self._format_timestamps([message["ts"] for message in messages])
+
+        records = iter([self._build_record(message, text, reply_texts, users_mentions, stamp, profiles)
+                        for message, (text, reply_texts, users_mentions), stamp in zip(messages, texts, stamps)])
+        return [next(records) if is_allowed else None for is_allowed in allowed]
+
+    def _message_text(self, message: dict) -> str:
+        text = message["text"]
         if "attachments" in message:
-            if len(message_dict["text"]) > 0:
-                message_dict["text"] = message_dict["text"] + '\n'
-
-            attachments = message["attachments"]
-            users_mentions = []
-            for attachment in attachments:
-                users_mentions.extend(self._extract_users_from_message(message["text"]))
+            # Attachments are appended first, so the whole text is rewritten in one pass
+            text_parts = [text + '\n' if len(text) > 0 else text]
+            for attachment in message["attachments"]:
                 if "author_id" in attachment:
-
-                    message_dict["text"] = message_dict["text"] + \
-                                           f'>>> <@{attachment["author_id"]}> ' \
-                                           f'{attachment["text"]} \n'
-                    message_dict["text"] = self.replace_mentions(message_dict["text"])
+                    text_parts.append(f'>>> <@{attachment["author_id"]}> {attachment["text"]} \n')
                 else:
                     self._logger_bot.info("Message without author_id: %s", attachment)
-                    message_dict["text"] = message_dict["text"] + f'>>> {attachment["fallback"]} '
-                    message_dict["text"] = self.replace_mentions(message_dict["text"])
-
-        if message_dict["is_attached"]:
-            message_dict["files"] = message["files"]
-
-        if message_dict["is_thread"]:
-            reply_list = []
-            for reply_message in message["reply"]:
-                users_mentions.extend(self._extract_users_from_message(reply_message["text"]))
-                reply_dict = {"text": self.replace_mentions(reply_message["text"]), "user_id": reply_message["user"],
-                              "user":
-                                  {
-                                      "user_id": reply_message["user"],
-                                      "user_name": self._users_list.get(reply_message["user"], {}).get("name"),
-                                      "user_email": self._users_list.get(reply_message["user"], {}).get("email"),
-                                      "user_is_bot": self._users_list.get(reply_message["user"], {}).get("is_bot"),
-                                      "user_first_name": self._users_list.get(reply_message["user"], {}).get(
-                                          "first_name"),
-                                      "user_last_name": self._users_list.get(reply_message["user"], {}).get(
-                                          "last_name"),
-                                      "user_is_deleted": self._users_list.get(reply_message["user"], {}).get(
-                                          "is_deleted"),
-                                      "user_display_name": self._users_list.get(reply_message["user"], {}).get(
-                                          "display_name")},
-                              "channel":
-                                  {"channel_id": message["channel"],
-                                   "channel_name": self._channels_list.get(message["channel"], {}).get("name"),
-                                   "channel_type": self._channels_list.get(message["channel"], {}).get("type")},
-                              "ts": reply_message["ts"], "is_attached": False,
-                              "is_thread": True
-                              }
-                if "files" in reply_message:
-                    reply_dict["files"] = reply_message["files"]
-                reply_list.append(reply_dict)
-            message_dict["reply"] = reply_list
-        message_dict["text"] = self._add_timestamp_to_text(message_dict["text"], message_dict["ts"])
-        users_mentions_list = []
-        for mention in users_mentions:
-            users_mentions_dict = {
-                "user_id": mention,
-                "user_name": self._users_list.get(mention, {}).get("name"),
-                "user_email": self._users_list.get(mention, {}).get("email"),
-                "user_is_bot": self._users_list.get(mention, {}).get("is_bot"),
-                "user_first_name": self._users_list.get(mention, {}).get("first_name"),
-                "user_last_name": self._users_list.get(mention, {}).get("last_name"),
-                "user_is_deleted": self._users_list.get(mention, {}).get("is_deleted"),
-                "user_display_name": self._users_list.get(mention, {}).get("display_name")}
-
-            users_mentions_list.append(users_mentions_dict)
-
-        message_dict["users_in_mentions"] = users_mentions_list
-
-        self.mm_upload_msg.upload_messages(message_dict)
+                    text_parts.append(f'>>> {attachment["fallback"]} ')
+            text = "".join(text_parts)
+        return text
+
+    def _build_record(self, message: dict, text: str, reply_texts: list, users_mentions: list, stamp: str,
+                      profiles: dict) -> MessageRecord:
+        message_record = MessageRecord(text=self._add_timestamp_to_text(text, stamp),
+                                       user=profiles[message["user"]],
+                                       channel=self._get_channel_info(message["channel"]),
+                                       ts=message["ts"], is_attached=message["is_attached"],
+                                       is_thread=message["is_thread"])
+        if message_record.is_attached:
+            message_record.files = message["files"]
+
+        if message_record.is_thread:
+            message_record.reply = [ReplyRecord(text=reply_text, user=profiles[reply_message["user"]],
+                                                channel=message_record.channel, ts=reply_message["ts"],
+                                                files=reply_message.get("files"))
+                                    for reply_message, reply_text in zip(message["reply"], reply_texts)]
+
+        # Each mentioned user once, in order of appearance
+        message_record.users_in_mentions = [profiles[mention] for mention in dict.fromkeys(users_mentions)]
+
+        return message_record
+
+    def _get_profile(self, user_id: str) -> UserProfile:
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            profile = self._profiles.setdefault(user_id, UserProfile(user_id, self._users_list.get(user_id, {})))
+        return profile
+
+    def _get_channel_info(self, channel_id: str) -> ChannelInfo:
+        channel_info = self._channel_infos.get(channel_id)
+        if channel_info is None:
+            channel_info = self._channel_infos.setdefault(
+                channel_id, ChannelInfo(channel_id, self._channels_list.get(channel_id, {})))
+        return channel_info
 
     def _find_user_name_by_key(self, key) -> str:
-        return self._users_list.get(key)
+        return self._users_list.get(key, {}).get("name")
 
     def _get_user_item(self, user_id: str) -> dict:
         user_dict = self._users_list.get(user_id)
@@ -124,81 +123,58 @@ class MessagesService:
 
     def set_users_list(self, users_list):
         self._users_list = users_list
+        self._profiles = {}
 
     def get_channels_list(self) -> dict:
         return self._channels_list
 
     def set_channels_list(self, channels_list):
         self._channels_list = channels_list
-
-    def replace_user_function(self, match):
-        matched_text = match.group(0)
-        matched_text = matched_text[2:len(matched_text) - 1]
-        user_data = self._users_list.get(matched_text)
-        user_name = user_data["name"]
-        if user_name == '' or user_name is None:
-            user_name = match.group(0)
-        else:
-            user_name = "@" + user_data["name"]
-        return user_name
-
-    def replace_channel_function(self, match) -> str:
-        matched_text = match.group(0)
-        matched_text = matched_text[2:matched_text.find('|')]
-        channel_name = ''
-        channel_data = self._channels_list.get(matched_text)
-        if channel_data:
-            channel_name = channel_data["name"]
-        if channel_name == '' or channel_name is None:
-            channel_name = match.group(0)
-        else:
-            channel_name = "~" + channel_name
-        return channel_name
+        self._channel_infos = {}
 
     def replace_mentions(self, msg_text: str) -> str:
+        return self._rewrite_markup(msg_text)[0]
 
-        replaced_message = msg_text
-        pattern = r'<@[\w\d]+>'
-        regex = re.compile(pattern)
-        match = re.search(regex, replaced_message)
-        if match:
-            replaced_message = re.sub(pattern, self.replace_user_function, replaced_message)
-
-        pattern = r'<#([\w\d]+)\|(.*?)>'
-        regex = re.compile(pattern)
-        match = re.search(regex, replaced_message)
-        if match:
-            replaced_message = re.sub(pattern, self.replace_channel_function, replaced_message)
-
-        pattern = r'<!here>'
-        regex = re.compile(pattern)
-        match = re.search(regex, replaced_message)
-        if match:
-            replaced_message = re.sub(pattern, "@here", replaced_message)
-
-        pattern = r'<!channel>'
-        regex = re.compile(pattern)
-        match = re.search(regex, replaced_message)
-        if match:
-            replaced_message = re.sub(pattern, "@channel", replaced_message)
-        return replaced_message
-
-    def _add_timestamp_to_text(self, msg_text: str, timestamp: float) -> str:
-        msg_with_ts = msg_text
-        if msg_with_ts != "" and msg_with_ts is not None:
-            msg_with_ts = msg_with_ts + f'\n\n slack_ts: ' \
-                                        f'{datetime.fromtimestamp(float(timestamp)).strftime("%Y-%m-%d %H:%M:%S")}'
-        else:
-            msg_with_ts = " slack_ts:" + datetime.fromtimestamp(float(timestamp)).strftime("%Y-%m-%d %H:%M:%S")
-        return msg_with_ts
-
-    def _extract_users_from_message(self, msg_txt) -> list:
+    def _rewrite_markup(self, msg_text: str):
+        """Rewrites Slack markup in one pass, returns the text and the ids of the mentioned users."""
         users_mentions = []
-        pattern = r'<@[\w\d]+>'
-        regex = re.compile(pattern)
-        matches = regex.findall(msg_txt)
 
-        for match in matches:
-            users_mentions.append(match[2:len(match) - 1])
+        def rewrite(match):
+            return self._markup_rewriters[match.lastgroup](match, users_mentions)
 
-        return users_mentions
+        return _MARKUP_PATTERN.sub(rewrite, msg_text), users_mentions
+
+    def _rewrite_user(self, match, users_mentions: list) -> str:
+        user_id = match.group("user")
+        users_mentions.append(user_id)
+        user_name = self._users_list.get(user_id, {}).get("name")
+        # Unknown users keep the Slack markup
+        if user_name == '' or user_name is None:
+            return match.group(0)
+        return "@" + user_name
+
+    def _rewrite_channel(self, match, users_mentions: list) -> str:
+        channel_name = self._channels_list.get(match.group("channel"), {}).get("name")
+        if channel_name == '' or channel_name is None:
+            return match.group(0)
+        return "~" + channel_name
+
+    @staticmethod
+    def _rewrite_special(match, users_mentions: list) -> str:
+        return "@" + match.group("special")
+
+    @staticmethod
+    def _format_timestamps(timestamps: list) -> list:
+        # Messages posted within the same second share the formatted stamp
+        formatted = {}
+        for timestamp in timestamps:
+            second = int(float(timestamp))
+            if second not in formatted:
+                formatted[second] = datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
+        return [formatted[int(float(timestamp))] for timestamp in timestamps]
+
+    @staticmethod
+    def _add_timestamp_to_text(msg_text: str, slack_ts: str) -> str:
+        if msg_text != "" and msg_text is not None:
+            return msg_text + f'\n\n slack_ts: {slack_ts}'
+        return " slack_ts:" + slack_ts
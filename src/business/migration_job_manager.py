@@ -0,0 +1,167 @@
+import itertools
+import logging
+import queue
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from src.entity.migration_job import MigrationJob
+from src.util.settings_parser import SettingsParser
+
+
+class MigrationJobManager:
+    """Runs migrations requested by the start command as background jobs.
+
+    Jobs are queued and run one at a time on a worker thread, since they share
+    the Slack loader and the Mattermost uploader. A start request for a channel
+    filter that is already queued or running returns that job instead of a new
+    one. Cancelling a running job lets the channels in progress finish and skips
+    the rest. The last job_history_size finished jobs are kept for status.
+
+    With shard_workers > 1 a job becomes a sharded run: its channels are written
+    to the channel lease store and shard_workers worker processes are started to
+    claim them. Workers in other containers that share the volume join in too.
+    """
+
+    def __init__(self, slack_load_messages, mattermost_upload_messages, channel_lease_store):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._load_messages = slack_load_messages
+        self._mattermost_upload_messages = mattermost_upload_messages
+        self._mattermost_sink = settings.mattermost_sink
+        self._history_size = settings.job_history_size
+        self._shard_workers = settings.shard_workers
+        self._slack_tier_rates = settings.slack_tier_rates
+        self._poll_seconds = min(5.0, settings.lease_seconds / 3)
+        self._lease_store = channel_lease_store
+        self._job_ids = itertools.count(1)
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def submit(self, channel_filter: str, on_finish=None):
+        """Queues a migration, returns the job and whether it is a new one."""
+        with self._lock:
+            for job in self._jobs.values():
+                if job.is_active() and not job.is_cancel_requested() and job.channel_filter == channel_filter:
+                    return job, False
+            job = MigrationJob(job_id=str(next(self._job_ids)), channel_filter=channel_filter)
+            self._jobs[job.job_id] = job
+            self._queue.put((job, on_finish))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run_jobs, name="migration-jobs", daemon=True)
+                self._worker.start()
+        self._logger_bot.info("Migration job %s queued for channels: %s", job.job_id, channel_filter)
+        return job, True
+
+    def get_job(self, job_id: str):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_jobs(self) -> list:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id: str):
+        """Requests cancellation of an active job, returns the job or None if there is none to cancel."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not job.is_active():
+                return None
+            job.cancel_event.set()
+        self._logger_bot.info("Migration job %s cancel requested", job_id)
+        return job
+
+    def _run_jobs(self):
+        while True:
+            job, on_finish = self._queue.get()
+            if job.is_cancel_requested():
+                self._finish(job, "cancelled")
+            else:
+                self._run_job(job)
+            if on_finish is not None:
+                try:
+                    on_finish(job)
+                except Exception as err:
+                    self._logger_bot.error(f"Migration job {job.job_id} finish notification failed: {err}")
+
+    def _run_job(self, job: MigrationJob):
+        job.started_at = datetime.now()
+        job.state = "running"
+        self._logger_bot.info("Migration job %s started", job.job_id)
+        try:
+            self._load_messages.set_channel_filter(job.channel_filter)
+            if self._shard_workers > 1:
+                self._run_sharded(job)
+            else:
+                if self._mattermost_sink == "rest":
+                    self._mattermost_upload_messages.set_channel_filter(job.channel_filter)
+                    self._mattermost_upload_messages.load_users()
+                    self._mattermost_upload_messages.load_channels()
+                    self._mattermost_upload_messages.load_team_id()
+                self._load_messages.load_channel_messages(job=job)
+        except Exception as err:
+            self._logger_bot.exception("Migration job %s failed: %s", job.job_id, err)
+            job.error = str(err)
+            self._finish(job, "failed")
+            return
+        if self._mattermost_sink == "rest" and self._shard_workers == 1:
+            self._logger_bot.info("Mattermost transport counters: %s",
+                                  self._mattermost_upload_messages.get_transport_counters())
+        self._finish(job, "cancelled" if job.is_cancel_requested() else "finished")
+
+    def _run_sharded(self, job: MigrationJob):
+        self._load_messages.start()
+        try:
+            channels = self._load_messages.select_channels()
+        finally:
+            self._load_messages.stop()
+        job.set_channels_total(len(channels))
+        run_id = f"{job.created_at:%Y%m%d%H%M%S}-{job.job_id}"
+        # The Slack rate limits are per workspace, so each worker gets its share of them. Workers read it
+        # and the channels and users from the run, including those started in other containers.
+        worker_tier_rates = {tier: rate / self._shard_workers for tier, rate in self._slack_tier_rates.items()}
+        self._lease_store.create_run(run_id, job.channel_filter, channels, worker_tier_rates,
+                                     self._load_messages.get_workspace(channels))
+        self._logger_bot.info("Migration job %s runs as sharded run %s on %d workers", job.job_id, run_id,
+                              self._shard_workers)
+
+        workers = [subprocess.Popen([sys.executable, "-m", "src.controller.shard_worker", run_id])
+                   for _ in range(self._shard_workers)]
+        cancelled = False
+        try:
+            while True:
+                progress = self._lease_store.get_progress(run_id)
+                job.set_progress(progress["done"] + progress["failed"], progress["failed"], progress["messages"])
+                if job.is_cancel_requested() and not cancelled:
+                    # Workers stop claiming, channels they hold are finished
+                    self._lease_store.set_run_state(run_id, "cancelled")
+                    cancelled = True
+                if progress["leased"] == 0 and (cancelled or progress["pending"] == 0):
+                    break
+                if all(worker.poll() is not None for worker in workers):
+                    self._logger_bot.error("All workers of sharded run %s exited with %d channels left", run_id,
+                                           progress["pending"] + progress["leased"])
+                    break
+                time.sleep(self._poll_seconds)
+        finally:
+            if not cancelled:
+                self._lease_store.set_run_state(run_id, "finished")
+            for worker in workers:
+                worker.wait()
+        progress = self._lease_store.get_progress(run_id)
+        job.set_progress(progress["done"] + progress["failed"], progress["failed"], progress["messages"])
+
+    def _finish(self, job: MigrationJob, state: str):
+        job.finished_at = datetime.now()
+        job.state = state
+        self._logger_bot.info(job.describe())
+        with self._lock:
+            finished = [job_id for job_id, item in self._jobs.items() if not item.is_active()]
+            for job_id in finished[:max(0, len(finished) - self._history_size)]:
+                del self._jobs[job_id]
@@ -0,0 +1,145 @@
+import glob
+import os
+import re
+import threading
+import time
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, ProcessCollector, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+from src.util.settings_parser import SettingsParser
+
+
+class MigrationMetrics:
+    """Prometheus metrics of the migrations run by this process, served by SlackAppManager at /metrics.
+
+    API calls are counted per attempt, so retried calls show up with every status
+    they got. Queue depths and checkpoint lag are read when the metrics are
+    scraped. Worker processes of a sharded run run prometheus_client in multiprocess
+    mode and write their counters and histograms to worker_metrics_dir, which this
+    process adds to its own when it renders them. The files are cleared when the
+    serving process starts, as its own counters start from zero then too.
+    """
+
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    # Mattermost ids are 26 lower case letters and digits
+    MATTERMOST_ID_PATTERN = re.compile(r"/[a-z0-9]{26}(?=/|$)")
+
+    def __init__(self, checkpoint_writer):
+        settings = SettingsParser()
+
+        self._pipelines = {}
+        self._lock = threading.Lock()
+        self.registry = CollectorRegistry()
+        ProcessCollector(registry=self.registry)
+        self._api_requests = Counter("slack_migration_api_requests", "Slack and Mattermost API requests sent",
+                                     ["service", "method", "status"], registry=self.registry)
+        self._api_seconds = Histogram("slack_migration_api_request_seconds", "Latency of API requests",
+                                      ["service", "method"], buckets=self.LATENCY_BUCKETS, registry=self.registry)
+        self._api_retries = Counter("slack_migration_api_retries", "API requests repeated after a failure",
+                                    ["service", "method"], registry=self.registry)
+        self._api_rate_limited = Counter("slack_migration_api_rate_limited", "API requests answered with 429",
+                                         ["service", "method"], registry=self.registry)
+        self._messages = Counter("slack_migration_messages", "Messages through each channel pipeline stage",
+                                 ["channel", "stage"], registry=self.registry)
+        self._attachment_bytes = Counter("slack_migration_attachment_bytes",
+                                         "Attachment bytes downloaded from Slack (in) and sent on (out)",
+                                         ["direction"], registry=self.registry)
+        self.registry.register(_ScrapeTimeCollector(self, checkpoint_writer))
+        self._worker_metrics = None
+        if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+            os.makedirs(settings.worker_metrics_dir, exist_ok=True)
+            for path in glob.glob(os.path.join(settings.worker_metrics_dir, "*.db")):
+                os.remove(path)
+            self._worker_metrics = MultiProcessCollector(None, path=settings.worker_metrics_dir)
+
+    def observe_api_call(self, service: str, method: str, status, seconds: float):
+        """status is the HTTP status, or "error" when no answer came."""
+        self._api_requests.labels(service, method, str(status)).inc()
+        self._api_seconds.labels(service, method).observe(seconds)
+
+    def count_retry(self, service: str, method: str):
+        self._api_retries.labels(service, method).inc()
+
+    def count_rate_limited(self, service: str, method: str):
+        self._api_rate_limited.labels(service, method).inc()
+
+    def count_messages(self, channel: str, stage: str, count: int = 1):
+        self._messages.labels(channel, stage).inc(count)
+
+    def count_attachment_bytes(self, direction: str, count: int):
+        self._attachment_bytes.labels(direction).inc(count)
+
+    def mattermost_endpoint(self, method: str, path: str) -> str:
+        """The request method and path with ids left out, e.g. "POST /channels/{id}/members"."""
+        return f"{method} {self.MATTERMOST_ID_PATTERN.sub('/{id}', path.split('?', 1)[0])}"
+
+    def track_pipeline(self, channel: str, queues: dict):
+        with self._lock:
+            self._pipelines[channel] = queues
+
+    def untrack_pipeline(self, channel: str):
+        with self._lock:
+            self._pipelines.pop(channel, None)
+
+    def render(self) -> bytes:
+        """The metrics of this process in the Prometheus text format, with those of the shard workers added."""
+        if self._worker_metrics is None:
+            return generate_latest(self.registry)
+        return generate_latest(_MergedRegistry(self.registry, self._worker_metrics))
+
+    def get_queue_depths(self) -> list:
+        """(channel, queue name, depth) of every running pipeline."""
+        with self._lock:
+            pipelines = list(self._pipelines.items())
+        return [(channel, name, pipeline_queue.qsize()) for channel, queues in pipelines
+                for name, pipeline_queue in queues.items()]
+
+
+class _MergedRegistry:
+    """Adds up the samples with the same name and labels of several collectors."""
+
+    def __init__(self, *collectors):
+        self._collectors = collectors
+
+    def collect(self):
+        families = {}
+        values = {}
+        for collector in self._collectors:
+            for family in collector.collect():
+                merged = families.setdefault(family.name, family)
+                for sample in family.samples:
+                    key = (family.name, sample.name, tuple(sorted(sample.labels.items())))
+                    if key not in values:
+                        values[key] = sample
+                        if merged is not family:
+                            merged.samples.append(sample)
+                    elif not sample.name.endswith("_created"):
+                        values[key] = values[key]._replace(value=values[key].value + sample.value)
+        for family in families.values():
+            family.samples = [values[(family.name, sample.name, tuple(sorted(sample.labels.items())))]
+                              for sample in family.samples]
+            yield family
+
+
+class _ScrapeTimeCollector:
+    def __init__(self, metrics: MigrationMetrics, checkpoint_writer):
+        self._metrics = metrics
+        self._checkpoint_writer = checkpoint_writer
+
+    def collect(self):
+        queue_depth = GaugeMetricFamily("slack_migration_pipeline_queue_depth",
+                                        "Items waiting between pipeline stages (pages before transform, "
+                                        "messages before upload)", labels=["channel", "queue"])
+        for channel, name, depth in self._metrics.get_queue_depths():
+            queue_depth.add_metric([channel, name], depth)
+        yield queue_depth
+
+        checkpoint_lag = GaugeMetricFamily("slack_migration_checkpoint_lag_seconds",
+                                           "Seconds since delivered messages of the channel wait for their "
+                                           "checkpoint to be saved", labels=["channel"])
+        now = time.monotonic()
+        for channel, pending_since in self._checkpoint_writer.get_pending_since().items():
+            checkpoint_lag.add_metric([channel], now - pending_since)
+        yield checkpoint_lag
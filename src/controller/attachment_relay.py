@@ -0,0 +1,198 @@
+import logging
+import os
+import tempfile
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+
+from src.util.settings_parser import SettingsParser
+
+
+class _DownloadStream:
+    """File-like view of a Slack download, so requests sends it with its Content-Length."""
+
+    def __init__(self, raw, length: int, chunk_size: int, metrics):
+        self._raw = raw
+        self._chunk_size = chunk_size
+        self._metrics = metrics
+        self.len = length
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._chunk_size:
+            size = self._chunk_size
+        data = self._raw.read(size)
+        self.bytes_read += len(data)
+        self._metrics.count_attachment_bytes("in", len(data))
+        return data
+
+
+class AttachmentRelay:
+    """Copies Slack files to Mattermost without storing them locally.
+
+    The Slack download is streamed as the raw body of a Mattermost /files upload
+    (channel_id and filename go in the query string), so at most
+    attachment_chunk_size bytes of a file are held in memory. A streamed body can
+    not be sent twice, so when that upload fails the file is downloaded again into
+    a temporary file in WORKDIR, which the transport is able to retry, and the
+    temporary file is removed right after.
+
+    With the attachment cache enabled, files are downloaded into the cache once
+    and every upload of the same Slack file is sent from there. fetch() gives the
+    bulk import sink a local copy, from the cache or a temporary file. The bytes read
+    from Slack and sent on are counted in the migration metrics.
+    """
+
+    OK = 200
+    CREATED = 201
+    RATE_LIMITED = 429
+    SLACK_TIMEOUT = (10, 60)
+
+    def __init__(self, mattermost_transport, attachment_cache, http_cassette, migration_metrics):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._metrics = migration_metrics
+        self._mm_transport = mattermost_transport
+        self._attachment_cache = attachment_cache
+        self._chunk_size = settings.attachment_chunk_size
+        self._spool_dir = os.environ.get('WORKDIR')
+        self._slack_session = requests.Session()
+        self._slack_session.headers["Authorization"] = 'Bearer %s' % settings.slack_bot_token
+        # One keep-alive connection per attachment worker, files.slack.com is the only host
+        self._slack_session.mount('https://', HTTPAdapter(pool_connections=1,
+                                                          pool_maxsize=settings.attachment_workers))
+        http_cassette.mount(self._slack_session, "slack_files")
+
+    def upload(self, file: dict, channel_id: str):
+        """Returns the Mattermost file id, or None when the file could not be copied."""
+        params = {"channel_id": channel_id, "filename": file["file_name"]}
+        if file.get("file_id") and self._attachment_cache.fits(file.get("size")):
+            cached_file = self._open_cached(file)
+            if cached_file is not None:
+                with cached_file:
+                    return self._post_file(params, cached_file)
+
+        try:
+            response = self._download(file)
+            if response is None:
+                return None
+            with response:
+                body = self._stream(response)
+                response_file = self._mm_transport.post('/files', params=params, data=body)
+            if response_file.status_code == self.CREATED:
+                self._metrics.count_attachment_bytes("out", body.bytes_read if isinstance(body, _DownloadStream)
+                                                     else file.get("size") or 0)
+                return response_file.json()['file_infos'][0]['id']
+            reason = f"status {response_file.status_code}"
+        except (RequestException, OSError) as err:
+            reason = f"{type(err).__name__}"
+
+        self._logger_bot.info("Streaming file %s to Mattermost failed (%s), retrying from a local copy",
+                              file["file_name"], reason)
+        return self._upload_spooled(file, params)
+
+    def fetch(self, file: dict):
+        """Downloads the Slack file and returns it opened for reading, or None when that failed.
+
+        The file comes from the attachment cache when it fits there, otherwise it is a temporary
+        file in WORKDIR that is removed when it is closed.
+        """
+        if file.get("file_id") and self._attachment_cache.fits(file.get("size")):
+            cached_file = self._open_cached(file)
+            if cached_file is not None:
+                return cached_file
+
+        try:
+            response = self._download(file)
+            if response is None:
+                return None
+            spool = tempfile.TemporaryFile(dir=self._spool_dir)
+            try:
+                with response:
+                    for chunk in self._iter_chunks(response):
+                        spool.write(chunk)
+            except BaseException:
+                spool.close()
+                raise
+        except (RequestException, OSError) as err:
+            self._logger_bot.error(f'Download of file {file["file_name"]} failed: {err}')
+            return None
+        spool.seek(0)
+        return spool
+
+    def copy_to(self, source, target):
+        """Copies a file returned by fetch() into the writable file object target."""
+        while True:
+            chunk = source.read(self._chunk_size)
+            if not chunk:
+                return
+            target.write(chunk)
+            self._metrics.count_attachment_bytes("out", len(chunk))
+
+    def _upload_spooled(self, file: dict, params: dict):
+        response = self._download(file)
+        if response is None:
+            return None
+        with response, tempfile.TemporaryFile(dir=self._spool_dir) as spool:
+            for chunk in self._iter_chunks(response):
+                spool.write(chunk)
+            spool.seek(0)
+            return self._post_file(params, spool)
+
+    def _open_cached(self, file: dict):
+        with self._attachment_cache.file_lock(file["file_id"]):
+            cached_file = self._attachment_cache.open(file["file_id"])
+            if cached_file is not None:
+                self._logger_bot.info("File %s is taken from the attachment cache", file["file_name"])
+                return cached_file
+            response = self._download(file)
+            if response is None:
+                return None
+            with response:
+                if not self._attachment_cache.store(file["file_id"], self._iter_chunks(response)):
+                    return None
+            return self._attachment_cache.open(file["file_id"])
+
+    def _post_file(self, params: dict, file_object):
+        response_file = self._mm_transport.post('/files', params=params, data=file_object)
+        if response_file.status_code == self.CREATED:
+            self._metrics.count_attachment_bytes("out", os.fstat(file_object.fileno()).st_size)
+            return response_file.json()['file_infos'][0]['id']
+        self._logger_bot.error(
+            f'Mattermost API Error (files). Status code: {response_file.status_code} '
+            f'Response:{response_file.text}')
+        return None
+
+    def _download(self, file: dict):
+        self._logger_bot.info(f'{file["file_name"]} is downloading')
+        started = time.monotonic()
+        try:
+            response = self._slack_session.get(file["link"], stream=True, timeout=self.SLACK_TIMEOUT)
+        except RequestException:
+            self._metrics.observe_api_call("slack", "files_download", "error", time.monotonic() - started)
+            raise
+        # Timed up to the response headers, the caller reads the body
+        self._metrics.observe_api_call("slack", "files_download", response.status_code, time.monotonic() - started)
+        if response.status_code == self.RATE_LIMITED:
+            self._metrics.count_rate_limited("slack", "files_download")
+        if response.status_code != self.OK:
+            self._logger_bot.error(f'SlackAPIError (files): {response.text}')
+            response.close()
+            return None
+        return response
+
+    def _stream(self, response):
+        length = response.headers.get("Content-Length")
+        if length is not None and "Content-Encoding" not in response.headers:
+            response.raw.decode_content = True
+            return _DownloadStream(response.raw, int(length), self._chunk_size, self._metrics)
+        # Size unknown up front, send the body chunked
+        return self._iter_chunks(response)
+
+    def _iter_chunks(self, response):
+        for chunk in response.iter_content(chunk_size=self._chunk_size):
+            self._metrics.count_attachment_bytes("in", len(chunk))
+            yield chunk
@@ -0,0 +1,187 @@
+import logging
+import queue
+import threading
+import time
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class ChannelPipeline:
+    """Streams one channel through fetch -> transform -> upload stages.
+
+    Fetching and transforming run in their own threads and hand off through
+    bounded queues, so the first page is uploaded while later pages are still
+    being fetched and at most a few pages are held in memory at a time.
+    prepare_message may be None when pages arrive already prepared. message_done
+    gets each message with whether upload_message reported it delivered.
+    prefetch_message, when given, is called with each transformed message as it
+    is queued for upload, so slow work such as file transfers can start early.
+    transform_page, when given, transforms whole pages instead of transform_message
+    and returns one result per message, in page order. Messages with a true
+    "load_failed" key could not be read in full, e.g. their thread, and are
+    reported undelivered without being transformed or uploaded.
+    stats counts the messages through each stage and the seconds each stage was
+    busy, time spent waiting on the queues left out. migration_metrics, when
+    given, gets the message counts as they change and the depths of the queues.
+    Setting stop_event, when given, stops the pipeline after the message being
+    uploaded; run() then returns with stopped set.
+    """
+
+    _END = object()
+    _FAILED = object()
+    _PUT_TIMEOUT = 0.5
+
+    def __init__(self, channel_name: str, pages, prepare_message, transform_message, upload_message,
+                 message_done, queue_size: int, page_size: int, prefetch_message=None, transform_page=None,
+                 migration_metrics=None, stop_event: threading.Event = None):
+        self._logger_bot = logging.getLogger("")
+        self._channel_name = channel_name
+        self._pages = pages
+        self._prepare_message = prepare_message
+        self._transform_message = transform_message
+        self._transform_page = transform_page
+        self._upload_message = upload_message
+        self._message_done = message_done
+        self._prefetch_message = prefetch_message
+        self._metrics = migration_metrics
+        # queue_size bounds the number of messages buffered between two stages
+        self._pages_queue = queue.Queue(maxsize=max(1, queue_size // page_size))
+        self._upload_queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._stop_event = stop_event
+        self._errors = []
+        self.stopped = False
+        self.stats = {"fetched": 0, "transformed": 0, "uploaded": 0,
+                      "fetch_seconds": 0.0, "transform_seconds": 0.0, "upload_seconds": 0.0}
+
+    def run(self):
+        stages = [threading.Thread(target=self._run_stage, args=(self._fetch, self._pages_queue),
+                                   name=f"fetch-{self._channel_name}", daemon=True),
+                  threading.Thread(target=self._run_stage, args=(self._transform, self._upload_queue),
+                                   name=f"transform-{self._channel_name}", daemon=True)]
+        if self._metrics is not None:
+            self._metrics.track_pipeline(self._channel_name, {"pages": self._pages_queue,
+                                                              "upload": self._upload_queue})
+        for stage in stages:
+            stage.start()
+        try:
+            self._upload()
+        except PipelineStopped:
+            pass
+        except BaseException as err:
+            self._errors.append(err)
+            self._stop.set()
+            raise
+        finally:
+            for stage in stages:
+                stage.join()
+            if self._metrics is not None:
+                self._metrics.untrack_pipeline(self._channel_name)
+
+        if self._errors:
+            raise self._errors[0]
+        if self._is_stopping():
+            self.stopped = True
+            self._logger_bot.info("Channel %s pipeline stopped after %d uploaded messages", self._channel_name,
+                                  self.stats["uploaded"])
+            return
+        self._logger_bot.info("Channel %s pipeline finished: fetched %d (%.1f s), transformed %d (%.1f s), "
+                              "uploaded %d (%.1f s)", self._channel_name, self.stats["fetched"],
+                              self.stats["fetch_seconds"], self.stats["transformed"],
+                              self.stats["transform_seconds"], self.stats["uploaded"],
+                              self.stats["upload_seconds"])
+
+    def _run_stage(self, stage, output_queue: queue.Queue):
+        try:
+            stage()
+        except PipelineStopped:
+            pass
+        except Exception as err:
+            self._logger_bot.error("Channel %s pipeline stage failed: %s", self._channel_name, err)
+            self._errors.append(err)
+            self._stop.set()
+        finally:
+            self._put(output_queue, self._END, force=True)
+
+    def _fetch(self):
+        started = time.perf_counter()
+        for page in self._pages:
+            if self._prepare_message is None:
+                prepared_page = page
+            else:
+                prepared_page = []
+                for message in page:
+                    self._check_stopped()
+                    prepared_page.append(self._prepare_message(message))
+            self._count("fetched", len(prepared_page))
+            self.stats["fetch_seconds"] += time.perf_counter() - started
+            self._put(self._pages_queue, prepared_page)
+            started = time.perf_counter()
+
+    def _transform(self):
+        for page in self._iter_queue(self._pages_queue):
+            started = time.perf_counter()
+            loaded_page = [message for message in page if not message.get("load_failed")]
+            if self._transform_page is not None:
+                loaded_dicts = iter(self._transform_page(loaded_page))
+            else:
+                loaded_dicts = iter([self._transform_message(message) for message in loaded_page])
+            message_dicts = [self._FAILED if message.get("load_failed") else next(loaded_dicts) for message in page]
+            self.stats["transform_seconds"] += time.perf_counter() - started
+            for message, message_dict in zip(page, message_dicts):
+                if message_dict is self._FAILED:
+                    self._put(self._upload_queue, (message, message_dict))
+                    continue
+                if message_dict is not None and self._prefetch_message is not None:
+                    started = time.perf_counter()
+                    self._prefetch_message(message_dict)
+                    self.stats["transform_seconds"] += time.perf_counter() - started
+                self._count("transformed")
+                self._put(self._upload_queue, (message, message_dict))
+
+    def _upload(self):
+        for message, message_dict in self._iter_queue(self._upload_queue):
+            started = time.perf_counter()
+            delivered = message_dict is not self._FAILED
+            if message_dict is not None and delivered:
+                delivered = bool(self._upload_message(message_dict))
+                self._count("uploaded")
+            self._message_done(message, delivered)
+            self.stats["upload_seconds"] += time.perf_counter() - started
+
+    def _count(self, stage: str, count: int = 1):
+        self.stats[stage] += count
+        if self._metrics is not None:
+            self._metrics.count_messages(self._channel_name, stage, count)
+
+    def _iter_queue(self, input_queue: queue.Queue):
+        while True:
+            item = input_queue.get()
+            if item is self._END:
+                return
+            self._check_stopped()
+            yield item
+
+    def _put(self, output_queue: queue.Queue, item, force=False):
+        while True:
+            if self._is_stopping() and not force:
+                raise PipelineStopped()
+            try:
+                output_queue.put(item, timeout=self._PUT_TIMEOUT)
+                return
+            except queue.Full:
+                if force and self._is_stopping():
+                    # Nobody is draining this queue any more, make room for the end marker.
+                    try:
+                        output_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _check_stopped(self):
+        if self._is_stopping():
+            raise PipelineStopped()
+
+    def _is_stopping(self) -> bool:
+        return self._stop.is_set() or (self._stop_event is not None and self._stop_event.is_set())
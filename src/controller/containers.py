@@ -1,32 +1,82 @@
 from dependency_injector import containers, providers
+from src.business.checkpoint_writer import CheckpointWriter
 from src.business.config_service import ConfigService
 from src.business.messages_service import MessagesService
+from src.business.migration_metrics import MigrationMetrics
+from src.business.migration_job_manager import MigrationJobManager
+from src.controller.attachment_relay import AttachmentRelay
+from src.controller.http_cassette import HttpCassette
+from src.controller.mattermost_bulk_import import MattermostBulkImport
+from src.controller.mattermost_transport import MattermostTransport
 from src.controller.mattermost_upload_messages import MattermostUploadMessages
 from src.controller.mattermost_web_client import MattermostWebClient
 from src.controller.slack_load_messages import SlackLoadMessages
 from src.controller.slack_app_manager import SlackAppManager
+from src.controller.slack_async_load_messages import SlackAsyncLoadMessages
+from src.controller.slack_export_source import SlackExportSource
+from src.controller.shard_worker import ShardWorker
+from src.controller.slack_rate_limiter import SlackRateLimiter
 from src.controller.slack_web_client import SlackWebClient
+from src.repository.attachment_cache import AttachmentCache
+from src.repository.channel_lease_store import ChannelLeaseStore
+from src.repository.config_cache import ConfigCache
 from src.repository.config_repository import ConfigRepository
+from src.repository.state_store import StateStore
 
 
 class Containers(containers.DeclarativeContainer):
-    slack_web_client = providers.Singleton(SlackWebClient)
-    mattermost_web_client = providers.Singleton(MattermostWebClient)
+    state_store = providers.Singleton(StateStore)
+    channel_lease_store = providers.Singleton(ChannelLeaseStore)
+    config_repo = providers.Singleton(ConfigRepository)
+    config_cache = providers.Singleton(ConfigCache, config_repo=config_repo)
+    config_service = providers.Singleton(ConfigService, config_repo=config_repo, config_cache=config_cache)
+    checkpoint_writer = providers.Singleton(CheckpointWriter, config_service=config_service, state_store=state_store)
+    migration_metrics = providers.Singleton(MigrationMetrics, checkpoint_writer=checkpoint_writer)
+    http_cassette = providers.Singleton(HttpCassette)
+    slack_web_client = providers.Singleton(SlackWebClient, http_cassette=http_cassette)
+    slack_rate_limiter = providers.Singleton(SlackRateLimiter, migration_metrics=migration_metrics)
+    slack_async_load_messages = providers.Singleton(SlackAsyncLoadMessages, slack_rate_limiter=slack_rate_limiter,
+                                                    http_cassette=http_cassette)
+    slack_export_source = providers.Singleton(SlackExportSource)
+    mattermost_web_client = providers.Singleton(MattermostWebClient, http_cassette=http_cassette)
+    mattermost_transport = providers.Singleton(MattermostTransport, mattermost_web_client=mattermost_web_client,
+                                               migration_metrics=migration_metrics)
+    attachment_cache = providers.Singleton(AttachmentCache)
+    attachment_relay = providers.Singleton(AttachmentRelay, mattermost_transport=mattermost_transport,
+                                           attachment_cache=attachment_cache, http_cassette=http_cassette,
+                                           migration_metrics=migration_metrics)
     mattermost_upload_messages = providers.Singleton(MattermostUploadMessages,
-                                                     mattermost_web_client=mattermost_web_client)
+                                                     mattermost_transport=mattermost_transport,
+                                                     attachment_relay=attachment_relay,
+                                                     state_store=state_store)
 
-    config_repo = providers.Factory(ConfigRepository)
-    config_service = providers.Factory(ConfigService, config_repo=config_repo)
+    mattermost_bulk_import = providers.Singleton(MattermostBulkImport, attachment_relay=attachment_relay,
+                                                 config_service=config_service)
     messages_service = providers.Factory(MessagesService, config_service=config_service,
                                          mattermost_upload_messages=mattermost_upload_messages)
     slack_load_messages = providers.Factory(SlackLoadMessages, web_client=slack_web_client,
                                             config_service=config_service,
                                             messages_service=messages_service,
-                                            mattermost_upload_messages=mattermost_upload_messages)
+                                            mattermost_upload_messages=mattermost_upload_messages,
+                                            slack_async_load_messages=slack_async_load_messages,
+                                            slack_rate_limiter=slack_rate_limiter,
+                                            checkpoint_writer=checkpoint_writer,
+                                            state_store=state_store,
+                                            mattermost_bulk_import=mattermost_bulk_import,
+                                            slack_export_source=slack_export_source,
+                                            migration_metrics=migration_metrics)
+    migration_job_manager = providers.Singleton(MigrationJobManager, slack_load_messages=slack_load_messages,
+                                                mattermost_upload_messages=mattermost_upload_messages,
+                                                channel_lease_store=channel_lease_store)
+    shard_worker = providers.Factory(ShardWorker, slack_load_messages=slack_load_messages,
+                                     mattermost_upload_messages=mattermost_upload_messages,
+                                     channel_lease_store=channel_lease_store,
+                                     state_store=state_store,
+                                     slack_rate_limiter=slack_rate_limiter)
     slack_app_manager = providers.Factory(SlackAppManager,
                                           config_service=config_service,
-                                          slack_load_messages=slack_load_messages,
-                                          mattermost_upload_messages=mattermost_upload_messages)
+                                          migration_job_manager=migration_job_manager,
+                                          migration_metrics=migration_metrics)
 
 
 
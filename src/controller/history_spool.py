@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import time
+
+# Pages a history window should take: after a window of fewer the next one is twice as long, after one of
+# more it is half as long. Every window ends with a page that is not full, which costs calls in short windows.
+WINDOW_MIN_PAGES = 3
+WINDOW_MAX_PAGES = 8
+MIN_WINDOW_SECONDS = 60
+
+
+class HistorySpool:
+    """Keeps the history pages of one channel on disk to hand them on oldest first.
+
+    conversations.history answers newest first, so the pages are written to an
+    anonymous temporary file as they arrive and read back in reverse order, with
+    one page in memory at a time.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        # Offset and length of each page in the file, in the order they were added
+        self._pages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def append(self, messages: list):
+        data = json.dumps(messages).encode()
+        offset = self._file.seek(0, os.SEEK_END)
+        self._file.write(data)
+        self._pages.append((offset, len(data)))
+
+    def pages_oldest_first(self):
+        """Yields the pages in reverse order, each with its messages oldest first."""
+        for offset, length in reversed(self._pages):
+            self._file.seek(offset)
+            yield list(reversed(json.loads(self._file.read(length))))
+
+    def close(self):
+        self._file.close()
+
+
+def history_oldest_first(load_page, oldest: float, window_seconds=None):
+    """Yields the history pages of a channel after oldest, oldest page and message first.
+
+    load_page(oldest, latest, cursor) reads one conversations.history page, newest
+    first as Slack answers, and returns its messages and the next cursor, None for
+    the messages when the page could not be read; reading stops there. oldest and
+    latest are Slack ts strings, both exclusive, latest None for no upper bound.
+
+    Without window_seconds the whole history is a single window, all of it is read
+    before the first page is handed on. With it the history is read in consecutive
+    time windows starting at oldest, window_seconds long to begin with and then
+    adapted to the channel's traffic. Only the window being read has to be spooled,
+    so the pages of the earlier windows are already on their way meanwhile.
+    """
+    window_oldest = _to_micros(oldest)
+    window_micros = _to_micros(window_seconds) if window_seconds else None
+    while True:
+        window_latest = None
+        if window_micros is not None and window_oldest + window_micros < _to_micros(time.time()):
+            window_latest = window_oldest + window_micros
+        with HistorySpool() as spool:
+            cursor = None
+            while True:
+                messages, cursor = load_page(_to_ts(window_oldest),
+                                             _to_ts(window_latest) if window_latest is not None else None, cursor)
+                if messages is None:
+                    return
+                spool.append(messages)
+                if not cursor:
+                    break
+            yield from spool.pages_oldest_first()
+            pages = len(spool)
+
+        if window_latest is None:
+            return
+        # latest is exclusive, a message at exactly window_latest belongs to the next window
+        window_oldest = window_latest - 1
+        if pages < WINDOW_MIN_PAGES:
+            window_micros *= 2
+        elif pages > WINDOW_MAX_PAGES:
+            window_micros = max(window_micros // 2, _to_micros(MIN_WINDOW_SECONDS))
+
+
+def _to_micros(seconds: float) -> int:
+    return round(seconds * 1000000)
+
+
+def _to_ts(micros: int) -> str:
+    return f"{micros // 1000000}.{micros % 1000000:06d}"
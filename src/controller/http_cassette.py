@@ -0,0 +1,347 @@
+import asyncio
+import atexit
+import base64
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from slack_sdk import WebClient
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+from slack_sdk.web.async_slack_response import AsyncSlackResponse
+from slack_sdk.web.slack_response import SlackResponse
+
+from src.util.settings_parser import SettingsParser
+
+
+class HttpCassette:
+    """Records the Slack and Mattermost HTTP traffic of a run and serves it back.
+
+    In record mode every Slack Web API call, Mattermost request and Slack file
+    download is appended with its timing to a gzip compressed JSON lines file.
+    Only rate limit related response headers are kept, tokens, passwords and
+    secrets are scrubbed, and Slack file downloads and other binary bodies are
+    stored by size only.
+
+    In replay mode nothing goes to the network: each request gets the recorded
+    response with the same method, URL and body, or the next recorded one for
+    the same method and URL, after its recorded duration divided by
+    http_cassette_speed (0 answers at once). Requests the cassette does not hold
+    are answered with 404 and logged.
+    """
+
+    OFF = "off"
+    RECORD = "record"
+    REPLAY = "replay"
+    FORMAT_VERSION = 1
+    KEPT_HEADERS = ("content-type", "content-length", "retry-after", "x-ratelimit-limit", "x-ratelimit-remaining",
+                    "x-ratelimit-reset")
+    SECRET_KEYS = frozenset(("token", "access_token", "refresh_token", "password", "client_secret", "secret",
+                             "signing_secret", "auth_data"))
+    SECRET_PATTERN = re.compile(r"\b(xox[a-z]|xapp)-[0-9A-Za-z-]+")
+    FLUSH_ENTRIES = 100
+
+    def __init__(self):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self.mode = settings.http_cassette_mode
+        self._file_name = settings.http_cassette_file
+        self._speed = settings.http_cassette_speed
+        self._lock = threading.Lock()
+        self._file = None
+        self._entries = 0
+        self._started = time.monotonic()
+        self._by_request = None
+        self._by_url = None
+        self._misses = 0
+        if self.mode == self.RECORD:
+            atexit.register(self.close)
+
+    def create_slack_client(self, token: str, base_url: str) -> WebClient:
+        if self.mode == self.OFF:
+            return WebClient(token, base_url=base_url)
+        return CassetteWebClient(self, token=token, base_url=base_url)
+
+    def create_async_slack_client(self, token: str, base_url: str, session) -> AsyncWebClient:
+        if self.mode == self.OFF:
+            return AsyncWebClient(token=token, base_url=base_url, session=session)
+        return CassetteAsyncWebClient(self, token=token, base_url=base_url, session=session)
+
+    def mount(self, session, service: str):
+        """Routes the requests of a requests session through the cassette."""
+        if self.mode == self.OFF:
+            return
+        for prefix, adapter in list(session.adapters.items()):
+            session.mount(prefix, CassetteAdapter(self, service, adapter))
+
+    def record(self, service: str, method: str, url: str, request_digest: str, started: float, status: int,
+               headers, body=None, size=None):
+        entry = {"at": round(started - self._started, 6), "seconds": round(time.monotonic() - started, 6),
+                 "service": service, "method": method, "url": self._scrub_text(url), "request": request_digest,
+                 "status": status,
+                 "headers": {name: value for name, value in ((name.lower(), value) for name, value in headers.items())
+                             if name in self.KEPT_HEADERS}}
+        if isinstance(body, (dict, list)):
+            entry["json"] = self._scrub(body)
+        elif isinstance(body, str):
+            entry["text"] = self._scrub_text(body)
+        elif body is not None:
+            entry["base64"] = base64.b64encode(body).decode()
+        else:
+            entry["size"] = size
+        line = (json.dumps(entry, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self._file_name) or ".", exist_ok=True)
+                self._file = gzip.open(self._file_name, "wb")
+                self._file.write((json.dumps({"cassette": self.FORMAT_VERSION}) + "\n").encode())
+                self._logger_bot.info("Recording HTTP traffic to %s", self._file_name)
+            self._file.write(line)
+            self._entries += 1
+            if self._entries % self.FLUSH_ENTRIES == 0:
+                # A run that is killed still leaves a readable cassette
+                self._file.flush()
+
+    def replay(self, service: str, method: str, url: str, request_digest: str):
+        """Returns the recorded entry for the request and the seconds to wait before answering, or (None, 0)."""
+        url = self._scrub_text(url)
+        with self._lock:
+            if self._by_request is None:
+                self._load()
+            entry = self._take(self._by_request.get((service, method, url, request_digest)))
+            if entry is None:
+                entry = self._take(self._by_url.get((service, method, url)))
+            if entry is None:
+                self._misses += 1
+                self._logger_bot.warning("%s %s %s is not in the cassette (%d missed)", service, method, url,
+                                         self._misses)
+                return None, 0
+            entry["used"] = True
+        return entry, entry["seconds"] / self._speed if self._speed > 0 else 0
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self._logger_bot.info("HTTP cassette %s written (%d requests)", self._file_name, self._entries)
+
+    def request_digest(self, body) -> str:
+        """Digest of a request body or of Slack API arguments, secrets left out."""
+        if body is None or body == b"" or body == "":
+            return ""
+        if isinstance(body, (bytes, str)):
+            try:
+                body = json.loads(body)
+            except ValueError:
+                return hashlib.sha1(body.encode() if isinstance(body, str) else body).hexdigest()
+        elif not isinstance(body, (dict, list)):
+            # Streamed uploads are matched by URL only
+            return ""
+        canonical = json.dumps(self._scrub(body), sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha1(canonical.encode()).hexdigest()
+
+    def _load(self):
+        self._by_request = {}
+        self._by_url = {}
+        count = 0
+        try:
+            with gzip.open(self._file_name, "rb") as cassette:
+                cassette.readline()
+                for line in cassette:
+                    entry = json.loads(line)
+                    self._by_request.setdefault((entry["service"], entry["method"], entry["url"], entry["request"]),
+                                                deque()).append(entry)
+                    self._by_url.setdefault((entry["service"], entry["method"], entry["url"]), deque()).append(entry)
+                    count += 1
+        except OSError as err:
+            self._logger_bot.error(f"HTTP cassette {self._file_name} can not be read: {err}")
+        except (EOFError, zlib.error, ValueError) as err:
+            # The end of a cassette whose recording was killed is cut off
+            self._logger_bot.error(f"HTTP cassette {self._file_name} is truncated after {count} requests: {err}")
+        self._logger_bot.info("Replaying %d requests from %s at speed %s", count, self._file_name, self._speed)
+
+    @staticmethod
+    def _take(entries):
+        while entries:
+            entry = entries.popleft()
+            if not entry.get("used"):
+                return entry
+        return None
+
+    def _scrub(self, value):
+        if isinstance(value, dict):
+            return {key: "REDACTED" if key.lower() in self.SECRET_KEYS else self._scrub(item)
+                    for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._scrub(item) for item in value]
+        if isinstance(value, str):
+            return self._scrub_text(value)
+        return value
+
+    def _scrub_text(self, text: str) -> str:
+        return self.SECRET_PATTERN.sub(r"\1-REDACTED", text)
+
+    def url_key(self, url: str) -> str:
+        """Path and query of a URL, so a cassette replays against any host; secret parameters are dropped."""
+        parts = urlsplit(url)
+        query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                 if name.lower() not in self.SECRET_KEYS]
+        return parts.path + ("?" + urlencode(sorted(query)) if query else "")
+
+    @staticmethod
+    def slack_arguments(params, data, json_body) -> dict:
+        arguments = {}
+        for source in (params, data, json_body):
+            if isinstance(source, dict):
+                arguments.update((name, value) for name, value in source.items() if value is not None)
+        return arguments
+
+
+class CassetteWebClient(WebClient):
+    """Slack WebClient whose API calls are recorded to or replayed from the cassette."""
+
+    def __init__(self, cassette: HttpCassette, **kwargs):
+        super().__init__(**kwargs)
+        self._cassette = cassette
+
+    def api_call(self, api_method: str, *, http_verb: str = "POST", files=None, data=None, params=None, json=None,
+                 headers=None, auth=None) -> SlackResponse:
+        arguments = self._cassette.slack_arguments(params, data, json)
+        digest = self._cassette.request_digest(arguments)
+        if self._cassette.mode == HttpCassette.REPLAY:
+            entry, delay = self._cassette.replay("slack", http_verb, api_method, digest)
+            if delay:
+                time.sleep(delay)
+            return _slack_response(SlackResponse, self, http_verb, api_method, arguments, entry).validate()
+
+        started = time.monotonic()
+        try:
+            response = super().api_call(api_method, http_verb=http_verb, files=files, data=data, params=params,
+                                        json=json, headers=headers, auth=auth)
+        except SlackApiError as err:
+            self._cassette.record("slack", http_verb, api_method, digest, started, err.response.status_code,
+                                  err.response.headers, err.response.data)
+            raise
+        self._cassette.record("slack", http_verb, api_method, digest, started, response.status_code,
+                              response.headers, response.data)
+        return response
+
+
+class CassetteAsyncWebClient(AsyncWebClient):
+    """Slack AsyncWebClient whose API calls are recorded to or replayed from the cassette."""
+
+    def __init__(self, cassette: HttpCassette, **kwargs):
+        super().__init__(**kwargs)
+        self._cassette = cassette
+
+    async def api_call(self, api_method: str, *, http_verb: str = "POST", files=None, data=None, params=None,
+                       json=None, headers=None, auth=None) -> AsyncSlackResponse:
+        arguments = self._cassette.slack_arguments(params, data, json)
+        digest = self._cassette.request_digest(arguments)
+        if self._cassette.mode == HttpCassette.REPLAY:
+            entry, delay = self._cassette.replay("slack", http_verb, api_method, digest)
+            if delay:
+                await asyncio.sleep(delay)
+            return _slack_response(AsyncSlackResponse, self, http_verb, api_method, arguments, entry).validate()
+
+        started = time.monotonic()
+        try:
+            response = await super().api_call(api_method, http_verb=http_verb, files=files, data=data,
+                                              params=params, json=json, headers=headers, auth=auth)
+        except SlackApiError as err:
+            self._cassette.record("slack", http_verb, api_method, digest, started, err.response.status_code,
+                                  err.response.headers, err.response.data)
+            raise
+        self._cassette.record("slack", http_verb, api_method, digest, started, response.status_code,
+                              response.headers, response.data)
+        return response
+
+
+def _slack_response(response_class, client, http_verb: str, api_method: str, arguments: dict, entry):
+    if entry is None:
+        return response_class(client=client, http_verb=http_verb, api_url=api_method, req_args=arguments,
+                              data={"ok": False, "error": "not_in_cassette"}, headers={}, status_code=404)
+    return response_class(client=client, http_verb=http_verb, api_url=api_method, req_args=arguments,
+                          data=entry.get("json", {}), headers=dict(entry["headers"]), status_code=entry["status"])
+
+
+class CassetteAdapter(BaseAdapter):
+    """requests transport adapter that records to or replays from the cassette around another adapter."""
+
+    TEXT_TYPES = ("application/json", "text/")
+    # Whatever their content type, file contents are neither read nor stored
+    SIZE_ONLY_SERVICES = frozenset(("slack_files",))
+
+    def __init__(self, cassette: HttpCassette, service: str, adapter: BaseAdapter):
+        super().__init__()
+        self._cassette = cassette
+        self._service = service
+        self._adapter = adapter
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = self._cassette.url_key(request.url)
+        digest = self._cassette.request_digest(request.body)
+        if self._cassette.mode == HttpCassette.REPLAY:
+            entry, delay = self._cassette.replay(self._service, request.method, url, digest)
+            if delay:
+                time.sleep(delay)
+            return self._build_response(request, entry)
+
+        started = time.monotonic()
+        response = self._adapter.send(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                      proxies=proxies)
+        if self._service not in self.SIZE_ONLY_SERVICES and \
+                response.headers.get("Content-Type", "").startswith(self.TEXT_TYPES):
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text
+            self._cassette.record(self._service, request.method, url, digest, started, response.status_code,
+                                  response.headers, body)
+        else:
+            # Files are left streaming, only their size is kept
+            self._cassette.record(self._service, request.method, url, digest, started, response.status_code,
+                                  response.headers, size=int(response.headers.get("Content-Length") or 0))
+        return response
+
+    def close(self):
+        self._adapter.close()
+
+    @staticmethod
+    def _build_response(request, entry) -> Response:
+        response = Response()
+        response.request = request
+        response.url = request.url
+        if entry is None:
+            response.status_code = 404
+            body = b'{"message": "not in cassette"}'
+            response.headers = CaseInsensitiveDict({"Content-Type": "application/json"})
+        else:
+            response.status_code = entry["status"]
+            response.headers = CaseInsensitiveDict(entry["headers"])
+            if "json" in entry:
+                body = json.dumps(entry["json"]).encode()
+            elif "text" in entry:
+                body = entry["text"].encode()
+            elif "base64" in entry:
+                body = base64.b64decode(entry["base64"])
+            else:
+                body = b"\0" * entry.get("size", 0)
+        response.headers["Content-Length"] = str(len(body))
+        response.encoding = "utf-8"
+        response.raw = io.BytesIO(body)
+        return response
@@ -1,3 +1,4 @@
+import signal
 import sys
 
 from src.controller.containers import Containers
@@ -15,6 +16,9 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 logger_bot = logging.getLogger(__name__)
 
 
+# Docker stops the container with SIGTERM, exit normally so pending checkpoints are flushed
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
 containers = Containers()
 app_manager = containers.slack_app_manager()
 app_manager.run()
\ No newline at end of file
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import zipfile
+
+from src.entity.message_record import MessageRecord
+from src.util.settings_parser import SettingsParser
+
+
+class MattermostBulkImport:
+    """Writes the migrated messages as a Mattermost bulk import archive for `mmctl import`.
+
+    Stands in for MattermostUploadMessages in the channel pipeline. Teams, channels
+    and users are written when the export opens, every message is appended to a
+    JSONL file as it arrives and its files are downloaded to disk and copied into
+    the archive, so memory does not grow with the size of the workspace. Only the
+    copy holds the archive, downloads of the channel workers run in parallel.
+    mmctl wants users before posts and direct messages after all channel posts, so
+    authors missing from the users list get their user line as they are seen and
+    posts and direct posts are kept in files of their own until close, which
+    appends them and puts import.jsonl into the archive next to data/. Messages
+    and replies of excluded users are left out, as MessagesService does for the
+    REST sink.
+    """
+
+    VERSION = 1
+    ATTACHMENTS_DIR = "bulk-export-attachments"
+    CHANNEL_TYPES = {"public": "O", "private": "P"}
+    UNSAFE_PATH_PATTERN = re.compile(r"[/\\]|\.\.")
+
+    def __init__(self, attachment_relay, config_service):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._attachment_relay = attachment_relay
+        self._config_service = config_service
+        self._team_name = settings.mattermost_team_name
+        self._export_dir = settings.bulk_import_dir
+        self._jsonl_path = os.path.join(self._export_dir, "import.jsonl")
+        self._posts_jsonl_path = os.path.join(self._export_dir, "posts.jsonl")
+        self._direct_jsonl_path = os.path.join(self._export_dir, "direct_posts.jsonl")
+        self._archive_path = os.path.join(self._export_dir, "import.zip")
+        self._lock = threading.Lock()
+        self._archive_lock = threading.Lock()
+        self._jsonl = None
+        self._posts_jsonl = None
+        self._direct_jsonl = None
+        self._archive = None
+        self._users = {}
+        self._user_channels = {}
+        self._written_users = set()
+        self._direct_channels = set()
+        self._counters = {}
+
+    def open(self, channels: list, users: dict):
+        """Starts a new export with the selected Slack channels and the Slack users by id."""
+        os.makedirs(self._export_dir, exist_ok=True)
+        self._users = users
+        self._direct_channels = set()
+        self._written_users = set()
+        self._counters = {"users": 0, "posts": 0, "direct_posts": 0, "attachments": 0}
+        self._jsonl = open(self._jsonl_path, "w", encoding="utf-8")
+        self._posts_jsonl = open(self._posts_jsonl_path, "w+", encoding="utf-8")
+        self._direct_jsonl = open(self._direct_jsonl_path, "w+", encoding="utf-8")
+        self._archive = zipfile.ZipFile(self._archive_path, "w", compression=zipfile.ZIP_DEFLATED)
+
+        self._write(self._jsonl, {"type": "version", "version": self.VERSION})
+        self._write(self._jsonl, {"type": "team", "team": {"name": self._team_name,
+                                                          "display_name": self._team_name, "type": "O"}})
+        self._user_channels = {}
+        for channel in channels:
+            if channel["type"] not in self.CHANNEL_TYPES:
+                continue
+            self._write(self._jsonl, {"type": "channel", "channel": {
+                "team": self._team_name, "name": channel["name"], "display_name": channel["name"],
+                "type": self.CHANNEL_TYPES[channel["type"]]}})
+            for member in channel.get("members", ()):
+                self._user_channels.setdefault(member, []).append({"name": channel["name"]})
+
+        for user_id in users:
+            if self._is_allowed_author(user_id):
+                self._write_user(user_id)
+        self._logger_bot.info("Bulk import export started in %s", self._export_dir)
+
+    def close(self) -> str:
+        """Completes the archive and returns its path."""
+        with self._lock:
+            self._posts_jsonl.seek(0)
+            shutil.copyfileobj(self._posts_jsonl, self._jsonl)
+            self._posts_jsonl.close()
+            for members in sorted(self._direct_channels):
+                self._write(self._jsonl, {"type": "direct_channel", "direct_channel": {"members": list(members)}})
+            self._direct_jsonl.seek(0)
+            shutil.copyfileobj(self._direct_jsonl, self._jsonl)
+            self._direct_jsonl.close()
+            self._jsonl.close()
+            os.remove(self._posts_jsonl_path)
+            os.remove(self._direct_jsonl_path)
+        with self._archive_lock:
+            self._archive.write(self._jsonl_path, "import.jsonl")
+            self._archive.close()
+        os.remove(self._jsonl_path)
+        self._logger_bot.info("Bulk import archive %s written: %s", self._archive_path, self._counters)
+        return self._archive_path
+
+    def reconcile_channel(self, slack_channel_id: str, channel_name: str):
+        pass
+
+    def is_delivered(self, slack_channel_id: str, slack_ts: str) -> bool:
+        return False
+
+    def get_delivered(self, slack_channel_id: str, slack_ts_list: list) -> set:
+        return set()
+
+    def prefetch_files(self, message_data: MessageRecord):
+        pass
+
+    def upload_messages(self, message_data: MessageRecord) -> bool:
+        channel = message_data.channel
+        if not self._is_allowed_author(message_data.user.user_id):
+            return True
+        reply_messages = [reply_message for reply_message in message_data.reply
+                          if self._is_allowed_author(reply_message.user.user_id)]
+        post = self._post(message_data)
+        post["replies"] = [self._post(reply_message) for reply_message in reply_messages]
+        user_ids = [message_data.user.user_id] + [reply_message.user.user_id for reply_message in reply_messages]
+
+        if channel.channel_type == "direct":
+            member_ids = sorted(channel.channel_members or ())
+            members = tuple(sorted(self._username(member) for member in member_ids))
+            if len(members) < 2:
+                self._logger_bot.error("Direct channel %s has less than two members", channel.channel_id)
+                return False
+            post["channel_members"] = list(members)
+            with self._lock:
+                self._write_users(user_ids + member_ids)
+                self._direct_channels.add(members)
+                self._write(self._direct_jsonl, {"type": "direct_post", "direct_post": post})
+                self._counters["direct_posts"] += 1
+        else:
+            post["team"] = self._team_name
+            post["channel"] = channel.channel_name
+            with self._lock:
+                self._write_users(user_ids)
+                self._write(self._posts_jsonl, {"type": "post", "post": post})
+                self._counters["posts"] += 1
+        return True
+
+    def _post(self, message_data) -> dict:
+        post = {"user": self._username(message_data.user.user_id),
+                "message": message_data.text,
+                "create_at": int(float(message_data.ts) * 1000),
+                # Lets a later REST sync recognise imported posts, see MattermostUploadMessages.reconcile_channel
+                "props": {"slack_user_id": message_data.user.user_id,
+                          "slack_channel_id": message_data.channel.channel_id,
+                          "slack_ts": message_data.ts}}
+        attachments = [self._add_attachment(file) for file in message_data.files or []]
+        attachments = [attachment for attachment in attachments if attachment is not None]
+        if attachments:
+            post["attachments"] = attachments
+        return post
+
+    def _add_attachment(self, file: dict):
+        # Slack file names are user input, they must not reach outside the attachments folder
+        file_name = self.UNSAFE_PATH_PATTERN.sub("_", f'{file["file_id"]}_{file["file_name"]}')
+        path = f"{self.ATTACHMENTS_DIR}/{file_name}"
+        # Downloaded before the archive is locked, so the channel workers fetch their files in parallel
+        source = self._attachment_relay.fetch(file)
+        if source is None:
+            # The post is imported without it
+            return None
+        with source, self._archive_lock:
+            with self._archive.open(f"data/{path}", "w", force_zip64=True) as target:
+                self._attachment_relay.copy_to(source, target)
+            self._counters["attachments"] += 1
+        return {"path": path}
+
+    def _is_allowed_author(self, user_id: str) -> bool:
+        return self._config_service.is_allowed_user(self._users.get(user_id, {}).get("name"))
+
+    def _write_users(self, user_ids: list):
+        """Writes the user lines of the authors not written yet, e.g. users missing from the Slack users list."""
+        for user_id in user_ids:
+            if user_id not in self._written_users:
+                self._write_user(user_id)
+
+    def _write_user(self, user_id: str):
+        user = self._users.get(user_id, {})
+        self._write(self._jsonl, {"type": "user", "user": {
+            "username": self._username(user_id), "email": self._email(user_id),
+            "nickname": user.get("display_name") or "", "first_name": user.get("first_name") or "",
+            "last_name": user.get("last_name") or "",
+            "teams": [{"name": self._team_name, "channels": self._user_channels.get(user_id, [])}]}})
+        self._written_users.add(user_id)
+        self._counters["users"] += 1
+
+    def _username(self, user_id: str) -> str:
+        return (self._users.get(user_id, {}).get("name") or user_id).lower()
+
+    def _email(self, user_id: str) -> str:
+        return self._users.get(user_id, {}).get("email") or f"{self._username(user_id)}@slack-import.invalid"
+
+    @staticmethod
+    def _write(target, line: dict):
+        target.write(json.dumps(line, ensure_ascii=False))
+        target.write("\n")
@@ -0,0 +1,39 @@
+class MattermostChannelRegistry:
+    """Mattermost channels indexed by id and by name, with members kept as sets of user ids."""
+
+    def __init__(self, channels=None):
+        self._channels_by_id = {}
+        self._channels_by_name = {}
+        self._members = {}
+        if channels:
+            self.extend(channels)
+
+    def add(self, channel: dict):
+        self._channels_by_id[channel["id"]] = channel
+        self._channels_by_name[channel["name"]] = channel
+        self._members.setdefault(channel["id"], set())
+
+    def extend(self, channels):
+        for channel in channels:
+            self.add(channel)
+
+    def get(self, channel_id: str):
+        return self._channels_by_id.get(channel_id)
+
+    def get_by_name(self, channel_name: str):
+        return self._channels_by_name.get(channel_name)
+
+    def set_members(self, channel_id: str, members):
+        self._members[channel_id] = set(members)
+
+    def add_member(self, channel_id: str, user_id: str):
+        self._members.setdefault(channel_id, set()).add(user_id)
+
+    def is_member(self, channel_id: str, user_id: str) -> bool:
+        return user_id in self._members.get(channel_id, ())
+
+    def __len__(self):
+        return len(self._channels_by_id)
+
+    def __iter__(self):
+        return iter(self._channels_by_id.values())
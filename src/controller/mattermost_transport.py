@@ -0,0 +1,157 @@
+import logging
+import random
+import threading
+import time
+
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+
+from src.util.settings_parser import SettingsParser
+
+
+class MattermostTransport:
+    """Sends Mattermost API requests through MattermostWebClient.mattermost_session.
+
+    Requests are paced from the X-RateLimit-Remaining / X-RateLimit-Reset headers
+    so the server limit is spread over its window instead of being hit. 429
+    answers and failed connections are retried with jittered backoff, and so are
+    5xx answers and read timeouts of idempotent requests; a POST may have been
+    carried out before they happened and is not sent twice. Every request carries
+    connect and read timeouts, and every attempt is reported to the migration
+    metrics.
+    """
+
+    RATE_LIMITED_STATUS_CODE = 429
+    SERVER_ERROR_STATUS_CODE = 500
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    def __init__(self, mattermost_web_client, migration_metrics):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._metrics = migration_metrics
+        self._session = mattermost_web_client.mattermost_session
+        self._url = mattermost_web_client.mattermost_url
+        self._timeout = (settings.mattermost_connect_timeout, settings.mattermost_read_timeout)
+        self._max_retries = settings.mattermost_max_retries
+        self._backoff_base = 0.5
+        self._backoff_max = 30.0
+        self._lock = threading.Lock()
+        self._remaining = None
+        self._reset_at = 0.0
+        self._next_request_at = 0.0
+        self._counters = {"requests": 0, "retries": 0, "rate_limited": 0, "server_errors": 0,
+                          "connection_errors": 0, "failed": 0, "paced_seconds": 0.0}
+
+    def get(self, path: str, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def request(self, method: str, path: str, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        endpoint = self._metrics.mattermost_endpoint(method, path)
+        retry_count = 0
+        while True:
+            self._pace()
+            self._rewind_files(kwargs)
+            self._count("requests")
+            started = time.monotonic()
+            try:
+                response = self._session.request(method, self._url + path, **kwargs)
+            except (ConnectTimeout, ReadTimeout, ConnectionError) as err:
+                self._metrics.observe_api_call("mattermost", endpoint, "error", time.monotonic() - started)
+                self._count("connection_errors")
+                # The request may have reached the server, only resend when that is harmless
+                may_resend = method in self.IDEMPOTENT_METHODS or isinstance(err, ConnectTimeout)
+                if not may_resend or retry_count >= self._max_retries or not self._is_replayable(kwargs):
+                    self._count("failed")
+                    raise
+                self._retry_wait(method, path, retry_count, f"{type(err).__name__}")
+                retry_count += 1
+                continue
+
+            self._metrics.observe_api_call("mattermost", endpoint, response.status_code, time.monotonic() - started)
+            self._update_limits(response)
+            if response.status_code == self.RATE_LIMITED_STATUS_CODE:
+                self._count("rate_limited")
+                self._metrics.count_rate_limited("mattermost", endpoint)
+            elif response.status_code >= self.SERVER_ERROR_STATUS_CODE:
+                self._count("server_errors")
+            else:
+                return response
+
+            # A 5xx, e.g. a proxy timing out, can come after the server carried the request out
+            may_resend = response.status_code == self.RATE_LIMITED_STATUS_CODE or method in self.IDEMPOTENT_METHODS
+            if not may_resend or retry_count >= self._max_retries or not self._is_replayable(kwargs):
+                self._count("failed")
+                return response
+            self._retry_wait(method, path, retry_count, f"status {response.status_code}",
+                             retry_after=response.headers.get("Retry-After"))
+            retry_count += 1
+
+    def get_counters(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+    def _pace(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_request_at - now
+            if self._remaining is not None and self._reset_at > now:
+                # Spread what is left of the window evenly over the time until it resets
+                interval = (self._reset_at - now) / max(self._remaining, 1)
+                self._next_request_at = max(self._next_request_at, now) + interval
+                self._remaining = max(self._remaining - 1, 0)
+            if wait > 0:
+                self._counters["paced_seconds"] += wait
+        if wait > 0:
+            time.sleep(wait)
+
+    def _update_limits(self, response):
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = int(remaining)
+            reset_at = time.monotonic() + float(reset)
+        except ValueError:
+            return
+        with self._lock:
+            self._remaining = remaining
+            self._reset_at = reset_at
+            if remaining == 0:
+                self._next_request_at = max(self._next_request_at, reset_at)
+
+    def _retry_wait(self, method: str, path: str, retry_count: int, reason: str, retry_after=None):
+        delay = min(self._backoff_max, self._backoff_base * 2 ** retry_count)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        self._count("retries")
+        self._metrics.count_retry("mattermost", self._metrics.mattermost_endpoint(method, path))
+        self._logger_bot.info("Mattermost API %s %s failed (%s), retrying in %.1f s. %d times repeated",
+                              method, path, reason, delay, retry_count + 1)
+        time.sleep(delay)
+
+    def _count(self, counter: str):
+        with self._lock:
+            self._counters[counter] += 1
+
+    @staticmethod
+    def _is_replayable(kwargs: dict) -> bool:
+        data = kwargs.get("data")
+        return data is None or isinstance(data, (bytes, str, dict, list, tuple)) or hasattr(data, "seek")
+
+    @staticmethod
+    def _rewind_files(kwargs: dict):
+        if hasattr(kwargs.get("data"), "seek"):
+            kwargs["data"].seek(0)
+        for file_item in (kwargs.get("files") or {}).values():
+            file_object = file_item[1] if isinstance(file_item, tuple) else file_item
+            if hasattr(file_object, "seek"):
+                file_object.seek(0)
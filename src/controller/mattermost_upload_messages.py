@@ -1,17 +1,32 @@
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from requests import HTTPError
 
+from src.controller.mattermost_channel_registry import MattermostChannelRegistry
+from src.controller.mattermost_user_directory import MattermostUserDirectory
+from src.entity.message_record import ChannelInfo, MessageRecord, UserProfile
+from src.util.settings_parser import SettingsParser
+
 
 class MattermostUploadMessages:
-    def __init__(self, mattermost_web_client):
-        self._channels_list = []
-        self._users_list = []
+    def __init__(self, mattermost_transport, attachment_relay, state_store):
+        settings = SettingsParser()
+
+        self._channel_registry = MattermostChannelRegistry()
+        self._user_directory = MattermostUserDirectory()
         self._channel_filter = []
         self._team_id = None
         self._logger_bot = logging.getLogger("")
-        self._mm_web_client = mattermost_web_client
+        self._mm_transport = mattermost_transport
+        self._attachment_relay = attachment_relay
+        self._attachment_executor = ThreadPoolExecutor(max_workers=settings.attachment_workers,
+                                                       thread_name_prefix="attachment")
+        self._state_store = state_store
         self._messages_per_page = 100
+        # Guards the users/channels caches and their find-or-create paths shared by channel workers
+        self._lock = threading.RLock()
 
     def load_users(self):
         response = ''
@@ -19,22 +34,20 @@ class MattermostUploadMessages:
             "page": 0,
             "per_page": self._messages_per_page
         }
-        self._users_list = []
+        self._user_directory = MattermostUserDirectory()
         try:
             while True:
-                response = self._mm_web_client.mattermost_session.get(
-                    f'{self._mm_web_client.mattermost_url}/users',
-                    params=params)
+                response = self._mm_transport.get('/users', params=params)
                 response.raise_for_status()
                 users = response.json()
 
                 if not users:
                     break
 
-                self._users_list.extend(users)
+                self._user_directory.extend(users)
                 params["page"] += 1
 
-            self._logger_bot.info("Mattermost users loaded (%d)", len(self._users_list))
+            self._logger_bot.info("Mattermost users loaded (%d)", len(self._user_directory))
 
         except HTTPError:
             self._logger_bot.error(
@@ -46,13 +59,10 @@ class MattermostUploadMessages:
             "page": 0,
             "per_page": self._messages_per_page
         }
-        self._channels_list = []
         channels_list = []
         try:
             while True:
-                response = self._mm_web_client.mattermost_session.get(
-                    f'{self._mm_web_client.mattermost_url}/channels',
-                    params=params)
+                response = self._mm_transport.get('/channels', params=params)
                 response.raise_for_status()
                 channels = response.json()
 
@@ -73,168 +83,258 @@ class MattermostUploadMessages:
             self._logger_bot.error(
                 f'Mattermost API Error (channels). Status code: {response.status_code} Response:{response.text}')
 
-    def upload_messages(self, message_data):
-        channel_id = self._get_channel_by_name(message_data["channel"])
-        user_data = message_data["user"]
-        user_id = self._get_user_by_email(user_data)
-        if not self._is_user_in_channel(user_id=user_id, channel_id=channel_id) and \
-                message_data["user"]["user_id"] in message_data["channel"]["channel_members"]:
-            self._add_user_to_channel(user_id=user_id, channel_id=channel_id)
+    def reconcile_channel(self, slack_channel_id: str, channel_name: str):
+        """Records posts that reached Mattermost but not the state store, e.g. before a crash.
+
+        Posts are walked newest first until one that is already recorded, so only the tail
+        written after the last state flush is read.
+        """
+        channel_id = self._state_store.get_mm_channel_id(slack_channel_id)
+        if channel_id is None:
+            channel = self._channel_registry.get_by_name(channel_name)
+            if channel is None:
+                return
+            channel_id = channel["id"]
+
+        response = ''
+        params = {
+            "page": 0,
+            "per_page": self._messages_per_page
+        }
+        recovered = 0
+        try:
+            while True:
+                response = self._mm_transport.get(f'/channels/{channel_id}/posts', params=params)
+                response.raise_for_status()
+                post_list = response.json()
+                if not post_list["order"]:
+                    break
+
+                for post_id in post_list["order"]:
+                    props = post_list["posts"][post_id].get("props") or {}
+                    slack_ts = props.get("slack_ts")
+                    if not slack_ts or props.get("slack_channel_id") != slack_channel_id:
+                        continue
+                    if self._state_store.get_post_id(slack_channel_id, slack_ts) is not None:
+                        break
+                    self._state_store.set_post_id(slack_channel_id, slack_ts, post_id)
+                    recovered += 1
+                else:
+                    params["page"] += 1
+                    continue
+                break
+
+            if recovered:
+                self._logger_bot.info("Recovered %d posts of channel %s already in Mattermost", recovered,
+                                      channel_name)
+        except HTTPError:
+            self._logger_bot.error(
+                f'Mattermost API Error (channels/posts). Status code: {response.status_code} '
+                f'Response:{response.text}')
 
+    def is_delivered(self, slack_channel_id: str, slack_ts: str) -> bool:
+        return self._state_store.get_post_id(slack_channel_id, slack_ts) is not None
+
+    def get_delivered(self, slack_channel_id: str, slack_ts_list: list) -> set:
+        """Returns the ts of the list that is_delivered is true for, in one lookup."""
+        return self._state_store.get_posted_ts(slack_channel_id, slack_ts_list)
+
+    def prefetch_files(self, message_data: MessageRecord):
+        """Starts copying the files of a message and its replies before the message is posted.
+
+        The transfers run on the attachment workers, _upload_files then only collects their results.
+        """
+        channel_id = self._get_channel_by_name(message_data.channel)
         if channel_id is None:
-            self._logger_bot.error("Channel %s did`nt find in Mattermost", message_data["channel"]["channel_name"])
             return
+        items = [message_data]
+        if message_data.is_thread:
+            items.extend(message_data.reply)
+        for item in items:
+            if item.files and not self.is_delivered(item.channel.channel_id, item.ts):
+                for file in item.files:
+                    self._start_file_transfer(file, channel_id=channel_id)
+
+    def upload_messages(self, message_data: MessageRecord) -> bool:
+        """Posts a message and its thread, skipping whatever the state store marks as delivered.
+
+        Returns True once the message and all of its replies are in Mattermost.
+        """
+        channel_id = self._get_channel_by_name(message_data.channel)
+        user_data = message_data.user
+        user_id = self._get_user_by_email(user_data)
+        if message_data.user.user_id in message_data.channel.channel_members:
+            self._ensure_user_in_channel(user_id=user_id, channel_id=channel_id)
 
-        for mention in message_data["users_in_mentions"]:
+        if channel_id is None:
+            self._logger_bot.error("Channel %s did`nt find in Mattermost", message_data.channel.channel_name)
+            return False
+
+        for mention in message_data.users_in_mentions:
             user_mention_id = self._get_user_by_email(mention)
-            if not self._is_user_in_channel(user_id=user_mention_id, channel_id=channel_id) and \
-                    mention in message_data["channel"]["channel_members"]:
-                self._add_user_to_channel(user_id=user_mention_id, channel_id=channel_id)
+            if mention.user_id in message_data.channel.channel_members:
+                self._ensure_user_in_channel(user_id=user_mention_id, channel_id=channel_id)
+
+        orig_post_id = self._state_store.get_post_id(message_data.channel.channel_id, message_data.ts)
+        if orig_post_id is not None:
+            self._logger_bot.info("Message %s is already in Mattermost", message_data.ts)
+        else:
+            orig_post_id = self._create_post(message_data, channel_id=channel_id)
+            if orig_post_id is None:
+                return False
+            self._logger_bot.info("Message loaded to Mattermost")
 
+        delivered = True
+        if message_data.is_thread:
+            for reply_message in message_data.reply:
+                if self._state_store.get_post_id(reply_message.channel.channel_id,
+                                                 reply_message.ts) is not None:
+                    continue
+                self._logger_bot.info("Thread`s message is loading to Mattermost")
+                if self._create_post(reply_message, channel_id=channel_id, root_id=orig_post_id) is None:
+                    delivered = False
+                else:
+                    self._logger_bot.info("Threads`s message loaded to Mattermost")
+        return delivered
+
+    def _create_post(self, message_data, channel_id: str, root_id=None):
         files_list = []
-        self._logger_bot.info("Message is loading to Mattermost")
-        if message_data["is_attached"]:
-            files_list = self._upload_files(message_data["files"], channel_id=channel_id)
+        if message_data.files:
+            files_list = self._upload_files(message_data.files, channel_id=channel_id)
+            if None in files_list:
+                # Posted without the file, the message would count as delivered and the file never be
+                # retried. The files that did upload are kept in the state store for the next attempt.
+                self._logger_bot.error("Message %s not posted, %d of its files could not be uploaded",
+                                       message_data.ts, files_list.count(None))
+                return None
 
         data = {
             "channel_id": channel_id,
-            "message": message_data["text"],
+            "message": message_data.text,
             "props": {"from_webhook": "true",
-                      "override_username": message_data["user"]["user_display_name"],
-                      "username": message_data["user"]["user_display_name"],
-                      "slack_user_id": message_data["user"]["user_id"],
-                      "slack_user_name": message_data["user"]["user_name"],
-                      "slack_channel_id": message_data["channel"]["channel_id"],
-                      "slack_channel_name": message_data["channel"]["channel_name"],
-                      "slack_ts": message_data["ts"]
+                      "override_username": message_data.user.user_display_name,
+                      "username": message_data.user.user_display_name,
+                      "slack_user_id": message_data.user.user_id,
+                      "slack_user_name": message_data.user.user_name,
+                      "slack_channel_id": message_data.channel.channel_id,
+                      "slack_channel_name": message_data.channel.channel_name,
+                      "slack_ts": message_data.ts
                       },
             "file_ids": files_list
         }
+        if root_id is not None:
+            data["root_id"] = root_id
 
-        response = self._mm_web_client.mattermost_session.post(f'{self._mm_web_client.mattermost_url}/posts', json=data)
-        if response.status_code == 201:
-            post_info = response.json()
-            self._logger_bot.info("Message loaded to Mattermost")
-
-            if message_data["is_thread"]:
-                orig_post_id = post_info["id"]
-
-                for reply_message in message_data["reply"]:
-                    self._logger_bot.info("Thread`s message is loading to Mattermost")
-                    files_list = []
-                    if "files" in reply_message:
-                        files_list = self._upload_files(reply_message["files"], channel_id=channel_id)
-
-                    data = {
-                        "channel_id": channel_id,
-                        "message": reply_message["text"],
-                        "root_id": orig_post_id,
-                        "props": {"from_webhook": "true",
-                                  "override_username": reply_message["user"]["user_display_name"],
-                                  "username": reply_message["user"]["user_display_name"],
-                                  "slack_user_id": reply_message["user"]["user_id"],
-                                  "slack_user_name": reply_message["user"]["user_name"],
-                                  "slack_channel_id": reply_message["channel"]["channel_id"],
-                                  "slack_channel_name": reply_message["channel"]["channel_name"],
-                                  "slack_ts": reply_message["ts"]
-                                  },
-                        "file_ids": files_list
-                    }
-                    response = self._mm_web_client.mattermost_session.post(
-                        f'{self._mm_web_client.mattermost_url}/posts', json=data)
-                    if response.status_code == 201:
-                        self._logger_bot.info("Threads`s message loaded to Mattermost")
-                    else:
-                        self._logger_bot.error(
-                            f'Mattermost API Error (posts). Status code: {response.status_code} '
-                            f'Response:{response.text}')
-
-        else:
+        response = self._mm_transport.post('/posts', json=data)
+        if response.status_code != 201:
             self._logger_bot.error(
                 f'Mattermost API Error (posts). Status code: {response.status_code} Response:{response.text}')
+            return None
 
-    def _upload_files(self, files_from_message: list, channel_id: str) -> list:
-        files_list = []
-        for file in files_from_message:
-            self._logger_bot.info("File %s is loading to Mattermost", file["file_path"])
-            files = {"files": open(file["file_path"], "rb")}
-            params = {"channel_id": channel_id}
-
-            response_file = self._mm_web_client.mattermost_session.post(
-                f'{self._mm_web_client.mattermost_url}/files', params=params,
-                files=files)
-
-            if response_file.status_code == 201:
-                response_json = response_file.json()
-                self._logger_bot.info("File %s loaded to Mattermost", file["file_path"])
-                files_list.append(response_json['file_infos'][0]['id'])
-            else:
-                self._logger_bot.error(
-                    f'Mattermost API Error (files). Status code: {response_file.status_code} '
-                    f'Response:{response_file.text}')
-        return files_list
-
-    def _get_user_by_email(self, user_data: dict) -> str:
-        user_id = None
-        for user in self._users_list:
-            mm_mail = user["email"]
-            slack_mail = user_data["user_email"]
-            if mm_mail and slack_mail and mm_mail.lower() == slack_mail.lower():
-                user_id = user["id"]
-                break
+        post_id = response.json()["id"]
+        self._state_store.set_post_id(message_data.channel.channel_id, message_data.ts, post_id)
+        # Attached files belong to the post now and can not be reused by another one
+        for file in message_data.files or []:
+            if file.get("file_id"):
+                self._state_store.delete_file_id(file["file_id"], channel_id)
+        return post_id
 
-        if user_id is None and not user_data["user_is_bot"]:
+    def _upload_files(self, files_from_message: list, channel_id: str) -> list:
+        """Returns the Mattermost file id of each file, None for those that could not be uploaded."""
+        transfers = [self._start_file_transfer(file, channel_id=channel_id) for file in files_from_message]
+        return [transfer.result() for transfer in transfers]
+
+    def _start_file_transfer(self, file: dict, channel_id: str):
+        # The future is kept on the file, so a transfer started by prefetch_files is not started twice
+        if "transfer" not in file:
+            file["transfer"] = self._attachment_executor.submit(self._upload_file, file, channel_id)
+        return file["transfer"]
+
+    def _upload_file(self, file: dict, channel_id: str):
+        uploaded_file_id = None
+        if file.get("file_id"):
+            uploaded_file_id = self._state_store.get_file_id(file["file_id"], channel_id)
+        if uploaded_file_id is not None:
+            # Uploaded by an earlier attempt whose post was not created
+            self._logger_bot.info("File %s is already in Mattermost", file["file_name"])
+            return uploaded_file_id
+
+        self._logger_bot.info("File %s is loading to Mattermost", file["file_name"])
+        file_id = self._attachment_relay.upload(file, channel_id=channel_id)
+        if file_id is not None:
+            self._logger_bot.info("File %s loaded to Mattermost", file["file_name"])
+            if file.get("file_id"):
+                self._state_store.set_file_id(file["file_id"], channel_id, file_id)
+        return file_id
+
+    def _get_user_by_email(self, user_data: UserProfile) -> str:
+        user_id = self._state_store.get_mm_user_id(user_data.user_id)
+        if user_id is not None:
+            return user_id
+        user = self._user_directory.get_by_email(user_data.user_email)
+        if user is not None:
+            self._state_store.set_mm_user_id(user_data.user_id, user["id"])
+            return user["id"]
+        if user_data.user_is_bot:
+            return None
+
+        with self._lock:
+            # Another channel worker may have created the user in the meantime
+            user = self._user_directory.get_by_email(user_data.user_email)
+            if user is not None:
+                self._state_store.set_mm_user_id(user_data.user_id, user["id"])
+                return user["id"]
             self._logger_bot.info("user_data: %s", user_data)
-            #            self._logger_bot.info("users_list: %s", self._users_list)
             user_id = self._create_user(user_data)
-        return user_id
+            if user_id is not None:
+                self._state_store.set_mm_user_id(user_data.user_id, user_id)
+            return user_id
 
     def _get_user(self, user_id: str) -> dict:
-
-        for user in self._users_list:
-            if user["id"] == user_id:
-                return user
-        return {}
+        return self._user_directory.get_by_id(user_id) or {}
 
     def _get_channel(self, channel_id: str) -> dict:
-        for channel in self._channels_list:
-            if channel["id"] == channel_id:
-                return channel
-        return {}
-
-    def _get_channel_by_name(self, channel_data: dict) -> str:
-        channel_id = None
-        for channel in self._channels_list:
-            if channel["name"] == channel_data["channel_name"]:
-                channel_id = channel["id"]
-                break
-
-        if channel_id is None:
+        return self._channel_registry.get(channel_id) or {}
+
+    def _get_channel_by_name(self, channel_data: ChannelInfo) -> str:
+        channel_id = self._state_store.get_mm_channel_id(channel_data.channel_id)
+        if channel_id is not None:
+            return channel_id
+        channel = self._channel_registry.get_by_name(channel_data.channel_name)
+        if channel is not None:
+            self._state_store.set_mm_channel_id(channel_data.channel_id, channel["id"])
+            return channel["id"]
+
+        with self._lock:
+            channel = self._channel_registry.get_by_name(channel_data.channel_name)
+            if channel is not None:
+                self._state_store.set_mm_channel_id(channel_data.channel_id, channel["id"])
+                return channel["id"]
             channel_id = self._create_channel(channel_data)
+            if channel_id is not None:
+                self._state_store.set_mm_channel_id(channel_data.channel_id, channel_id)
+            return channel_id
 
-        return channel_id
-
-    def _create_channel(self, channel_data: dict) -> str:
-        self._logger_bot.info("Channel %s is creating", channel_data["channel_name"])
+    def _create_channel(self, channel_data: ChannelInfo) -> str:
+        self._logger_bot.info("Channel %s is creating", channel_data.channel_name)
 
         channel_id = None
         data = {
             "team_id": self._team_id,
-            "name": channel_data["channel_name"],
-            "display_name": channel_data["channel_name"],
+            "name": channel_data.channel_name,
+            "display_name": channel_data.channel_name,
             "scheme_id": '',
             "type": "O",
         }
-        if channel_data["channel_type"] == "private":
+        if channel_data.channel_type == "private":
             data["type"] = "P"
-        response = self._mm_web_client.mattermost_session.post(
-            f'{self._mm_web_client.mattermost_url}/channels', json=data)
+        response = self._mm_transport.post('/channels', json=data)
 
         if response.status_code == 201:
             response_data = response.json()
             channel_id = response_data["id"]
-            self._channels_list.append(response_data)
-            self._logger_bot.info("Channel %s created", channel_data["channel_name"])
+            self._channel_registry.add(response_data)
+            self._logger_bot.info("Channel %s created", channel_data.channel_name)
             self._set_channels_members(channel_id)
         else:
             self._logger_bot.error(
@@ -242,28 +342,27 @@ class MattermostUploadMessages:
 
         return channel_id
 
-    def _create_user(self, user_data: dict) -> str:
-        self._logger_bot.info("User %s is creating", user_data["user_name"])
+    def _create_user(self, user_data: UserProfile) -> str:
+        self._logger_bot.info("User %s is creating", user_data.user_name)
         user_id = None
 
         data = {
             "team_id": self._team_id,
-            "username": user_data["user_name"],
-            "display_name": user_data["user_display_name"],
-            "nickname": user_data["user_display_name"],
+            "username": user_data.user_name,
+            "display_name": user_data.user_display_name,
+            "nickname": user_data.user_display_name,
             "scheme_id": '',
-            "email": user_data["user_email"],
-            "first_name": user_data["user_first_name"],
-            "last_name": user_data["user_last_name"],
+            "email": user_data.user_email,
+            "first_name": user_data.user_first_name,
+            "last_name": user_data.user_last_name,
             "password": "password1+"
         }
         self._logger_bot.info("User data is %s", user_data)
-        response = self._mm_web_client.mattermost_session.post(
-            f'{self._mm_web_client.mattermost_url}/users', json=data)
+        response = self._mm_transport.post('/users', json=data)
 
         if response.status_code == 201:
             response_date = response.json()
-            self._users_list.append(response_date)
+            self._user_directory.add(response_date)
             user_id = response_date["id"]
             self._logger_bot.info("User %s created", self._get_user(user_id))
 
@@ -276,7 +375,7 @@ class MattermostUploadMessages:
         return user_id
 
     def load_team_id(self):
-        response = self._mm_web_client.mattermost_session.get(f'{self._mm_web_client.mattermost_url}/teams')
+        response = self._mm_transport.get('/teams')
         if response.status_code == 200:
             response_data = response.json()
             self._team_id = response_data[0]["id"]
@@ -286,64 +385,66 @@ class MattermostUploadMessages:
             self._logger_bot.error(
                 f'Mattermost API Error (teams). Status code: {response.status_code} Response:{response.text}')
 
+    def _ensure_user_in_channel(self, user_id: str, channel_id: str):
+        if self._is_user_in_channel(user_id=user_id, channel_id=channel_id):
+            return
+        with self._lock:
+            if not self._is_user_in_channel(user_id=user_id, channel_id=channel_id):
+                self._add_user_to_channel(user_id=user_id, channel_id=channel_id)
+
     def _add_user_to_channel(self, user_id: str, channel_id: str):
         response = ''
         if user_id is None or channel_id is None:
             return
 
         try:
-            self._logger_bot.info("Started adding user %s to channel %s", self._get_user(user_id)["username"],
-                                  self._get_channel(channel_id)["name"])
+            self._logger_bot.info("Started adding user %s to channel %s",
+                                  self._get_user(user_id).get("username", user_id),
+                                  self._get_channel(channel_id).get("name", channel_id))
             #            self._logger_bot.info("Users data: %s", self._get_user(user_id))
             #            self._logger_bot.info("Channels data: %s", self._get_channel(channel_id))
             payload = {
                 "user_id": user_id,
             }
 
-            response = self._mm_web_client.mattermost_session.post(f'{self._mm_web_client.mattermost_url}'
-                                                                   f'/channels/{channel_id}/members',
-                                                                   json=payload)
+            response = self._mm_transport.post(f'/channels/{channel_id}/members', json=payload)
             response.raise_for_status()
 
-            channels = self._channels_list
-            i = 0
-            for channel in channels:
-                if channel["id"] == channel_id:
-                    self._channels_list[i]["members"].append(user_id)
-                    break
-                i += 1
+            self._channel_registry.add_member(channel_id, user_id)
 
-            self._logger_bot.info("User %s added to channel %s", self._get_user(user_id)["username"],
-                                  self._get_channel(channel_id)["name"])
+            self._logger_bot.info("User %s added to channel %s", self._get_user(user_id).get("username", user_id),
+                                  self._get_channel(channel_id).get("name", channel_id))
         except Exception as err:
             self._logger_bot.error(
                 f'Mattermost API Error (channels/member). Status code: {response.status_code} Response:{response.text} '
                 f'Error:{err}')
 
     def _set_channels_members(self, channel_id: str):
-        channels = self._channels_list
-        i = 0
-        for channel in channels:
-            if channel["id"] == channel_id:
-                channel_members_list = self._get_channels_members(channel_id)
-                member_list = []
-                for channel_member in channel_members_list:
-                    member_list.append(channel_member["user_id"])
-                self._channels_list[i]["members"] = member_list
-                break
-            i += 1
+        if self._channel_registry.get(channel_id) is None:
+            return
+        channel_members_list = self._get_channels_members(channel_id)
+        self._channel_registry.set_members(channel_id,
+                                           [channel_member["user_id"] for channel_member in channel_members_list])
 
     def _get_channels_members(self, channel_id: str) -> list:
         response = ''
+        params = {
+            "page": 0,
+            "per_page": self._messages_per_page
+        }
         channel_members = []
         try:
+            while True:
+                response = self._mm_transport.get(f'/channels/{channel_id}/members', params=params)
+                response.raise_for_status()
+                members = response.json()
 
-            response = self._mm_web_client.mattermost_session.get(f'{self._mm_web_client.mattermost_url}'
-                                                                  f'/channels/{channel_id}/members')
-            response.raise_for_status()
-            channel_members = response.json()
+                if not members:
+                    break
+                channel_members.extend(members)
+                params["page"] += 1
 
-            self._logger_bot.info("Got members of channel %s", self._get_channel(channel_id)["name"])
+            self._logger_bot.info("Got members of channel %s", self._get_channel(channel_id).get("name", channel_id))
         except Exception as err:
             self._logger_bot.error(
                 f'Mattermost API Error (channels/members). '
@@ -351,13 +452,7 @@ class MattermostUploadMessages:
         return channel_members
 
     def _is_user_in_channel(self, user_id: str, channel_id: str) -> bool:
-        is_member = False
-        channels = self._get_channel(channel_id)
-        if "members" in channels:
-            for member in channels["members"]:
-                if member == user_id:
-                    is_member = True
-        return is_member
+        return self._channel_registry.is_member(channel_id, user_id)
 
     def _add_user_to_team(self, user_id: str, team_id: str):
         response = ''
@@ -367,26 +462,31 @@ class MattermostUploadMessages:
                 "team_id": team_id
             }
 
-            response = self._mm_web_client.mattermost_session.post(f'{self._mm_web_client.mattermost_url}'
-                                                                   f'/teams/{team_id}/members',
-                                                                   json=payload)
+            response = self._mm_transport.post(f'/teams/{team_id}/members', json=payload)
             response.raise_for_status()
 
-            self._logger_bot.info("User %s added to team %s", self._get_user(user_id)["username"], team_id)
+            self._logger_bot.info("User %s added to team %s", self._get_user(user_id).get("username", user_id), team_id)
         except Exception as err:
             self._logger_bot.error(
                 f'Mattermost API Error (teams/members). Status code: {response.status_code} Response:{response.text}'
                 f'Error:{err}')
 
+    def get_transport_counters(self) -> dict:
+        return self._mm_transport.get_counters()
+
     def set_channel_filter(self, channel_filter):
         if len(channel_filter) != 0 and channel_filter != 'all':
             self._channel_filter = channel_filter.split(" ")
+        else:
+            self._channel_filter = []
 
     def set_channels_list(self, channels):
-        self._channels_list = channels
+        with self._lock:
+            self._channel_registry = MattermostChannelRegistry(channels)
 
     def set_users_list(self, users):
-        self._users_list = users
+        with self._lock:
+            self._user_directory = MattermostUserDirectory(users)
 
     def _is_selected_channel(self, channel_name) -> bool:
         is_channel_selected = False
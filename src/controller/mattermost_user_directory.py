@@ -0,0 +1,37 @@
+class MattermostUserDirectory:
+    """Mattermost users indexed by lower-cased email, by id and by username."""
+
+    def __init__(self, users=None):
+        self._users_by_id = {}
+        self._users_by_email = {}
+        self._users_by_username = {}
+        if users:
+            self.extend(users)
+
+    def add(self, user: dict):
+        self._users_by_id[user["id"]] = user
+        if user.get("email"):
+            self._users_by_email[user["email"].lower()] = user
+        if user.get("username"):
+            self._users_by_username[user["username"]] = user
+
+    def extend(self, users):
+        for user in users:
+            self.add(user)
+
+    def get_by_id(self, user_id: str):
+        return self._users_by_id.get(user_id)
+
+    def get_by_email(self, email: str):
+        if not email:
+            return None
+        return self._users_by_email.get(email.lower())
+
+    def get_by_username(self, username: str):
+        return self._users_by_username.get(username)
+
+    def __len__(self):
+        return len(self._users_by_id)
+
+    def __iter__(self):
+        return iter(self._users_by_id.values())
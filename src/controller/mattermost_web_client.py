@@ -1,11 +1,19 @@
 import requests
+from requests.adapters import HTTPAdapter
 
 from src.util.settings_parser import SettingsParser
 
 
 class MattermostWebClient:
-    def __init__(self):
+    def __init__(self, http_cassette):
         settings = SettingsParser()
         self.mattermost_url = settings.mattermost_url
         self.mattermost_session = requests.Session()
-        self.mattermost_session.headers.update({'Authorization': 'Bearer ' + settings.mattermost_bot_token})
\ No newline at end of file
+        self.mattermost_session.headers.update({'Authorization': 'Bearer ' + settings.mattermost_bot_token})
+        # Keep-alive connections for every thread that talks to Mattermost at once: the upload and
+        # transform stage of each channel worker and the attachment workers
+        pool_size = settings.channels_concurrency * 2 + settings.attachment_workers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.mattermost_session.mount('http://', adapter)
+        self.mattermost_session.mount('https://', adapter)
+        http_cassette.mount(self.mattermost_session, "mattermost")
@@ -0,0 +1,175 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.entity.migration_job import MigrationJob
+from src.util.settings_parser import SettingsParser
+
+
+class ShardWorker:
+    """Worker process of a sharded migration.
+
+    Claims channels of a run from the channel lease store, channels_concurrency
+    at a time, and migrates them. A heartbeat renews the leases every third of
+    lease_seconds and reports the messages delivered so far. Workers keep
+    polling until no channel is pending or leased, so leases that expired
+    because another worker died are picked up. A channel whose lease is lost to
+    another worker is stopped, and the state store is flushed before leases are
+    renewed or released, so the next owner sees every post made under them.
+    The worker's share of the Slack rate limits and the Slack channels and users
+    are read from the run, so no worker loads them from Slack again.
+    """
+
+    def __init__(self, slack_load_messages, mattermost_upload_messages, channel_lease_store, state_store,
+                 slack_rate_limiter):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._load_messages = slack_load_messages
+        self._mattermost_upload_messages = mattermost_upload_messages
+        self._lease_store = channel_lease_store
+        self._state_store = state_store
+        self._rate_limiter = slack_rate_limiter
+        self._mattermost_sink = settings.mattermost_sink
+        self._concurrency = settings.channels_concurrency
+        self._heartbeat_seconds = settings.lease_seconds / 3
+        self._owner = f"{socket.gethostname()}-{os.getpid()}"
+        self._channel_jobs = {}
+        self._lock = threading.Lock()
+
+    def serve(self):
+        """Works on every run started in the lease store, for workers running in their own containers."""
+        finished_run_id = None
+        while True:
+            run = self._lease_store.get_running_run()
+            if run is None or run[0] == finished_run_id:
+                time.sleep(self._heartbeat_seconds)
+                continue
+            self.run(run[0])
+            finished_run_id = run[0]
+
+    def run(self, run_id: str):
+        """Migrates channels of the run until none is left to claim."""
+        run = self._lease_store.get_running_run()
+        if run is None or run[0] != run_id:
+            self._logger_bot.info("Sharded run %s is not running", run_id)
+            return
+        channel_filter = run[1]
+        run_setup = self._lease_store.get_run_setup(run_id)
+        if run_setup is None:
+            self._logger_bot.error("Sharded run %s has no setup, it was started by an older version", run_id)
+            return
+        slack_tier_rates, workspace = run_setup
+        self._logger_bot.info("Worker %s joins sharded run %s", self._owner, run_id)
+
+        self._load_messages.set_channel_filter(channel_filter)
+        self._rate_limiter.set_tier_rates(slack_tier_rates)
+        if self._mattermost_sink == "rest":
+            self._mattermost_upload_messages.set_channel_filter(channel_filter)
+            self._mattermost_upload_messages.load_users()
+            self._mattermost_upload_messages.load_channels()
+            self._mattermost_upload_messages.load_team_id()
+        self._load_messages.start()
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=self._renew_leases, args=(run_id, stop_heartbeat),
+                                     name="lease-heartbeat", daemon=True)
+        try:
+            channels = {channel_item["id"]: channel_item
+                        for channel_item in self._load_messages.set_workspace(workspace)}
+            heartbeat.start()
+            with ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="channel") as executor:
+                for _ in range(self._concurrency):
+                    executor.submit(self._migrate_claimed_channels, run_id, channels)
+        finally:
+            stop_heartbeat.set()
+            if heartbeat.is_alive():
+                heartbeat.join()
+            self._load_messages.stop()
+        self._logger_bot.info("Worker %s leaves sharded run %s", self._owner, run_id)
+
+    def _migrate_claimed_channels(self, run_id: str, channels: dict):
+        try:
+            while self._lease_store.is_running(run_id):
+                slack_channel_id = self._lease_store.claim(run_id, self._owner)
+                if slack_channel_id is None:
+                    progress = self._lease_store.get_progress(run_id)
+                    if progress["pending"] == 0 and progress["leased"] == 0:
+                        return
+                    # Channels leased by other workers come back if their lease expires
+                    time.sleep(self._heartbeat_seconds)
+                    continue
+                self._migrate_channel(run_id, slack_channel_id, channels.get(slack_channel_id))
+        except Exception as err:
+            self._logger_bot.exception("Worker %s stopped claiming channels: %s", self._owner, err)
+
+    def _migrate_channel(self, run_id: str, slack_channel_id: str, channel_item):
+        if channel_item is None:
+            self._logger_bot.error("Channel %s of sharded run %s is not selected by this worker", slack_channel_id,
+                                   run_id)
+            self._lease_store.release(run_id, slack_channel_id, self._owner, "failed", 0)
+            return
+        job = MigrationJob(job_id=run_id, channel_filter=channel_item["name"])
+        with self._lock:
+            self._channel_jobs[slack_channel_id] = job
+        state = "done"
+        try:
+            self._load_messages.migrate_channel(channel_item, job)
+        except Exception as err:
+            state = "failed"
+            self._logger_bot.exception("Migration of channel %s failed: %s", channel_item["name"], err)
+        finally:
+            with self._lock:
+                # After a lost lease the channel can be claimed again while this run of it is still stopping
+                if self._channel_jobs.get(slack_channel_id) is job:
+                    del self._channel_jobs[slack_channel_id]
+        self._state_store.flush()
+        if job.is_stop_requested():
+            # The lease belongs to another worker now, it is not ours to release
+            self._logger_bot.info("Worker %s stopped channel %s after losing its lease", self._owner,
+                                  channel_item["name"])
+            return
+        self._lease_store.release(run_id, slack_channel_id, self._owner, state, job.messages)
+
+    def _renew_leases(self, run_id: str, stop: threading.Event):
+        while not stop.wait(self._heartbeat_seconds):
+            with self._lock:
+                jobs = dict(self._channel_jobs)
+            messages = {slack_channel_id: job.messages for slack_channel_id, job in jobs.items()}
+            try:
+                self._state_store.flush()
+                held = self._lease_store.renew(run_id, self._owner, messages)
+            except Exception as err:
+                self._logger_bot.error(f"Lease renewal of worker {self._owner} failed: {err}")
+                continue
+            for slack_channel_id in messages.keys() - held:
+                if jobs[slack_channel_id].is_stop_requested():
+                    continue
+                # Another worker has claimed the channel, posting on would duplicate its messages
+                self._logger_bot.warning("Worker %s lost the lease of channel %s, stopping it", self._owner,
+                                         slack_channel_id)
+                jobs[slack_channel_id].stop_event.set()
+
+
+if __name__ == "__main__":
+    settings = SettingsParser()
+    # Read when prometheus_client is imported, the worker's metrics then go to files the manager serves
+    os.makedirs(settings.worker_metrics_dir, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = settings.worker_metrics_dir
+
+    from src.controller.containers import Containers
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(process)d - %(levelname)s - %(message)s',
+                        handlers=[
+                            logging.FileHandler(settings.log_file, mode='a'),
+                            logging.StreamHandler(sys.stdout)
+                        ])
+
+    shard_worker = Containers().shard_worker()
+    if len(sys.argv) > 1:
+        shard_worker.run(sys.argv[1])
+    else:
+        shard_worker.serve()
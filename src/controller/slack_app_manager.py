@@ -1,5 +1,6 @@
 from slack_bolt import App
-from flask import Flask, request
+from flask import Flask, Response, request
+from prometheus_client import CONTENT_TYPE_LATEST
 from slack_bolt.adapter.flask import SlackRequestHandler
 
 from src.controller.config_dto_schema import ConfigDTOSchema
@@ -9,11 +10,9 @@ from datetime import datetime
 
 
 class SlackAppManager:
-    def __init__(self, config_service, slack_load_messages, mattermost_upload_messages):
+    def __init__(self, config_service, migration_job_manager, migration_metrics):
         self.logger_bot = logging.getLogger("")
 
-        self._mattermost_upload_messages_id = None
-        self._mattermost_upload_messages_state = None
         settings = SettingsParser()
         bot_token = settings.slack_bot_token
         app_token = settings.slack_app_token
@@ -24,25 +23,33 @@ class SlackAppManager:
         self.handler = SlackRequestHandler(self.app)
 
         self._config_service = config_service
-        self._load_messages = slack_load_messages
+        self._job_manager = migration_job_manager
+        self._metrics = migration_metrics
         self._get_config_command = settings.get_config_command
         self._set_excluded_channels_command = settings.set_excluded_channels_command
         self._set_excluded_users_command = settings.set_excluded_users_command
         self._set_date_sync_command = settings.set_date_sync_command
         self._start_integration_command = settings.start_integration_command
-        self._mattermost_upload_messages = mattermost_upload_messages
+        self._job_status_command = settings.job_status_command
+        self._cancel_job_command = settings.cancel_job_command
         self.register_commands()
 
         @self.flask_app.route("/slack/events", methods=["POST"])
         def slack_events():
             return self.handler.handle(request)
 
+        @self.flask_app.route("/metrics", methods=["GET"])
+        def metrics():
+            return Response(self._metrics.render(), content_type=CONTENT_TYPE_LATEST)
+
     def register_commands(self):
         self.app.command(self._get_config_command)(self.get_config)
         self.app.command(self._set_excluded_channels_command)(self.set_excluded_channels)
         self.app.command(self._set_excluded_users_command)(self.set_excluded_users)
         self.app.command(self._set_date_sync_command)(self.set_date_integration)
         self.app.command(self._start_integration_command)(self.start_integration)
+        self.app.command(self._job_status_command)(self.get_job_status)
+        self.app.command(self._cancel_job_command)(self.cancel_job)
 
     def get_config(self, ack, respond, command):
         ack()
@@ -99,18 +106,42 @@ class SlackAppManager:
             self.logger_bot.info("Transfer messages is canceled: no params")
             respond("Transfer messages is canceled: no params")
             return
-        respond("Transfer messages started")
-        self.logger_bot.info("Transfer messages started")
-
-        self._load_messages.set_channel_filter(command_params)
-        self._mattermost_upload_messages.set_channel_filter(command_params)
-        self._mattermost_upload_messages.load_users()
-        self._mattermost_upload_messages.load_channels()
-        self._mattermost_upload_messages.load_team_id()
-        self._load_messages.load_channel_messages()
-        self.logger_bot.info("Transfer messages finished")
-
-        respond("Transfer messages finished")
+
+        def notify_finished(job):
+            self.logger_bot.info("Transfer messages finished (job %s)", job.job_id)
+            # The response URL may have expired on long migrations, the job status still has the result
+            try:
+                respond(f"Transfer messages finished: {job.describe()}")
+            except Exception as err:
+                self.logger_bot.warning("Job %s result was not sent: %s", job.job_id, err)
+
+        job, is_new = self._job_manager.submit(command_params, on_finish=notify_finished)
+        if is_new:
+            self.logger_bot.info("Transfer messages queued (job %s)", job.job_id)
+            respond(f"Transfer messages queued as job {job.job_id}, check it with {self._job_status_command} "
+                    f"{job.job_id}")
+        else:
+            respond(f"Transfer messages for these channels is already {job.state} as job {job.job_id}")
+
+    def get_job_status(self, ack, respond, command):
+        ack()
+        command_params = command['text'].strip()
+        if len(command_params) != 0:
+            job = self._job_manager.get_job(command_params)
+            respond(job.describe() if job is not None else f"Job {command_params} not found")
+            return
+        jobs = self._job_manager.get_jobs()
+        respond("\n".join(job.describe() for job in jobs) if jobs else "No transfer jobs")
+
+    def cancel_job(self, ack, respond, command):
+        ack()
+        command_params = command['text'].strip()
+        job = self._job_manager.cancel(command_params)
+        if job is None:
+            respond(f"Job {command_params} is not queued or running")
+            return
+        self.logger_bot.info("Transfer messages cancel requested (job %s)", job.job_id)
+        respond(f"Job {job.job_id} will stop after the channels in progress")
 
     def run(self, port=3005):
         self.flask_app.run(port=port, host="0.0.0.0", debug=False)
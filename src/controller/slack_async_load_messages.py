@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import threading
+
+import aiohttp
+from slack_sdk.errors import SlackApiError
+
+from src.controller.history_spool import history_oldest_first
+from src.util.settings_parser import SettingsParser
+
+
+class SlackAsyncLoadMessages:
+    """Asyncio ingestion backend for SlackLoadMessages.
+
+    All Slack calls run on one event loop in a background thread, so the thread
+    replies of a whole history page are requested at once, bounded by
+    slack_async_concurrency. Channel workers drive it through
+    blocking methods, which lets it plug into the same channel pipeline as the
+    synchronous backend.
+    """
+
+    def __init__(self, slack_rate_limiter, http_cassette):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._slack_token = settings.slack_bot_token
+        self._slack_api_url = settings.slack_api_url
+        self._concurrency = settings.slack_async_concurrency
+        self._messages_per_page = 100
+        self._rate_limiter = slack_rate_limiter
+        self._http_cassette = http_cassette
+        self._loop = None
+        self._loop_thread = None
+        self._session = None
+        self._web_client = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._loop_thread = threading.Thread(target=self._loop.run_forever, name="slack-async", daemon=True)
+            self._loop_thread.start()
+            self._run(self._open())
+
+    def stop(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            self._run(self._close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._loop_thread.join()
+            self._loop.close()
+            self._loop = None
+            self._loop_thread = None
+
+    def load_users_list(self) -> list:
+        return self._run(self._load_users_list())
+
+    def load_channels_members(self, channel_ids: list) -> dict:
+        return self._run(self._load_channels_members(channel_ids))
+
+    def load_prepared_pages(self, channel_item: dict, oldest_date: float, get_delivered, get_threads_to_load,
+                            window_seconds=None):
+        """Yields history pages (oldest page and message first) with threads and files already loaded.
+
+        Pages are read in time windows as history_oldest_first describes, as Slack answers newest first.
+        Files of the messages in get_delivered(channel_id, ts_list) are left out, and only the threads
+        returned by get_threads_to_load(channel_id, page) are read, from the ts it maps them to. Both
+        look up the state store, so they are called once per page from the calling thread and never
+        block the event loop.
+        """
+        def load_page(oldest: str, latest, cursor):
+            # Without the older pages the newer ones cannot be posted in order, None stops the reading
+            return self._run(self._load_history_page(channel_item, oldest, latest, cursor))
+
+        for page in history_oldest_first(load_page, oldest_date + 1, window_seconds):
+            yield self.prepare_page(page, channel_item, get_delivered, get_threads_to_load)
+
+    def prepare_page(self, page: list, channel_item: dict, get_delivered, get_threads_to_load) -> list:
+        """Loads the threads and files of a page of messages, as load_prepared_pages does."""
+        threads = get_threads_to_load(channel_item["id"], page)
+        delivered = get_delivered(channel_item["id"], [message["ts"] for message in page])
+        self._run(self._prepare_page(page, channel_item, threads, delivered))
+
+        # Replies are only known once their threads are read
+        replies = [reply for message in page for reply in message.get("reply", ()) if "files" in reply]
+        delivered = get_delivered(channel_item["id"], [reply["ts"] for reply in replies]) if replies else ()
+        for reply in replies:
+            if reply["ts"] in delivered:
+                del reply["files"]
+        return page
+
+    def load_thread_parents(self, channel_item: dict, thread_ts_list: list) -> list:
+        """Returns the parent message of each thread, with its latest_reply, None where it could not be read."""
+        return self._run(self._load_thread_parents(channel_item, thread_ts_list))
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _open(self):
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        connector = aiohttp.TCPConnector(limit=self._concurrency)
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._web_client = self._http_cassette.create_async_slack_client(self._slack_token, self._slack_api_url,
+                                                                         self._session)
+
+    async def _close(self):
+        await self._session.close()
+        self._session = None
+        self._web_client = None
+
+    async def _call(self, method: str, **kwargs):
+        api_method = getattr(self._web_client, method)
+
+        async def request(**request_kwargs):
+            async with self._semaphore:
+                return await api_method(**request_kwargs)
+
+        return await self._rate_limiter.acall(method, request, **kwargs)
+
+    async def _load_users_list(self) -> list:
+        users_list = []
+        cursor = None
+        try:
+            while True:
+                response = await self._call("users_list", limit=self._messages_per_page, cursor=cursor)
+                users_list.extend(response["members"])
+                cursor = response.get("response_metadata", {}).get("next_cursor")
+                if not cursor:
+                    break
+        except SlackApiError as e:
+            self._logger_bot.error(f"SlackAPIError (users_list): {e.response['error']}")
+            return []
+        return users_list
+
+    async def _load_channels_members(self, channel_ids: list) -> dict:
+        members_lists = await asyncio.gather(*(self._load_channel_members(channel_id)
+                                               for channel_id in channel_ids))
+        return dict(zip(channel_ids, members_lists))
+
+    async def _load_channel_members(self, channel_id: str) -> list:
+        members_list = []
+        cursor = None
+        try:
+            while True:
+                response = await self._call("conversations_members", channel=channel_id,
+                                            limit=self._messages_per_page, cursor=cursor)
+                members_list.extend(response["members"])
+                cursor = response["response_metadata"]["next_cursor"]
+                if not cursor:
+                    break
+        except SlackApiError as e:
+            self._logger_bot.error(f"SlackAPIError (conversations_members): {e.response['error']}")
+            return []
+        self._logger_bot.info("Loaded %s members for channel %s", len(members_list), channel_id)
+        return members_list
+
+    async def _load_history_page(self, channel_item: dict, oldest: str, latest, cursor):
+        try:
+            response = await self._call("conversations_history", channel=channel_item["id"],
+                                        limit=self._messages_per_page, oldest=oldest, latest=latest,
+                                        cursor=cursor)
+        except SlackApiError as e:
+            self._logger_bot.error(f"SlackAPIError (conversations_history): {e.response['error']}")
+            return None, None
+
+        messages = response["messages"]
+        self._logger_bot.info("Selected %d messages from Slack channel %s", len(messages), channel_item["name"])
+        next_cursor = response["response_metadata"]["next_cursor"] if response["has_more"] else None
+        return messages, next_cursor
+
+    async def _load_thread_parents(self, channel_item: dict, thread_ts_list: list) -> list:
+        return await asyncio.gather(*(self._load_thread_parent(channel_item["id"], thread_ts)
+                                      for thread_ts in thread_ts_list))
+
+    async def _load_thread_parent(self, channel_id: str, thread_ts: str):
+        try:
+            response = await self._call("conversations_replies", channel=channel_id, ts=thread_ts, limit=1)
+        except SlackApiError as e:
+            self._logger_bot.error(f"SlackAPIError (conversations_replies): {e.response['error']}")
+            return None
+        # The parent comes first
+        return response["messages"][0] if response["messages"] else None
+
+    async def _prepare_page(self, messages: list, channel_item: dict, threads: dict, delivered: set):
+        await asyncio.gather(*(self._prepare_message(message, channel_item, threads, delivered)
+                               for message in messages))
+
+    async def _prepare_message(self, message: dict, channel_item: dict, threads: dict, delivered: set):
+        message["is_thread"] = False
+        message["channel"] = channel_item["id"]
+        message["is_attached"] = False
+
+        files_attach = []
+        if message["ts"] not in delivered:
+            files_attach.extend(message.get("files", []))
+            for attachment in message.get("attachments", []):
+                files_attach.extend(attachment.get("files", []))
+        else:
+            message.pop("files", None)
+
+        if files_attach:
+            message["is_attached"] = True
+            message["files"] = self._collect_files(files_attach)
+        if message["ts"] in threads:
+            reply_messages = await self._load_threads(channel_item["id"], message["ts"], threads[message["ts"]])
+            if reply_messages is None:
+                # Reported undelivered by the pipeline, the parent is not posted without its thread
+                message["load_failed"] = True
+            else:
+                message["reply"] = reply_messages
+                message["is_thread"] = True
+                message["thread_latest_reply"] = message.get("latest_reply")
+
+    async def _load_threads(self, channel_id: str, ts_of_parent_message: str, oldest):
+        reply_messages = []
+        cursor = None
+        try:
+            while True:
+                response = await self._call("conversations_replies", channel=channel_id, ts=ts_of_parent_message,
+                                            oldest=oldest, limit=self._messages_per_page, cursor=cursor)
+                # The parent comes first on the first page only
+                reply_messages.extend(reply for reply in response["messages"]
+                                      if reply["ts"] != ts_of_parent_message)
+                if not response.get("has_more"):
+                    break
+                cursor = response["response_metadata"]["next_cursor"]
+            self._logger_bot.info("Thread (%d messages) loaded", len(reply_messages))
+        except SlackApiError as e:
+            self._logger_bot.error(f"SlackAPIError (conversations_replies): {e.response['error']}")
+            return None
+
+        for reply in reply_messages:
+            if "files" in reply:
+                reply["files"] = self._collect_files(reply["files"])
+        return reply_messages
+
+    @staticmethod
+    def _collect_files(files_attach: list) -> list:
+        # Files are relayed to Mattermost at upload time, here only what the relay needs is kept
+        files_list = []
+        for files in files_attach:
+            if "url_private_download" not in files:
+                break
+            files_list.append({"file_id": files["id"],
+                               "file_name": files["name"],
+                               "link": files["url_private_download"],
+                               "user_id": files["user"],
+                               "size": files.get("size")})
+        return files_list
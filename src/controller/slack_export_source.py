@@ -0,0 +1,176 @@
+import calendar
+import json
+import logging
+import posixpath
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+
+from src.util.settings_parser import SettingsParser
+
+
+class SlackExportSource:
+    """Reads channels, users and messages from a Slack workspace export archive.
+
+    The archive is read in place: channels.json, groups.json, mpims.json, dms.json
+    and users.json are loaded once, the per-day message files of a channel are
+    streamed in date order and days before the checkpoint are not opened at all.
+    Replies are stored in the day they were posted, so an index of the days that
+    hold replies of each thread is built before a channel is read.
+    """
+
+    DAY_CACHE_SIZE = 16
+
+    def __init__(self):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._export_file = settings.slack_export_file
+        self._archive = None
+        self._days = {}
+        self._thread_days = {}
+        self._day_cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self):
+        with self._lock:
+            if self._archive is not None:
+                return
+            self._archive = zipfile.ZipFile(self._export_file)
+            days = {}
+            for name in self._archive.namelist():
+                directory, file_name = posixpath.split(name)
+                if directory and file_name.endswith(".json"):
+                    days.setdefault(directory, []).append(file_name[:-len(".json")])
+            self._days = {directory: sorted(day_list) for directory, day_list in days.items()}
+            self._logger_bot.info("Slack export %s opened (%d channel folders)", self._export_file, len(self._days))
+
+    def close(self):
+        with self._lock:
+            if self._archive is None:
+                return
+            self._archive.close()
+            self._archive = None
+            self._days = {}
+            self._thread_days = {}
+            self._day_cache.clear()
+
+    def load_users_list(self) -> list:
+        return self._read_json("users.json")
+
+    def load_channels_list(self) -> list:
+        """Public and private channels, shaped like conversations_list results."""
+        channels = [dict(channel, is_private=False) for channel in self._read_json("channels.json")]
+        channels.extend(dict(channel, is_private=True) for channel in self._read_json("groups.json"))
+        return channels
+
+    def load_direct_channels_list(self) -> list:
+        """Group and direct messages, shaped like conversations_list results."""
+        channels = list(self._read_json("mpims.json"))
+        for channel in self._read_json("dms.json"):
+            members = channel.get("members") or []
+            channels.append(dict(channel, user=members[-1] if members else channel["id"]))
+        return channels
+
+    def load_history_pages(self, channel_item: dict, oldest_date: float, page_size: int):
+        """Yields pages of the channel's top level messages newer than oldest_date, oldest first."""
+        directory = self._get_directory(channel_item)
+        if directory is None:
+            self._logger_bot.info("No messages of channel %s in the Slack export", channel_item["name"])
+            return
+        # A day that ended before oldest_date holds neither new messages nor replies to them. Day files
+        # follow the workspace time zone, so a day is kept until a day after its UTC end.
+        days = [day for day in self._days[directory] if self._day_end(day) > oldest_date]
+        self._thread_days[channel_item["id"]] = self._index_threads(directory, days)
+        try:
+            page = []
+            for day in days:
+                for message in self._read_day(directory, day):
+                    if float(message["ts"]) <= oldest_date or self._is_reply(message):
+                        continue
+                    page.append(self._with_thread_summary(message))
+                    if len(page) >= page_size:
+                        self._logger_bot.info("Selected %d messages from Slack export channel %s", len(page),
+                                              channel_item["name"])
+                        yield page
+                        page = []
+            if page:
+                self._logger_bot.info("Selected %d messages from Slack export channel %s", len(page),
+                                      channel_item["name"])
+                yield page
+        finally:
+            self._thread_days.pop(channel_item["id"], None)
+
+    def load_thread_replies(self, channel_item: dict, thread_ts: str, oldest) -> list:
+        """Replies of a thread newer than oldest (all replies when oldest is None), oldest first."""
+        directory = self._get_directory(channel_item)
+        replies = []
+        for day in self._thread_days.get(channel_item["id"], {}).get(thread_ts, ()):
+            replies.extend(message for message in self._read_day(directory, day)
+                           if message.get("thread_ts") == thread_ts and message["ts"] != thread_ts
+                           and (oldest is None or float(message["ts"]) > float(oldest)))
+        replies.sort(key=lambda reply: float(reply["ts"]))
+        return replies
+
+    def _index_threads(self, directory: str, days: list) -> dict:
+        thread_days = {}
+        for day in days:
+            for message in self._read_day(directory, day, cache=False):
+                if self._is_reply(message):
+                    day_list = thread_days.setdefault(message["thread_ts"], [])
+                    if not day_list or day_list[-1] != day:
+                        day_list.append(day)
+        return thread_days
+
+    def _read_day(self, directory: str, day: str, cache: bool = True) -> list:
+        key = (directory, day)
+        with self._lock:
+            if key in self._day_cache:
+                self._day_cache.move_to_end(key)
+                return self._day_cache[key]
+        messages = self._read_json(f"{directory}/{day}.json")
+        if cache:
+            with self._lock:
+                self._day_cache[key] = messages
+                while len(self._day_cache) > self.DAY_CACHE_SIZE:
+                    self._day_cache.popitem(last=False)
+        return messages
+
+    def _read_json(self, name: str) -> list:
+        try:
+            with self._archive.open(name) as member:
+                return json.load(member)
+        except KeyError:
+            return []
+        except ValueError as err:
+            self._logger_bot.error(f"Slack export file {name} can not be read: {err}")
+            return []
+
+    def _get_directory(self, channel_item: dict):
+        # Channels are stored by name, direct messages by channel id
+        for directory in (channel_item["name"], channel_item["id"]):
+            if directory in self._days:
+                return directory
+        return None
+
+    @staticmethod
+    def _is_reply(message: dict) -> bool:
+        return "thread_ts" in message and message["thread_ts"] != message["ts"]
+
+    @staticmethod
+    def _with_thread_summary(message: dict) -> dict:
+        # Older exports list the replies instead of reply_users / latest_reply
+        if "replies" in message and "reply_users" not in message:
+            replies = message["replies"]
+            message["reply_users"] = sorted({reply["user"] for reply in replies if "user" in reply})
+            if replies:
+                message["latest_reply"] = max((reply["ts"] for reply in replies), key=float)
+        return message
+
+    @staticmethod
+    def _day_end(day: str) -> float:
+        try:
+            return calendar.timegm(time.strptime(day, "%Y-%m-%d")) + 2 * 24 * 60 * 60
+        except ValueError:
+            return float("inf")
@@ -1,183 +1,457 @@
+import itertools
 import logging
-import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import requests
 from slack_sdk.errors import SlackApiError
-from slack_sdk import WebClient
 
+from src.controller.channel_pipeline import ChannelPipeline
+from src.controller.history_spool import history_oldest_first
 from src.util.settings_parser import SettingsParser
 
 
 class SlackLoadMessages:
-    REQUEST_TIME_OUT = 408
-    RATE_LIMITED_STATUS_CODE = 429
-    CREATED = 201
     OK = 200
+    # First history window read after a channel watermark, see history_oldest_first
+    HISTORY_WINDOW_SECONDS = 24 * 60 * 60
 
-    def __init__(self, web_client, config_service, messages_service, mattermost_upload_messages):
+    def __init__(self, web_client, config_service, messages_service, mattermost_upload_messages,
+                 slack_async_load_messages, slack_rate_limiter, checkpoint_writer, state_store,
+                 mattermost_bulk_import, slack_export_source, migration_metrics):
         settings = SettingsParser()
 
         self._logger_bot = logging.getLogger("")
         self._channels_list = {}
         self._users_list = []
-        self._web_client = WebClient(settings.slack_bot_token)
-        self._slack_token = settings.slack_bot_token
+        self._web_client = web_client.slack_web_client
         self._config_service = config_service
         self._messages_service = messages_service
         self._mattermost_upload_messages = mattermost_upload_messages
+        self._mattermost_bulk_import = mattermost_bulk_import
+        self._mattermost_sink = settings.mattermost_sink
+        # Where transformed messages go: the Mattermost API, or a bulk import archive
+        if self._mattermost_sink == "bulk_import":
+            self._sink = mattermost_bulk_import
+        else:
+            self._sink = mattermost_upload_messages
+        self._export_checkpoints = {}
         self._messages_per_page = 100
         self._channel_filter = []
-
-    def load_channel_messages(self):
-
+        self._channels_concurrency = settings.channels_concurrency
+        self._thread_executor = ThreadPoolExecutor(max_workers=settings.slack_thread_concurrency,
+                                                   thread_name_prefix="thread")
+        self._thread_lookback = settings.slack_thread_lookback_days * 24 * 60 * 60
+        self._thread_recheck = settings.slack_thread_recheck_days * 24 * 60 * 60
+        self._pipeline_queue_size = settings.pipeline_queue_size
+        self._slack_backend = settings.slack_backend
+        self._async_load_messages = slack_async_load_messages
+        self._slack_source = settings.slack_source
+        self._export_source = slack_export_source
+        self._rate_limiter = slack_rate_limiter
+        self._checkpoint_writer = checkpoint_writer
+        self._state_store = state_store
+        self._metrics = migration_metrics
+        # Pipeline stats summed over the channels migrated by this loader
+        self._pipeline_stats = {}
+        self._stats_lock = threading.Lock()
+
+    def load_channel_messages(self, job=None):
+        self.start()
+        try:
+            self._load_channel_messages(job)
+        finally:
+            self.stop()
+
+    def start(self):
+        if self._slack_source == "export":
+            self._export_source.open()
+        elif self._slack_backend == "async":
+            self._async_load_messages.start()
+        self._checkpoint_writer.start()
+
+    def stop(self):
+        self._checkpoint_writer.close()
+        if self._slack_source == "export":
+            self._export_source.close()
+        elif self._slack_backend == "async":
+            self._async_load_messages.stop()
+
+    def select_channels(self) -> list:
+        """Loads Slack channels and users and returns the channels selected for migration."""
         self.load_channels()
         self.load_users()
         self._messages_service.set_users_list(self._users_list)
         self._messages_service.set_channels_list(self._channels_list)
+        return [channel_item for channel_item in self._channels_list.values()
+                if self._is_selected_channel(channel_item["name"])
+                and self._config_service.is_allowed_channel(channel_item["name"])]
+
+    def get_workspace(self, selected_channels: list) -> dict:
+        """The channels and users loaded by select_channels, for set_workspace of another process."""
+        return {"channels": self._channels_list, "users": self._users_list,
+                "selected": [channel_item["id"] for channel_item in selected_channels]}
+
+    def set_workspace(self, workspace: dict) -> list:
+        """Takes the channels and users of get_workspace instead of loading them, returns the selected channels."""
+        channels = {}
+        for channel_id, channel_item in workspace["channels"].items():
+            channels[channel_id] = dict(channel_item)
+            if "members" in channel_item:
+                channels[channel_id]["members"] = frozenset(channel_item["members"])
+        self.set_channels_list(channels)
+        self.set_users_list(workspace["users"])
+        self._messages_service.set_users_list(self._users_list)
+        self._messages_service.set_channels_list(self._channels_list)
+        return [channels[channel_id] for channel_id in workspace["selected"]]
+
+    def migrate_channel(self, channel_item: dict, job=None) -> bool:
+        """Migrates one selected channel, returns False if the job was cancelled or stopped it."""
+        return self._load_messages_from_channel(channel_item, job)
+
+    def get_pipeline_stats(self) -> dict:
+        """Messages and busy seconds of each pipeline stage, summed over the channels migrated so far."""
+        with self._stats_lock:
+            return dict(self._pipeline_stats)
+
+    def _load_channel_messages(self, job=None):
+        selected_channels = self.select_channels()
         self._logger_bot.info("Loading messages from public and private channels")
-        for channel_id, channel_item in self._channels_list.items():
-            if self._is_selected_channel(channel_item["name"]) and self._config_service.is_allowed_channel(
-                    channel_item["name"]):
-                oldest_date = self._config_service.get_last_synchronize_date_unix(channel_name=channel_item["name"])
-                new_start_date = oldest_date
-                self._logger_bot.info("Start loading messages from channel %s, from date - %d", channel_item["name"],
-                                      oldest_date)
-                cursor = None
-
-                messages = []
-                while True:
-                    try:
-                        max_retries = 3
-                        retry_count = 0
-
-                        while retry_count < max_retries:
-                            self._logger_bot.info(
-                                "Starting request to Slack (conversations_history). %d times repeated",
-                                retry_count)
-                            response = self._web_client.conversations_history(
-                                channel=channel_item["id"],
-                                limit=self._messages_per_page,
-                                oldest=oldest_date + 1,
-                                cursor=cursor
-                            )
-                            response_code = response.status_code
-
-                            if response_code == self.OK:
-                                message_for_sort = response["messages"]
-                                message_for_sort = reversed(message_for_sort)
-                                messages.extend(message_for_sort)
-                                break
-                            else:
-                                retry_count += 1
-                                time.sleep(2)
-                        if retry_count == max_retries:
-                            raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                                response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-                        if response["has_more"]:
-                            cursor = response["response_metadata"]["next_cursor"]
-                        else:
-                            break
-                    except SlackApiError as e:
-                        self._logger_bot.error(
-                            f"SlackAPIError (conversations_history): {e.response['error']}")
-                        break
-
-                self._logger_bot.info("Selected %d messages from Slack channel %s", len(messages),
-                                      channel_item["name"])
-
-                for message in messages:
-                    message["is_thread"] = False
-                    if "reply_users" in message:
-                        message["reply"] = self._load_threads(channel_id=channel_item["id"], oldest_date=oldest_date,
-                                                              ts_of_parent_message=message["ts"])
-                        message["is_thread"] = True
-                    message["channel"] = channel_item["id"]
-                    if new_start_date < float(message["ts"]):
-                        new_start_date = float(message["ts"])
-
-                    files_list = []
-                    message["is_attached"] = False
+        self._logger_bot.info("Migrating %d channels, %d at once", len(selected_channels),
+                              self._channels_concurrency)
+        if job is not None:
+            job.set_channels_total(len(selected_channels))
+
+        if self._mattermost_sink == "bulk_import":
+            self._export_checkpoints = {}
+            self._mattermost_bulk_import.open(selected_channels, self._users_list)
+
+        failed_channels = []
+        with ThreadPoolExecutor(max_workers=self._channels_concurrency,
+                                thread_name_prefix="channel") as executor:
+            futures = {executor.submit(self._load_messages_from_channel, channel_item, job): channel_item
+                       for channel_item in selected_channels}
+            for future in as_completed(futures):
+                channel_item = futures[future]
+                try:
+                    migrated = future.result()
+                except Exception as err:
+                    failed_channels.append(channel_item["name"])
+                    self._logger_bot.exception("Migration of channel %s failed: %s", channel_item["name"], err)
+                    if job is not None:
+                        job.add_channel(failed=True)
+                    continue
+                if job is not None and migrated:
+                    job.add_channel()
+
+        if failed_channels:
+            self._logger_bot.error("Channels migrated with errors (%d): %s", len(failed_channels),
+                                   ", ".join(failed_channels))
+
+        if self._mattermost_sink == "bulk_import":
+            self._mattermost_bulk_import.close()
+            # Only now the exported messages are safe, so checkpoints move once the archive is complete
+            for channel_item, last_ts in self._export_checkpoints.values():
+                self._checkpoint_writer.set_last_synchronize_date_unix(last_ts, channel_name=channel_item["name"],
+                                                                       channel_id=channel_item["id"])
+
+    def _load_messages_from_channel(self, channel_item: dict, job=None) -> bool:
+        if job is not None and job.is_cancel_requested():
+            # Cancellation takes effect at a channel boundary, channels in progress are finished
+            self._logger_bot.info("Channel %s skipped, migration job %s is cancelled", channel_item["name"],
+                                  job.job_id)
+            return False
+        oldest_date = self._get_last_synchronize_date_unix(channel_item)
+        checkpoint = {"last_ts": oldest_date, "blocked": False}
+        self._logger_bot.info("Start loading messages from channel %s, from date - %d", channel_item["name"],
+                              oldest_date)
+
+        # Threads started before the checkpoint can still get replies, so a while before it is read again.
+        # Their parents come with latest_reply, only threads that moved on since the last run are fetched,
+        # and messages that are already delivered are skipped on upload.
+        history_oldest = max(0.0, oldest_date - self._thread_lookback) if oldest_date > 0 else oldest_date
+        # Slack lists history newest first, so pages can only be handed on oldest first once a whole window
+        # of it is read. A channel that was migrated before is read in short windows from its watermark,
+        # which lets uploads start after the first one. On the first migration of a channel its whole
+        # history is one window and uploads overlap only with the loading of threads and files.
+        window_seconds = self.HISTORY_WINDOW_SECONDS if self._has_channel_watermark(channel_item) else None
+
+        # Messages come oldest first, so the watermark only ever covers a contiguous run of delivered ones
+        def message_done(message: dict, delivered: bool):
+            if not delivered:
+                # Later messages are still posted, but the watermark stays before this one so the next
+                # run picks it up again; everything delivered meanwhile is skipped then.
+                if not checkpoint["blocked"]:
+                    self._logger_bot.error("Message %s of channel %s was not delivered, channel checkpoint "
+                                           "stays at %s", message["ts"], channel_item["name"], checkpoint["last_ts"])
+                checkpoint["blocked"] = True
+            if delivered and job is not None:
+                job.add_message()
+            if delivered and message.get("thread_latest_reply") and self._mattermost_sink == "rest":
+                self._state_store.set_thread_latest_reply(channel_item["id"], message["ts"],
+                                                          message["thread_latest_reply"])
+            if checkpoint["blocked"]:
+                return
+            if checkpoint["last_ts"] < float(message["ts"]):
+                checkpoint["last_ts"] = float(message["ts"])
+            if self._mattermost_sink == "rest":
+                self._checkpoint_writer.set_last_synchronize_date_unix(checkpoint["last_ts"],
+                                                                       channel_name=channel_item["name"],
+                                                                       channel_id=channel_item["id"])
+
+        if self._slack_source == "export":
+            pages = (self._prepare_export_page(page, channel_item=channel_item)
+                     for page in self._export_source.load_history_pages(channel_item, history_oldest,
+                                                                        self._messages_per_page))
+        elif self._slack_backend == "async":
+            thread_pages = (self._async_load_messages.prepare_page(page, channel_item, self._sink.get_delivered,
+                                                                   self._get_threads_to_load)
+                            for page in self._load_moved_thread_pages(channel_item, history_oldest))
+            pages = itertools.chain(thread_pages,
+                                    self._async_load_messages.load_prepared_pages(channel_item, history_oldest,
+                                                                                  self._sink.get_delivered,
+                                                                                  self._get_threads_to_load,
+                                                                                  window_seconds=window_seconds))
+        else:
+            pages = (self._prepare_page(page, channel_item=channel_item)
+                     for page in itertools.chain(self._load_moved_thread_pages(channel_item, history_oldest),
+                                                 self._load_history_pages(channel_item, history_oldest,
+                                                                          window_seconds)))
+
+        self._sink.reconcile_channel(channel_item["id"], channel_item["name"])
+        pipeline = ChannelPipeline(channel_name=channel_item["name"],
+                                   pages=pages,
+                                   prepare_message=None,
+                                   transform_message=self._messages_service.transform_message,
+                                   upload_message=self._sink.upload_messages,
+                                   message_done=message_done,
+                                   queue_size=self._pipeline_queue_size,
+                                   page_size=self._messages_per_page,
+                                   prefetch_message=self._sink.prefetch_files,
+                                   transform_page=self._messages_service.transform_page,
+                                   migration_metrics=self._metrics,
+                                   stop_event=job.stop_event if job is not None else None)
+        pipeline.run()
+        with self._stats_lock:
+            for name, value in pipeline.stats.items():
+                self._pipeline_stats[name] = self._pipeline_stats.get(name, 0) + value
+        if pipeline.stopped:
+            self._logger_bot.info("Loading messages from channel %s stopped", channel_item["name"])
+            return False
+        if self._mattermost_sink == "bulk_import":
+            self._export_checkpoints[channel_item["id"]] = (channel_item, checkpoint["last_ts"])
+
+        self._logger_bot.info("Finished loading messages from channel %s", channel_item["name"])
+        return True
+
+    def _has_channel_watermark(self, channel_item: dict) -> bool:
+        return channel_item["name"] in self._config_service.get_config().last_datetime_synchronize \
+            or self._state_store.get_channel_watermark(channel_item["id"]) is not None
+
+    def _get_last_synchronize_date_unix(self, channel_item: dict) -> float:
+        # A date stored for the channel in the config wins, so /set_date keeps working. The state store
+        # covers channels whose entry is missing from the config, e.g. after the file was recreated.
+        if channel_item["name"] not in self._config_service.get_config().last_datetime_synchronize:
+            last_ts = self._state_store.get_channel_watermark(channel_item["id"])
+            if last_ts is not None:
+                return last_ts
+        return self._config_service.get_last_synchronize_date_unix(channel_name=channel_item["name"])
+
+    def _load_history_pages(self, channel_item: dict, oldest_date: float, window_seconds=None):
+        """Yields the channel's history pages oldest first, see history_oldest_first for window_seconds.
+
+        Slack answers newest first, and handing pages on as they come would post them out of order and
+        move the checkpoint past older pages that are not posted yet.
+        """
+        def load_page(oldest: str, latest, cursor):
+            return self._load_history_page(channel_item, oldest, latest, cursor)
+
+        return history_oldest_first(load_page, oldest_date + 1, window_seconds)
+
+    def _load_history_page(self, channel_item: dict, oldest: str, latest, cursor) -> tuple:
+        try:
+            response = self._rate_limiter.call("conversations_history",
+                                               self._web_client.conversations_history,
+                                               channel=channel_item["id"],
+                                               limit=self._messages_per_page,
+                                               oldest=oldest,
+                                               latest=latest,
+                                               cursor=cursor)
+        except SlackApiError as e:
+            # Without the older pages the newer ones cannot be posted in order, the next run reads
+            # the channel again
+            self._logger_bot.error(
+                f"SlackAPIError (conversations_history): {e.response['error']}")
+            return None, None
+
+        self._logger_bot.info("Selected %d messages from Slack channel %s", len(response["messages"]),
+                              channel_item["name"])
+        next_cursor = response["response_metadata"]["next_cursor"] if response["has_more"] else None
+        return response["messages"], next_cursor
+
+    def _load_moved_thread_pages(self, channel_item: dict, history_oldest: float):
+        """Yields pages of the thread parents before history_oldest that got replies since they were migrated.
+
+        The history read from history_oldest on does not list them, so the threads the state store knows
+        are looked up one by one, leaving out those without replies in the last slack_thread_recheck_days.
+        """
+        if self._mattermost_sink != "rest" or history_oldest <= 0:
+            return
+        replied_since = time.time() - self._thread_recheck if self._thread_recheck else 0
+        # The history is read from after history_oldest + 1, see _load_history_pages
+        known_threads = self._state_store.get_thread_latest_replies(channel_item["id"], history_oldest + 1,
+                                                                     replied_since)
+        thread_ts_list = list(known_threads)
+        if thread_ts_list:
+            self._logger_bot.info("Looking up %d earlier threads of channel %s for new replies",
+                                  len(thread_ts_list), channel_item["name"])
+        for start in range(0, len(thread_ts_list), self._messages_per_page):
+            chunk = thread_ts_list[start:start + self._messages_per_page]
+            if self._slack_backend == "async":
+                parents = self._async_load_messages.load_thread_parents(channel_item, chunk)
+            else:
+                parents = list(self._thread_executor.map(
+                    lambda thread_ts: self._load_thread_parent(channel_item["id"], thread_ts), chunk))
+            page = [parent for parent in parents if parent is not None
+                    and float(parent.get("latest_reply", 0)) > float(known_threads[parent["ts"]])]
+            if page:
+                yield page
+
+    def _load_thread_parent(self, channel_id: str, thread_ts: str):
+        try:
+            response = self._rate_limiter.call("conversations_replies", self._web_client.conversations_replies,
+                                               channel=channel_id, ts=thread_ts, limit=1)
+        except SlackApiError as e:
+            self._logger_bot.error(f"SlackAPIError (conversations_replies): {e.response['error']}")
+            return None
+        # The parent comes first
+        return response["messages"][0] if response["messages"] else None
+
+    def _prepare_page(self, page: list, channel_item: dict) -> list:
+        threads = {ts: self._thread_executor.submit(self._load_threads, channel_id=channel_item["id"],
+                                                    ts_of_parent_message=ts, oldest=oldest)
+                   for ts, oldest in self._get_threads_to_load(channel_item["id"], page).items()}
+        prepared_page = []
+        for message in page:
+            reply_messages = threads[message["ts"]].result() if message["ts"] in threads else None
+            prepared_page.append(self._prepare_message(message, channel_item=channel_item,
+                                                       reply_messages=reply_messages,
+                                                       thread_failed=message["ts"] in threads
+                                                       and reply_messages is None))
+        return prepared_page
+
+    def _prepare_export_page(self, page: list, channel_item: dict) -> list:
+        threads = {ts: self._prepare_replies(channel_item["id"],
+                                             self._export_source.load_thread_replies(channel_item, ts, oldest))
+                   for ts, oldest in self._get_threads_to_load(channel_item["id"], page).items()}
+        return [self._prepare_message(message, channel_item=channel_item, reply_messages=threads.get(message["ts"]))
+                for message in page]
+
+    def _get_threads_to_load(self, channel_id: str, page: list) -> dict:
+        """Maps the ts of each thread parent with unseen replies to the ts to read its replies from."""
+        threads = {}
+        for message in page:
+            if "reply_users" not in message:
+                continue
+            known_latest_reply = self._state_store.get_thread_latest_reply(channel_id, message["ts"])
+            if known_latest_reply is None:
+                threads[message["ts"]] = None
+            elif float(message.get("latest_reply", 0)) > float(known_latest_reply):
+                threads[message["ts"]] = known_latest_reply
+        return threads
+
+    def _prepare_message(self, message: dict, channel_item: dict, reply_messages, thread_failed=False) -> dict:
+        message["is_thread"] = False
+        if thread_failed:
+            # Posted alone, the parent would let the checkpoint move past replies that were never read.
+            # The pipeline reports it undelivered instead, which keeps the watermark before it.
+            message["channel"] = channel_item["id"]
+            message["load_failed"] = True
+            return message
+        if reply_messages is not None:
+            message["reply"] = reply_messages
+            message["is_thread"] = True
+            message["thread_latest_reply"] = message.get("latest_reply")
+        message["channel"] = channel_item["id"]
+
+        message["is_attached"] = False
+        if self._sink.is_delivered(channel_item["id"], message["ts"]):
+            # Already posted by an earlier run, its files are not relayed again
+            message.pop("files", None)
+            return message
+        if "files" in message:
+            message["files"] = self._collect_files(message["files"])
+            message["is_attached"] = True
+        if "attachments" in message:
+            attachments = message["attachments"]
+            for attachment in attachments:
+                if "files" in attachment:
+                    files_list = self._collect_files(attachment["files"])
+                    message["is_attached"] = True
                     if "files" in message:
-                        files_list = self._download_files(message["files"])
-                        message["is_attached"] = True
+                        message["files"].extend(files_list)
+                    else:
                         message["files"] = files_list
-                    if "attachments" in message:
-                        attachments = message["attachments"]
-                        for attachment in attachments:
-                            if "files" in attachment:
-                                files_list = self._download_files(attachment["files"])
-                                message["is_attached"] = True
-                                if "files" in message:
-                                    message["files"].append(files_list)
-                                else:
-                                    message["files"] = files_list
-
-                    self._messages_service.save_messages_to_dict(message)
-                    if message["is_thread"]:
-                        for reply_message in message["reply"]:
-                            if "files" in reply_message and reply_message["files"]:
-                                files_list.extend(reply_message["files"])
-
-                    if files_list:
-                        for files in files_list:
-                            if os.path.exists(files["file_path"]):
-                                os.remove(files["file_path"])
-                                self._logger_bot.info("Deleted file %s from %s", files["file_name"],
-                                                      files["file_path"])
-
-                    self._config_service.set_last_synchronize_date_unix(new_start_date,
-                                                                        channel_name=channel_item["name"])
-
-    def _load_threads(self, channel_id, ts_of_parent_message, oldest_date) -> list:
-        try:
-            response = self._web_client.conversations_replies(
-                channel=channel_id,
-                ts=ts_of_parent_message,
-                oldest=oldest_date + 1
-            )
+        return message
 
-            reply_messages = response["messages"][1:]
+    def _load_threads(self, channel_id, ts_of_parent_message, oldest):
+        reply_messages = []
+        cursor = None
+        try:
+            while True:
+                response = self._rate_limiter.call("conversations_replies", self._web_client.conversations_replies,
+                                                   channel=channel_id,
+                                                   ts=ts_of_parent_message,
+                                                   oldest=oldest,
+                                                   limit=self._messages_per_page,
+                                                   cursor=cursor)
+                # The parent comes first on the first page only
+                reply_messages.extend(reply for reply in response["messages"]
+                                      if reply["ts"] != ts_of_parent_message)
+                if not response.get("has_more"):
+                    break
+                cursor = response["response_metadata"]["next_cursor"]
             self._logger_bot.info("Thread (%d messages) loaded", len(reply_messages))
         except SlackApiError as e:
             self._logger_bot.error(f"SlackAPIError (conversations_replies): {e.response['error']}")
-            return []
+            return None
+        return self._prepare_replies(channel_id, reply_messages)
+
+    def _prepare_replies(self, channel_id: str, reply_messages: list) -> list:
         thread_messages = []
         for reply in reply_messages:
+            if "files" in reply and self._sink.is_delivered(channel_id, reply["ts"]):
+                del reply["files"]
             if "files" in reply:
-                files_list = self._download_files(reply["files"])
+                files_list = self._collect_files(reply["files"])
                 reply["files"] = files_list
             thread_messages.append(reply)
 
         return thread_messages
 
     def load_users(self):
-        try:
-
-            max_retries = 3
-            retry_count = 0
-            user_list = []
-            while retry_count < max_retries:
-                self._logger_bot.info("Starting request to Slack (users). %d times repeated",
-                                      retry_count)
-
-                response = self._web_client.users_list()
-
-                response_code = response.status_code
+        if self._slack_source == "export":
+            user_list = self._export_source.load_users_list()
+        elif self._slack_backend == "async":
+            user_list = self._async_load_messages.load_users_list()
+        else:
+            user_list = self._load_users_list()
+            if user_list is None:
+                return
 
-                if response_code == self.OK:
-                    user_list = response["members"]
-                    break
-                else:
-                    retry_count += 1
-                    time.sleep(5)
-            if retry_count == max_retries:
-                raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                    response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
+        users = self._users_to_dict(user_list)
+        self._logger_bot.info("Slack users loaded (%d)", len(users))
+        self.set_users_list(users)
 
+    def _load_users_list(self):
+        try:
+            response = self._rate_limiter.call("users_list", self._web_client.users_list)
         except SlackApiError as e:
             self._logger_bot.error(f"SlackAPIError (users_list): {e.response['error']}")
-            return
+            return None
+        return response["members"]
+
+    def _users_to_dict(self, user_list: list) -> dict:
         users = {}
         for user in user_list:
             user_id = user.get("id")
@@ -195,121 +469,50 @@ class SlackLoadMessages:
             users[user["id"]] = {"id": user_id, "name": user_name, "email": user_email, "is_bot": user_is_bot,
                                  "is_deleted": user_is_deleted, "first_name": user_first_name,
                                  "last_name": user_last_name, "display_name": user_display_name}
-
-        self._logger_bot.info("Slack users loaded (%d)", len(users))
-        self.set_users_list(users)
+        return users
 
     def load_channels(self):
+        if self._slack_source == "export":
+            channels_list = self._export_source.load_channels_list()
+            channels_users_list = self._export_source.load_direct_channels_list()
+            self._logger_bot.info("Slack channels loaded from export (%d, %d direct)", len(channels_list),
+                                  len(channels_users_list))
+            self._set_channels(channels_list, channels_users_list)
+            # The export lists the members of every channel, no API calls are needed
+            for channel in channels_list + channels_users_list:
+                self._set_channels_members(channel["id"], channel.get("members") or [])
+            return
 
         try:
-
-            max_retries = 3
-            retry_count = 0
-            channels_list = []
-            while retry_count < max_retries:
-                self._logger_bot.info("Starting request to Slack (channels). %d times repeated",
-                                      retry_count)
-
-                response = self._web_client.conversations_list(types="public_channel,private_channel",
-                                                               limit=self._messages_per_page)
-                response_code = response.status_code
-                if response_code == self.OK:
-
-                    channels_list = response["channels"]
-                    self._logger_bot.info("Loaded %s channels", len(response["channels"]))
-                    break
-                else:
-                    retry_count += 1
-                    time.sleep(5)
-
-            if retry_count == max_retries:
-                raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                    response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-
-            next_cursor = response["response_metadata"]["next_cursor"]
-
-            while next_cursor:
-                max_retries = 3
-                retry_count = 0
-                while retry_count < max_retries:
-                    self._logger_bot.info("Starting request to Slack (channels). %d times repeated",
-                                          retry_count)
-                    response = self._web_client.conversations_list(types="public_channel,private_channel",
-                                                                   limit=self._messages_per_page, cursor=next_cursor)
-                    response_code = response.status_code
-                    if response_code == self.OK:
-
-                        channels_list.extend(response["channels"])
-                        self._logger_bot.info("Loaded %s channels", len(response["channels"]))
-                        next_cursor = response["response_metadata"]["next_cursor"]
-                        self._logger_bot.info("Slack channels loaded (%d)", len(channels_list))
-                        break
-                    else:
-                        retry_count += 1
-                        time.sleep(5)
-
-                    if retry_count == max_retries:
-                        raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                            response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-
+            channels_list = self._load_conversations_list(types="public_channel,private_channel")
+            self._logger_bot.info("Slack channels loaded (%d)", len(channels_list))
         except SlackApiError as e:
             self._logger_bot.error(f"SlackAPIError (conversations_list types=public_channel,private_channel): "
                                    f"{e.response['error']}")
             return
 
         try:
-
-            max_retries = 3
-            retry_count = 0
-            channels_users_list = []
-            while retry_count < max_retries:
-                self._logger_bot.info("Starting request to Slack (dm-channels). %d times repeated",
-                                      retry_count)
-
-                response = self._web_client.conversations_list(limit=self._messages_per_page, types="im,mpim")
-                response_code = response.status_code
-                if response_code == self.OK:
-                    channels_users_list = response["channels"]
-                    next_cursor = response["response_metadata"]["next_cursor"]
-                    break
-                else:
-                    retry_count += 1
-                    time.sleep(5)
-
-            if retry_count == max_retries:
-                raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                    response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-
-            while next_cursor:
-                max_retries = 3
-                retry_count = 0
-                channels_users_list = []
-                while retry_count < max_retries:
-                    self._logger_bot.info("Starting request to Slack (dm-channels). %d times repeated",
-                                          retry_count)
-
-                    response_code = response.status_code
-                    if response_code == self.OK:
-
-                        response = self._web_client.conversations_list(types="im,mpim",
-                                                                       limit=self._messages_per_page,
-                                                                       cursor=next_cursor)
-                        channels_users_list.extend(response["channels"])
-                        next_cursor = response["response_metadata"]["next_cursor"]
-                        break
-                    else:
-                        retry_count += 1
-                        time.sleep(5)
-
-                if retry_count == max_retries:
-                    raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                        response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-
+            channels_users_list = self._load_conversations_list(types="im,mpim")
             self._logger_bot.info("Slack direct messages channels loaded (%d)", len(channels_users_list))
         except SlackApiError as e:
             self._logger_bot.error(f"SlackAPIError (conversations_list types=im,mpim): {e.response['error']}")
             return
 
+        channels = self._set_channels(channels_list, channels_users_list)
+
+        selected_channels = [channel for channel in channels
+                             if self._is_selected_channel(self._get_channel(channel)["name"])
+                             and self._config_service.is_allowed_channel(self._get_channel(channel)["name"])]
+        if self._slack_backend == "async":
+            members_by_channel = self._async_load_messages.load_channels_members(selected_channels)
+            for channel, members in members_by_channel.items():
+                self._set_channels_members(channel, members)
+        else:
+            for channel in selected_channels:
+                members = self._load_channel_members(channel)
+                self._set_channels_members(channel, members)
+
+    def _set_channels(self, channels_list: list, channels_users_list: list) -> dict:
         channels = {}
         for channel in channels_list:
             channel_id = channel["id"]
@@ -330,68 +533,33 @@ class SlackLoadMessages:
             channels[channel["id"]] = {"id": channel_id, "name": channel_name, "type": channel_type}
 
         self.set_channels_list(channels)
-
-        for channel in channels:
-            if self._is_selected_channel(self._get_channel(channel)["name"]) \
-                    and self._config_service.is_allowed_channel(self._get_channel(channel)["name"]):
-                members = self._load_channel_members(channel)
-                self._set_channels_members(channel, members)
+        return channels
+
+    def _load_conversations_list(self, types: str) -> list:
+        channels_list = []
+        cursor = None
+        while True:
+            response = self._rate_limiter.call("conversations_list", self._web_client.conversations_list,
+                                               types=types, limit=self._messages_per_page, cursor=cursor)
+            channels_list.extend(response["channels"])
+            self._logger_bot.info("Loaded %s channels", len(response["channels"]))
+            cursor = response["response_metadata"]["next_cursor"]
+            if not cursor:
+                return channels_list
 
     def _load_channel_members(self, channel_id: str) -> list:
-
+        members_list = []
+        cursor = None
         try:
-
-            max_retries = 3
-            retry_count = 0
-            members_list = []
-            while retry_count < max_retries:
-                self._logger_bot.info("Starting request to Slack (channels/members). %d times repeated",
-                                      retry_count)
-
-                response = self._web_client.conversations_members(channel=channel_id,
-                                                                  limit=self._messages_per_page)
-                response_code = response.status_code
-                if response_code == self.OK:
-
-                    members_list = response["members"]
-                    self._logger_bot.info("Loaded %s members for channel %s", len(response["members"]),
-                                          self._get_channel(channel_id)["name"])
+            while True:
+                response = self._rate_limiter.call("conversations_members", self._web_client.conversations_members,
+                                                   channel=channel_id, limit=self._messages_per_page, cursor=cursor)
+                members_list.extend(response["members"])
+                self._logger_bot.info("Loaded %s members for channel %s", len(response["members"]),
+                                      self._get_channel(channel_id)["name"])
+                cursor = response["response_metadata"]["next_cursor"]
+                if not cursor:
                     break
-                else:
-                    retry_count += 1
-                    time.sleep(5)
-
-            if retry_count == max_retries:
-                raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                    response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-
-            next_cursor = response["response_metadata"]["next_cursor"]
-
-            while next_cursor:
-                max_retries = 3
-                retry_count = 0
-                while retry_count < max_retries:
-                    self._logger_bot.info("Starting request to Slack (channels|members). "
-                                          "%d times repeated",
-                                          retry_count)
-                    response = self._web_client.conversations_members(channel=channel_id,
-                                                                      limit=self._messages_per_page, cursor=next_cursor)
-                    response_code = response.status_code
-                    if response_code == self.OK:
-
-                        members_list.extend(response["members"])
-                        self._logger_bot.info("Loaded %s members for channel %s", len(response["members"]),
-                                              self._get_channel(channel_id)["name"])
-                        next_cursor = response["response_metadata"]["next_cursor"]
-                        break
-                    else:
-                        retry_count += 1
-                        time.sleep(5)
-
-                    if retry_count == max_retries:
-                        raise SlackApiError(message=f'Timeout after {retry_count} retries',
-                                            response={"error": f' Timeout error, {self.REQUEST_TIME_OUT}'})
-
         except SlackApiError as e:
             self._logger_bot.error(f"SlackAPIError (conversations_members): "
                                    f"{e.response['error']}")
@@ -399,17 +567,14 @@ class SlackLoadMessages:
         return members_list
 
     def _set_channels_members(self, channel_id: str, members: list):
-        channels = self._channels_list
-        i = 0
-        for key, channel in channels.items():
-            if channel["id"] == channel_id:
-                self._channels_list[key]["members"] = members
-                break
-            i += 1
+        if channel_id in self._channels_list:
+            self._channels_list[channel_id]["members"] = frozenset(members)
 
     def set_channel_filter(self, channel_filter: str):
         if len(channel_filter) != 0 and channel_filter != "all":
             self._channel_filter = channel_filter.split(" ")
+        else:
+            self._channel_filter = []
 
     def _is_selected_channel(self, channel_name) -> bool:
         is_channel_selected = False
@@ -421,36 +586,18 @@ class SlackLoadMessages:
 
         return is_channel_selected
 
-    def _download_files(self, files_attach: list) -> list:
+    def _collect_files(self, files_attach: list) -> list:
+        # Files are relayed to Mattermost at upload time, here only what the relay needs is kept
         files_list = []
         for files in files_attach:
             if "url_private_download" not in files:
                 break
-            self._logger_bot.info(f'{files["name"]} is downloading')
-            response_file = requests.get(files["url_private_download"],
-                                         headers={
-                                             'Authorization': 'Bearer %s' % self._slack_token})
-            if response_file.status_code == 200:
-                local_file_path = os.environ.get('WORKDIR') + "/" + files["name"]
-
-                try:
-                    with open(local_file_path, "wb") as local_file:
-                        for chunk in response_file.iter_content(chunk_size=8192):
-                            local_file.write(chunk)
-                    self._logger_bot.info(
-                        f'File {files["name"]} is downloaded to {local_file_path}')
-                except Exception:
-                    self._logger_bot.error("Error in downloading as local file")
-
-                files_dict = {
-                    "file_name": files["name"],
-                    "link": files["url_private_download"],
-                    "user_id": files["user"],
-                    "file_path": local_file_path}
-                files_list.append(files_dict)
-                self._logger_bot.info(f'{files["name"]} is downloaded from Slack')
-            else:
-                self._logger_bot.error(f'SlackAPIError (files): {response_file.json()}')
+            files_list.append({
+                "file_id": files["id"],
+                "file_name": files["name"],
+                "link": files["url_private_download"],
+                "user_id": files["user"],
+                "size": files.get("size")})
         return files_list
 
     def set_channels_list(self, channels: dict):
@@ -460,7 +607,4 @@ class SlackLoadMessages:
         self._users_list = users
 
     def _get_channel(self, channel_id: str) -> dict:
-        for key, channel in self._channels_list.items():
-            if channel["id"] == channel_id:
-                return channel
-        return {}
+        return self._channels_list.get(channel_id, {})
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import threading
+import time
+
+from slack_sdk.errors import SlackApiError
+
+from src.util.settings_parser import SettingsParser
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: float):
+        self._rate = rate_per_minute / 60.0
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Takes one token and returns how many seconds the caller has to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self._rate
+            return max(wait, self._paused_until - now)
+
+    def pause(self, seconds: float):
+        """Holds back every caller of this bucket, used when Slack answers with Retry-After."""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = min(self._tokens, 0.0)
+            self._updated_at = now
+
+
+class SlackRateLimiter:
+    """Schedules every Slack Web API call against the method's tier budget.
+
+    Each method gets its own token bucket filled at its tier rate, so calls are
+    queued before Slack would reject them. A 429 answer pauses the method's
+    bucket for Retry-After seconds and the call is repeated instead of failing.
+    Every attempt is reported to the migration metrics.
+    """
+
+    RATE_LIMITED_STATUS_CODE = 429
+
+    METHOD_TIERS = {
+        "users_list": 2,
+        "conversations_list": 2,
+        "conversations_history": 3,
+        "conversations_replies": 3,
+        "conversations_members": 4,
+    }
+    DEFAULT_TIER = 3
+
+    def __init__(self, migration_metrics):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._metrics = migration_metrics
+        self._tier_rates = settings.slack_tier_rates
+        self._max_retries = settings.slack_max_retries
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def set_tier_rates(self, tier_rates: dict):
+        """Replaces the requests per minute of each tier, e.g. with the share of a sharded run's worker."""
+        with self._lock:
+            self._tier_rates = dict(tier_rates)
+            self._buckets = {}
+
+    def call(self, method: str, function, **kwargs):
+        retry_count = 0
+        while True:
+            wait = self._get_bucket(method).reserve()
+            if wait > 0:
+                time.sleep(wait)
+            started = time.monotonic()
+            try:
+                response = function(**kwargs)
+            except SlackApiError as e:
+                self._observe(method, e.response.status_code, started)
+                self._pause_on_rate_limit(method, e, retry_count)
+            except Exception:
+                self._observe(method, "error", started)
+                raise
+            else:
+                self._observe(method, response.status_code, started)
+                return response
+            retry_count += 1
+
+    async def acall(self, method: str, function, **kwargs):
+        retry_count = 0
+        while True:
+            wait = self._get_bucket(method).reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            started = time.monotonic()
+            try:
+                response = await function(**kwargs)
+            except SlackApiError as e:
+                self._observe(method, e.response.status_code, started)
+                self._pause_on_rate_limit(method, e, retry_count)
+            except Exception:
+                self._observe(method, "error", started)
+                raise
+            else:
+                self._observe(method, response.status_code, started)
+                return response
+            retry_count += 1
+
+    def _observe(self, method: str, status, started: float):
+        self._metrics.observe_api_call("slack", method, status, time.monotonic() - started)
+
+    def _pause_on_rate_limit(self, method: str, error: SlackApiError, retry_count: int):
+        if error.response.status_code == self.RATE_LIMITED_STATUS_CODE:
+            self._metrics.count_rate_limited("slack", method)
+        if error.response.status_code != self.RATE_LIMITED_STATUS_CODE or retry_count >= self._max_retries:
+            raise error
+        self._metrics.count_retry("slack", method)
+        headers = {key.lower(): value for key, value in (error.response.headers or {}).items()}
+        retry_after = float(headers.get("retry-after", 1))
+        self._get_bucket(method).pause(retry_after)
+        self._logger_bot.info("Slack rate limit (%s), retrying in %d s. %d times repeated", method,
+                              retry_after, retry_count + 1)
+
+    def _get_bucket(self, method: str) -> TokenBucket:
+        bucket = self._buckets.get(method)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.get(method)
+                if bucket is None:
+                    rate = self._tier_rates[self.METHOD_TIERS.get(method, self.DEFAULT_TIER)]
+                    bucket = TokenBucket(rate_per_minute=rate, capacity=max(1.0, rate / 10))
+                    self._buckets[method] = bucket
+        return bucket
@@ -1,10 +1,9 @@
-from slack_sdk import WebClient
-
 from src.util.settings_parser import SettingsParser
 
 
 class SlackWebClient:
-    def __init__(self):
+    def __init__(self, http_cassette):
         settings = SettingsParser()
 
-        self.slack_web_client = WebClient(settings.slack_bot_token)
+        self.slack_web_client = http_cassette.create_slack_client(settings.slack_bot_token,
+                                                                     settings.slack_api_url)
@@ -0,0 +1,68 @@
+class UserProfile:
+    """Slack user as seen by the Mattermost sinks, one shared instance per user id."""
+
+    __slots__ = ("user_id", "user_name", "user_email", "user_is_bot", "user_first_name", "user_last_name",
+                 "user_is_deleted", "user_display_name")
+
+    def __init__(self, user_id: str, user: dict):
+        self.user_id = user_id
+        self.user_name = user.get("name")
+        self.user_email = user.get("email")
+        self.user_is_bot = user.get("is_bot")
+        self.user_first_name = user.get("first_name")
+        self.user_last_name = user.get("last_name")
+        self.user_is_deleted = user.get("is_deleted")
+        self.user_display_name = user.get("display_name")
+
+    def __repr__(self):
+        return f"UserProfile({', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)})"
+
+
+class ChannelInfo:
+    """Slack channel of a message, one shared instance per channel id."""
+
+    __slots__ = ("channel_id", "channel_name", "channel_type", "channel_members")
+
+    def __init__(self, channel_id: str, channel: dict):
+        self.channel_id = channel_id
+        self.channel_name = channel.get("name")
+        self.channel_type = channel.get("type")
+        self.channel_members = channel.get("members")
+
+    def __repr__(self):
+        return f"ChannelInfo(channel_id={self.channel_id!r}, channel_name={self.channel_name!r})"
+
+
+class ReplyRecord:
+    """Transformed thread reply, user and channel refer to the shared profiles."""
+
+    __slots__ = ("text", "user", "channel", "ts", "files")
+
+    is_attached = False
+    is_thread = True
+
+    def __init__(self, text: str, user: UserProfile, channel: ChannelInfo, ts: str, files=None):
+        self.text = text
+        self.user = user
+        self.channel = channel
+        self.ts = ts
+        self.files = files
+
+
+class MessageRecord:
+    """Transformed message as handed to the Mattermost sinks."""
+
+    __slots__ = ("text", "user", "channel", "ts", "is_attached", "is_thread", "files", "reply",
+                 "users_in_mentions")
+
+    def __init__(self, text: str, user: UserProfile, channel: ChannelInfo, ts: str, is_attached: bool,
+                 is_thread: bool):
+        self.text = text
+        self.user = user
+        self.channel = channel
+        self.ts = ts
+        self.is_attached = is_attached
+        self.is_thread = is_thread
+        self.files = None
+        self.reply = ()
+        self.users_in_mentions = ()
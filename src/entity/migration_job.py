@@ -0,0 +1,67 @@
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+
+
+@dataclass
+class MigrationJob:
+    job_id: str
+    channel_filter: str
+    state: str = "queued"
+    created_at: datetime = field(default_factory=datetime.now)
+    started_at: datetime = None
+    finished_at: datetime = None
+    channels_total: int = 0
+    channels_done: int = 0
+    channels_failed: int = 0
+    messages: int = 0
+    error: str = None
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+    # Unlike cancel_event, stops the channels in progress too, after the message being uploaded
+    stop_event: threading.Event = field(default_factory=threading.Event, repr=False, compare=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def is_active(self) -> bool:
+        return self.state in ("queued", "running")
+
+    def is_cancel_requested(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def is_stop_requested(self) -> bool:
+        return self.stop_event.is_set()
+
+    def set_channels_total(self, channels_total: int):
+        with self._lock:
+            self.channels_total = channels_total
+
+    def add_channel(self, failed: bool = False):
+        with self._lock:
+            self.channels_done += 1
+            if failed:
+                self.channels_failed += 1
+
+    def add_message(self):
+        with self._lock:
+            self.messages += 1
+
+    def set_progress(self, channels_done: int, channels_failed: int, messages: int):
+        with self._lock:
+            self.channels_done = channels_done
+            self.channels_failed = channels_failed
+            self.messages = messages
+
+    def describe(self) -> str:
+        with self._lock:
+            text = (f"Job {self.job_id} [{self.channel_filter}]: {self.state}, channels {self.channels_done}/"
+                    f"{self.channels_total}")
+            if self.channels_failed:
+                text += f" ({self.channels_failed} failed)"
+            text += f", messages {self.messages}"
+        if self.state == "running" and self.is_cancel_requested():
+            text += ", cancelling after the current channels"
+        if self.started_at is not None:
+            end = self.finished_at or datetime.now()
+            text += f", {int((end - self.started_at).total_seconds())}s"
+        if self.error:
+            text += f", error: {self.error}"
+        return text
@@ -0,0 +1,163 @@
+import atexit
+import contextlib
+import hashlib
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+from collections import OrderedDict
+
+from src.util.settings_parser import SettingsParser
+
+
+class AttachmentCache:
+    """Content-addressed store of Slack files in the blobs folder of attachment_cache_dir.
+
+    Each file is stored once under its SHA-256 and indexed by Slack file id, so a
+    file shared into several channels and threads is downloaded once per run.
+    The least recently used files are removed when the total size goes over
+    attachment_cache_bytes. A budget of 0 disables the cache.
+
+    Every process keeps its files in a folder of its own, named after the host
+    and pid like the owner of a channel lease, as the worker processes of a
+    sharded migration share attachment_cache_dir. The folder is removed at exit,
+    folders of processes of this host that are gone are removed at start.
+    """
+
+    BLOBS_DIR = "blobs"
+    TEMP_PREFIX = ".blob-"
+    DIGEST_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+    def __init__(self):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        # A folder of its own, attachment_cache_dir may well point at the WORKDIR
+        self._blobs_dir = os.path.join(settings.attachment_cache_dir, self.BLOBS_DIR)
+        self._host = socket.gethostname()
+        self._cache_dir = os.path.join(self._blobs_dir, f"{self._host}-{os.getpid()}")
+        self._budget = settings.attachment_cache_bytes
+        self._lock = threading.Lock()
+        self._file_locks = {}
+        self._index = {}
+        self._blobs = OrderedDict()
+        self._size = 0
+        if self.enabled:
+            self._remove_stale_folders()
+            self._clear(self._cache_dir)
+            os.makedirs(self._cache_dir, exist_ok=True)
+            atexit.register(self._remove_folder, self._cache_dir)
+
+    @property
+    def enabled(self) -> bool:
+        return self._budget > 0
+
+    def fits(self, size) -> bool:
+        return self.enabled and (size is None or size <= self._budget)
+
+    @contextlib.contextmanager
+    def file_lock(self, slack_file_id: str):
+        """Held while a file is being fetched, so concurrent requests for it wait for one download."""
+        with self._lock:
+            # The lock and the number of threads holding or waiting for it
+            entry = self._file_locks.setdefault(slack_file_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._file_locks[slack_file_id]
+
+    def open(self, slack_file_id: str):
+        """Returns the cached file opened for reading, or None."""
+        with self._lock:
+            digest = self._index.get(slack_file_id)
+            if digest is None or digest not in self._blobs:
+                return None
+            self._blobs.move_to_end(digest)
+            # The open handle stays readable even if the file is evicted meanwhile
+            return open(self._blob_path(digest), "rb")
+
+    def store(self, slack_file_id: str, chunks) -> bool:
+        """Writes the chunks to the cache. Returns False when they do not fit into the budget."""
+        digest = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(prefix=self.TEMP_PREFIX, dir=self._cache_dir,
+                                         delete=False) as temp_file:
+            try:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > self._budget:
+                        break
+                    digest.update(chunk)
+                    temp_file.write(chunk)
+            except BaseException:
+                os.remove(temp_file.name)
+                raise
+        if size > self._budget:
+            os.remove(temp_file.name)
+            return False
+
+        digest = digest.hexdigest()
+        with self._lock:
+            if digest in self._blobs:
+                os.remove(temp_file.name)
+            else:
+                os.replace(temp_file.name, self._blob_path(digest))
+                self._blobs[digest] = size
+                self._size += size
+            self._blobs.move_to_end(digest)
+            self._index[slack_file_id] = digest
+            self._evict()
+        return True
+
+    def _evict(self):
+        while self._size > self._budget and len(self._blobs) > 1:
+            digest, size = self._blobs.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError as err:
+                self._logger_bot.error(f"Attachment cache eviction failed: {err}")
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self._cache_dir, digest)
+
+    def _clear(self, folder: str):
+        # The index lives in memory, files left by an earlier run can not be found again. Only what the
+        # cache writes is removed, anything else put into its folder is left alone.
+        if not os.path.isdir(folder):
+            return
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and (self.DIGEST_PATTERN.fullmatch(entry.name)
+                                                             or entry.name.startswith(self.TEMP_PREFIX)):
+                    os.remove(entry.path)
+
+    def _remove_folder(self, folder: str):
+        try:
+            self._clear(folder)
+            os.rmdir(folder)
+        except OSError as err:
+            self._logger_bot.error(f"Attachment cache folder {folder} was not removed: {err}")
+
+    def _remove_stale_folders(self):
+        if not os.path.isdir(self._blobs_dir):
+            return
+        prefix = f"{self._host}-"
+        for name in os.listdir(self._blobs_dir):
+            pid = name[len(prefix):]
+            if not name.startswith(prefix) or not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                self._remove_folder(os.path.join(self._blobs_dir, name))
+            except OSError:
+                # Alive, but run by another user
+                pass
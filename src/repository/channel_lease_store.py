@@ -0,0 +1,174 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from src.util.settings_parser import SettingsParser
+
+
+class ChannelLeaseStore:
+    """SQLite store through which worker processes share out the channels of a sharded run.
+
+    A run lists its channels as pending; a worker claims one by taking a lease
+    that expires after lease_seconds unless it is renewed. Channels whose lease
+    expired, e.g. because the worker died, are claimed again by another worker.
+    Every change is committed at once, so all processes on the same volume see it.
+    A run also keeps what its workers share: each worker's Slack tier rates and
+    the Slack channels and users, which are loaded once when the run is created.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS lease_run ("
+        " run_id TEXT PRIMARY KEY, channel_filter TEXT NOT NULL, state TEXT NOT NULL, created_at REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS channel_lease ("
+        " run_id TEXT NOT NULL, slack_channel_id TEXT NOT NULL, channel_name TEXT NOT NULL,"
+        " state TEXT NOT NULL, owner TEXT, expires_at REAL NOT NULL DEFAULT 0,"
+        " attempts INTEGER NOT NULL DEFAULT 0, messages INTEGER NOT NULL DEFAULT 0,"
+        " PRIMARY KEY (run_id, slack_channel_id))",
+        "CREATE TABLE IF NOT EXISTS lease_run_setup ("
+        " run_id TEXT PRIMARY KEY, slack_tier_rates TEXT NOT NULL, workspace TEXT NOT NULL)",
+    )
+
+    def __init__(self):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._db_file = settings.lease_db_file
+        self._lease_seconds = settings.lease_seconds
+        self._max_attempts = settings.lease_max_attempts
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def create_run(self, run_id: str, channel_filter: str, channels: list, slack_tier_rates: dict, workspace: dict):
+        """Starts a run of the channels, cancelling the one running.
+
+        slack_tier_rates are the requests per minute of each worker by Slack tier, workspace is what
+        SlackLoadMessages.get_workspace returns; both are read back with get_run_setup.
+        """
+        # Channel members are frozensets
+        workspace_json = json.dumps(workspace, default=list)
+        with self._transaction() as connection:
+            connection.execute("UPDATE lease_run SET state = 'cancelled' WHERE state = 'running'")
+            connection.execute("INSERT OR REPLACE INTO lease_run (run_id, channel_filter, state, created_at) "
+                               "VALUES (?, ?, 'running', ?)", (run_id, channel_filter, time.time()))
+            connection.executemany("INSERT OR REPLACE INTO channel_lease (run_id, slack_channel_id, channel_name, "
+                                   "state) VALUES (?, ?, ?, 'pending')",
+                                   [(run_id, channel["id"], channel["name"]) for channel in channels])
+            connection.execute("INSERT OR REPLACE INTO lease_run_setup (run_id, slack_tier_rates, workspace) "
+                               "VALUES (?, ?, ?)", (run_id, json.dumps(slack_tier_rates), workspace_json))
+
+    def get_run_setup(self, run_id: str):
+        """Returns (slack_tier_rates, workspace) as given to create_run, or None."""
+        with self._lock:
+            row = self._get_connection().execute(
+                "SELECT slack_tier_rates, workspace FROM lease_run_setup WHERE run_id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        # JSON object keys are strings, the tiers are numbers
+        slack_tier_rates = {int(tier): rate for tier, rate in json.loads(row[0]).items()}
+        return slack_tier_rates, json.loads(row[1])
+
+    def get_running_run(self):
+        """Returns (run_id, channel_filter) of the running run, or None."""
+        with self._lock:
+            return self._get_connection().execute(
+                "SELECT run_id, channel_filter FROM lease_run WHERE state = 'running' "
+                "ORDER BY created_at DESC LIMIT 1").fetchone()
+
+    def is_running(self, run_id: str) -> bool:
+        with self._lock:
+            row = self._get_connection().execute("SELECT state FROM lease_run WHERE run_id = ?",
+                                                 (run_id,)).fetchone()
+        return row is not None and row[0] == "running"
+
+    def set_run_state(self, run_id: str, state: str):
+        with self._transaction() as connection:
+            connection.execute("UPDATE lease_run SET state = ? WHERE run_id = ?", (state, run_id))
+
+    def claim(self, run_id: str, owner: str):
+        """Leases the next pending or expired channel of the run to owner, returns its id or None."""
+        now = time.time()
+        with self._transaction() as connection:
+            while True:
+                row = connection.execute(
+                    "SELECT slack_channel_id, channel_name, attempts FROM channel_lease WHERE run_id = ? "
+                    "AND (state = 'pending' OR (state = 'leased' AND expires_at < ?)) ORDER BY rowid LIMIT 1",
+                    (run_id, now)).fetchone()
+                if row is None:
+                    return None
+                slack_channel_id, channel_name, attempts = row
+                if attempts < self._max_attempts:
+                    break
+                # Workers keep dying on this channel, it is given up instead of taking the run down with it
+                self._logger_bot.error("Channel %s failed after %d lease attempts", channel_name, attempts)
+                connection.execute("UPDATE channel_lease SET state = 'failed', owner = NULL WHERE run_id = ? "
+                                   "AND slack_channel_id = ?", (run_id, slack_channel_id))
+            connection.execute("UPDATE channel_lease SET state = 'leased', owner = ?, expires_at = ?, "
+                               "attempts = attempts + 1 WHERE run_id = ? AND slack_channel_id = ?",
+                               (owner, now + self._lease_seconds, run_id, slack_channel_id))
+            return slack_channel_id
+
+    def renew(self, run_id: str, owner: str, messages: dict) -> set:
+        """Extends the leases of owner and stores their message counts, returns the channel ids still held."""
+        expires_at = time.time() + self._lease_seconds
+        with self._transaction() as connection:
+            for slack_channel_id, count in messages.items():
+                connection.execute("UPDATE channel_lease SET expires_at = ?, messages = ? WHERE run_id = ? "
+                                   "AND slack_channel_id = ? AND owner = ? AND state = 'leased'",
+                                   (expires_at, count, run_id, slack_channel_id, owner))
+            rows = connection.execute("SELECT slack_channel_id FROM channel_lease WHERE run_id = ? AND owner = ? "
+                                      "AND state = 'leased'", (run_id, owner)).fetchall()
+        return {row[0] for row in rows}
+
+    def release(self, run_id: str, slack_channel_id: str, owner: str, state: str, messages: int):
+        """Ends the lease of owner with state done, failed or pending (given back unfinished)."""
+        with self._transaction() as connection:
+            connection.execute("UPDATE channel_lease SET state = ?, owner = NULL, expires_at = 0, messages = ? "
+                               "WHERE run_id = ? AND slack_channel_id = ? AND owner = ?",
+                               (state, messages, run_id, slack_channel_id, owner))
+
+    def get_progress(self, run_id: str) -> dict:
+        """Channel counts by lease state and the messages delivered so far."""
+        with self._lock:
+            rows = self._get_connection().execute(
+                "SELECT state, COUNT(*), SUM(messages) FROM channel_lease WHERE run_id = ? GROUP BY state",
+                (run_id,)).fetchall()
+        progress = {"pending": 0, "leased": 0, "done": 0, "failed": 0, "messages": 0}
+        for state, count, messages in rows:
+            progress[state] = count
+            progress["messages"] += messages or 0
+        return progress
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            connection = self._get_connection()
+            # Taken before the first read, so two workers never claim the same channel
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            db_dir = os.path.dirname(self._db_file)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._connection = sqlite3.connect(self._db_file, timeout=30, check_same_thread=False,
+                                               isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+        return self._connection
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from src.entity.config_entity import ConfigEntity
+from src.util.settings_parser import SettingsParser
+
+
+class ConfigCache:
+    """Keeps the parsed config in memory for all consumers.
+
+    The file's mtime is checked at most once per config_check_interval seconds
+    and the file is parsed again only when the mtime has changed, so between
+    checks a lookup costs a frozenset or dict access. Edits made through
+    ConfigService are pushed in with update().
+    """
+
+    def __init__(self, config_repo):
+        settings = SettingsParser()
+
+        self._config_repo = config_repo
+        self._check_interval = settings.config_check_interval
+        self._lock = threading.RLock()
+        self._config_entity = None
+        self._mtime = None
+        self._next_check_at = 0.0
+        self._excluded_channels = frozenset()
+        self._excluded_users = frozenset()
+
+    def get_config(self) -> ConfigEntity:
+        if time.monotonic() >= self._next_check_at:
+            with self._lock:
+                if time.monotonic() >= self._next_check_at:
+                    self._refresh()
+        return self._config_entity
+
+    def get_excluded_channels(self) -> frozenset:
+        self.get_config()
+        return self._excluded_channels
+
+    def get_excluded_users(self) -> frozenset:
+        self.get_config()
+        return self._excluded_users
+
+    def update(self, config_entity: ConfigEntity):
+        with self._lock:
+            self._set_config(config_entity, self._config_repo.get_config_mtime())
+            self._next_check_at = time.monotonic() + self._check_interval
+
+    def invalidate(self):
+        with self._lock:
+            self._next_check_at = 0.0
+            self._mtime = None
+
+    def _refresh(self):
+        self._next_check_at = time.monotonic() + self._check_interval
+        mtime = self._config_repo.get_config_mtime()
+        if self._config_entity is not None and mtime is not None and mtime == self._mtime:
+            return
+        config_entity = self._config_repo.read_config()
+        if config_entity is not None:
+            self._set_config(config_entity, mtime)
+
+    def _set_config(self, config_entity: ConfigEntity, mtime):
+        self._excluded_channels = frozenset(config_entity.excluded_channels or ())
+        self._excluded_users = frozenset(config_entity.excluded_users or ())
+        self._config_entity = config_entity
+        self._mtime = mtime
@@ -17,8 +17,22 @@ class ConfigRepository():
             self._logger_bot.error("Error during reading config: %s", str(e))
         return config_entity
 
-    def save_config(self,config_entity: ConfigEntity):
+    def lock(self):
+        """Holds off config edits of other processes for the length of a with block."""
+        return self._file_instance.lock()
+
+    def get_config_mtime(self):
+        mtime = None
+        try:
+            mtime = self._file_instance.get_mtime()
+        except Exception as e:
+            self._logger_bot.error("Error during reading config mtime: %s", str(e))
+        return mtime
+
+    def save_config(self,config_entity: ConfigEntity) -> bool:
         try:
             self._file_instance.save_file(config_entity)
         except Exception as e:
             self._logger_bot.error("Error during saving config: %s", str(e))
+            return False
+        return True
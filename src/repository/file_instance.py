@@ -1,4 +1,10 @@
+import contextlib
+import errno
+import fcntl
 import json
+import os
+import stat
+import tempfile
 from dataclasses import asdict
 
 from src.util.settings_parser import SettingsParser
@@ -10,6 +16,8 @@ class FileInstance:
     def __init__(self):
         setting_parser = SettingsParser()
         self._config_file = setting_parser.config_file
+        # Kept on the state volume, which is shared by the worker processes of a sharded migration
+        self._lock_file = os.path.join(os.path.dirname(setting_parser.state_db_file), 'config.lock')
 
     def read_file(self) -> ConfigEntity:
         with open(self._config_file) as f:
@@ -19,9 +27,41 @@ class FileInstance:
 
         return config_entity
 
+    @contextlib.contextmanager
+    def lock(self):
+        os.makedirs(os.path.dirname(self._lock_file), exist_ok=True)
+        with open(self._lock_file, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_mtime(self) -> int:
+        return os.stat(self._config_file).st_mtime_ns
+
     def save_file(self, config_entity: ConfigEntity):
 
         config_dict = asdict(config_entity)
-        with open(self._config_file,'w') as f:
-            f.write(json.dumps(config_dict,default=str))
-
+        config_json = json.dumps(config_dict, default=str)
+        # Write a temporary file next to the config and rename it over the original,
+        # so a crash in the middle of a save never leaves a truncated config behind.
+        config_dir = os.path.dirname(self._config_file) or '.'
+        fd, tmp_file = tempfile.mkstemp(prefix='.config-', suffix='.tmp', dir=config_dir)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(config_json)
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(self._config_file):
+                os.chmod(tmp_file, stat.S_IMODE(os.stat(self._config_file).st_mode))
+            os.replace(tmp_file, self._config_file)
+        except OSError as err:
+            os.unlink(tmp_file)
+            if err.errno in (errno.EBUSY, errno.EXDEV):
+                # A single-file bind mount can not be replaced. Rewriting it in place would bring back
+                # the truncated config on a crash, so the save fails and the directory has to be mounted.
+                raise OSError(err.errno, f"{self._config_file} can not be replaced atomically, bind-mount "
+                                         f"the directory that holds it instead of the file "
+                                         f"(see docker-compose.yml)") from err
+            raise
@@ -0,0 +1,207 @@
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from src.util.settings_parser import SettingsParser
+
+
+class StateStore:
+    """Local SQLite store for migration state.
+
+    Keeps per-channel watermarks, the latest delivered reply of each thread and
+    the Slack -> Mattermost id mappings of posts, files, users and channels. The database runs in WAL mode and writes
+    are buffered and committed in batches of state_batch_size rows (or every
+    state_flush_seconds), reads see buffered rows immediately.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS channel_watermark ("
+        " slack_channel_id TEXT PRIMARY KEY, channel_name TEXT, last_ts REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS thread_state ("
+        " slack_channel_id TEXT NOT NULL, thread_ts TEXT NOT NULL, latest_reply TEXT NOT NULL,"
+        " PRIMARY KEY (slack_channel_id, thread_ts))",
+        "CREATE TABLE IF NOT EXISTS post_map ("
+        " slack_channel_id TEXT NOT NULL, slack_ts TEXT NOT NULL, mm_post_id TEXT NOT NULL,"
+        " PRIMARY KEY (slack_channel_id, slack_ts))",
+        "CREATE INDEX IF NOT EXISTS post_map_mm_post_id ON post_map (mm_post_id)",
+        "CREATE TABLE IF NOT EXISTS file_map ("
+        " slack_file_id TEXT NOT NULL, mm_channel_id TEXT NOT NULL, mm_file_id TEXT NOT NULL,"
+        " PRIMARY KEY (slack_file_id, mm_channel_id))",
+        "CREATE TABLE IF NOT EXISTS user_map ("
+        " slack_user_id TEXT PRIMARY KEY, mm_user_id TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS channel_map ("
+        " slack_channel_id TEXT PRIMARY KEY, mm_channel_id TEXT NOT NULL)",
+    )
+
+    UPSERTS = {
+        "channel_watermark": "INSERT OR REPLACE INTO channel_watermark (slack_channel_id, channel_name, last_ts) "
+                             "VALUES (?, ?, ?)",
+        "thread_state": "INSERT OR REPLACE INTO thread_state (slack_channel_id, thread_ts, latest_reply) "
+                        "VALUES (?, ?, ?)",
+        "post_map": "INSERT OR REPLACE INTO post_map (slack_channel_id, slack_ts, mm_post_id) VALUES (?, ?, ?)",
+        "file_map": "INSERT OR REPLACE INTO file_map (slack_file_id, mm_channel_id, mm_file_id) VALUES (?, ?, ?)",
+        "user_map": "INSERT OR REPLACE INTO user_map (slack_user_id, mm_user_id) VALUES (?, ?)",
+        "channel_map": "INSERT OR REPLACE INTO channel_map (slack_channel_id, mm_channel_id) VALUES (?, ?)",
+    }
+
+    DELETES = {
+        "file_map": "DELETE FROM file_map WHERE slack_file_id = ? AND mm_channel_id = ?",
+    }
+
+    def __init__(self):
+        settings = SettingsParser()
+
+        self._logger_bot = logging.getLogger("")
+        self._db_file = settings.state_db_file
+        self._batch_size = settings.state_batch_size
+        self._flush_seconds = settings.state_flush_seconds
+        self._lock = threading.RLock()
+        self._connection = None
+        self._pending = {table: {} for table in self.UPSERTS}
+        self._pending_rows = 0
+        self._last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def get_channel_watermark(self, slack_channel_id: str):
+        row = self._get("channel_watermark", (slack_channel_id,),
+                        "SELECT slack_channel_id, channel_name, last_ts FROM channel_watermark "
+                        "WHERE slack_channel_id = ?")
+        return row[2] if row else None
+
+    def set_channel_watermark(self, slack_channel_id: str, channel_name: str, last_ts: float):
+        self._put("channel_watermark", (slack_channel_id,), (slack_channel_id, channel_name, last_ts))
+
+    def get_thread_latest_reply(self, slack_channel_id: str, thread_ts: str):
+        row = self._get("thread_state", (slack_channel_id, thread_ts),
+                        "SELECT slack_channel_id, thread_ts, latest_reply FROM thread_state "
+                        "WHERE slack_channel_id = ? AND thread_ts = ?")
+        return row[2] if row else None
+
+    def set_thread_latest_reply(self, slack_channel_id: str, thread_ts: str, latest_reply: str):
+        self._put("thread_state", (slack_channel_id, thread_ts), (slack_channel_id, thread_ts, latest_reply))
+
+    def get_thread_latest_replies(self, slack_channel_id: str, started_before: float, replied_since: float) -> dict:
+        """Maps the ts of each thread of the channel started up to started_before, whose latest reply is
+        not older than replied_since, to that reply, oldest thread first."""
+        with self._lock:
+            self.flush()
+            rows = self._get_connection().execute(
+                "SELECT thread_ts, latest_reply FROM thread_state WHERE slack_channel_id = ?"
+                " AND CAST(thread_ts AS REAL) <= ? AND CAST(latest_reply AS REAL) >= ?"
+                " ORDER BY CAST(thread_ts AS REAL)", (slack_channel_id, started_before, replied_since)).fetchall()
+        return dict(rows)
+
+    def get_post_id(self, slack_channel_id: str, slack_ts: str):
+        row = self._get("post_map", (slack_channel_id, slack_ts),
+                        "SELECT slack_channel_id, slack_ts, mm_post_id FROM post_map "
+                        "WHERE slack_channel_id = ? AND slack_ts = ?")
+        return row[2] if row else None
+
+    def get_posted_ts(self, slack_channel_id: str, slack_ts_list: list) -> set:
+        """Returns the ts of the list that have a Mattermost post, with one query per 500 of them."""
+        posted = set()
+        unknown = []
+        with self._lock:
+            for slack_ts in slack_ts_list:
+                key = (slack_channel_id, slack_ts)
+                if key in self._pending["post_map"]:
+                    row = self._pending["post_map"][key]
+                    if row is not None and row[2] is not None:
+                        posted.add(slack_ts)
+                else:
+                    unknown.append(slack_ts)
+            for start in range(0, len(unknown), 500):
+                chunk = unknown[start:start + 500]
+                rows = self._get_connection().execute(
+                    f"SELECT slack_ts FROM post_map WHERE slack_channel_id = ?"
+                    f" AND slack_ts IN ({', '.join('?' * len(chunk))})", (slack_channel_id, *chunk)).fetchall()
+                posted.update(row[0] for row in rows)
+        return posted
+
+    def set_post_id(self, slack_channel_id: str, slack_ts: str, mm_post_id: str):
+        self._put("post_map", (slack_channel_id, slack_ts), (slack_channel_id, slack_ts, mm_post_id))
+
+    def get_file_id(self, slack_file_id: str, mm_channel_id: str):
+        row = self._get("file_map", (slack_file_id, mm_channel_id),
+                        "SELECT slack_file_id, mm_channel_id, mm_file_id FROM file_map "
+                        "WHERE slack_file_id = ? AND mm_channel_id = ?")
+        return row[2] if row else None
+
+    def set_file_id(self, slack_file_id: str, mm_channel_id: str, mm_file_id: str):
+        self._put("file_map", (slack_file_id, mm_channel_id), (slack_file_id, mm_channel_id, mm_file_id))
+
+    def delete_file_id(self, slack_file_id: str, mm_channel_id: str):
+        self._put("file_map", (slack_file_id, mm_channel_id), None)
+
+    def get_mm_user_id(self, slack_user_id: str):
+        row = self._get("user_map", (slack_user_id,),
+                        "SELECT slack_user_id, mm_user_id FROM user_map WHERE slack_user_id = ?")
+        return row[1] if row else None
+
+    def set_mm_user_id(self, slack_user_id: str, mm_user_id: str):
+        self._put("user_map", (slack_user_id,), (slack_user_id, mm_user_id))
+
+    def get_mm_channel_id(self, slack_channel_id: str):
+        row = self._get("channel_map", (slack_channel_id,),
+                        "SELECT slack_channel_id, mm_channel_id FROM channel_map WHERE slack_channel_id = ?")
+        return row[1] if row else None
+
+    def set_mm_channel_id(self, slack_channel_id: str, mm_channel_id: str):
+        self._put("channel_map", (slack_channel_id,), (slack_channel_id, mm_channel_id))
+
+    def flush(self):
+        with self._lock:
+            if self._pending_rows == 0:
+                return
+            connection = self._get_connection()
+            with connection:
+                for table, rows in self._pending.items():
+                    deleted = [key for key, row in rows.items() if row is None]
+                    if deleted:
+                        connection.executemany(self.DELETES[table], deleted)
+                    upserted = [row for row in rows.values() if row is not None]
+                    if upserted:
+                        connection.executemany(self.UPSERTS[table], upserted)
+            self._pending = {table: {} for table in self.UPSERTS}
+            self._pending_rows = 0
+            self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    def _get(self, table: str, key: tuple, query: str):
+        with self._lock:
+            # A pending None marks a row deleted since the last flush
+            if key in self._pending[table]:
+                return self._pending[table][key]
+            return self._get_connection().execute(query, key).fetchone()
+
+    def _put(self, table: str, key: tuple, row: tuple):
+        with self._lock:
+            if key not in self._pending[table]:
+                self._pending_rows += 1
+            self._pending[table][key] = row
+            if self._pending_rows >= self._batch_size or \
+                    time.monotonic() - self._last_flush >= self._flush_seconds:
+                self.flush()
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            db_dir = os.path.dirname(self._db_file)
+            if db_dir:
+                os.makedirs(db_dir, exist_ok=True)
+            self._connection = sqlite3.connect(self._db_file, timeout=30, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            with self._connection:
+                for statement in self.SCHEMA:
+                    self._connection.execute(statement)
+            self._logger_bot.info("State store opened (%s)", self._db_file)
+        return self._connection
@@ -5,6 +5,7 @@ from src.util.settings_error import SettingsError
 
 class SettingsParser:
     slack_bot_token: str
+    slack_api_url: str
     slack_app_token: str
     slack_signing_secret: str
     mattermost_bot_token: str
@@ -14,8 +15,46 @@ class SettingsParser:
     set_excluded_users_command: str
     set_date_sync_command: str
     start_integration_command: str
+    job_status_command: str
+    cancel_job_command: str
+    job_history_size: int
     config_file: str
     log_file: str
+    config_check_interval: float
+    checkpoint_flush_messages: int
+    checkpoint_flush_seconds: float
+    state_db_file: str
+    state_batch_size: int
+    state_flush_seconds: float
+    channels_concurrency: int
+    shard_workers: int
+    lease_db_file: str
+    worker_metrics_dir: str
+    lease_seconds: float
+    lease_max_attempts: int
+    pipeline_queue_size: int
+    attachment_chunk_size: int
+    attachment_workers: int
+    attachment_cache_dir: str
+    attachment_cache_bytes: int
+    slack_backend: str
+    slack_source: str
+    slack_export_file: str
+    slack_async_concurrency: int
+    slack_thread_concurrency: int
+    slack_thread_lookback_days: float
+    slack_thread_recheck_days: float
+    slack_tier_rates: dict
+    slack_max_retries: int
+    mattermost_connect_timeout: float
+    mattermost_read_timeout: float
+    mattermost_max_retries: int
+    mattermost_sink: str
+    mattermost_team_name: str
+    bulk_import_dir: str
+    http_cassette_mode: str
+    http_cassette_file: str
+    http_cassette_speed: float
 
     def __init__(self):
 
@@ -119,3 +158,159 @@ class SettingsParser:
                 or (self.start_integration_command == '' or self.start_integration_command is None)\
                 or( self.log_file == '' or self.log_file is None):
             raise SettingsError()
+
+        self.job_status_command = self._get_option(config, _settings_file_exists, 'slack', 'job_status_command',
+                                                   '/job_status')
+        self.cancel_job_command = self._get_option(config, _settings_file_exists, 'slack', 'cancel_job_command',
+                                                   '/cancel_job')
+        self.job_history_size = int(self._get_option(config, _settings_file_exists, 'config', 'job_history_size', 20))
+        if self.job_history_size < 0:
+            raise SettingsError()
+
+        self.config_check_interval = float(self._get_option(config, _settings_file_exists, 'config',
+                                                            'config_check_interval', 2))
+
+        self.checkpoint_flush_messages = int(self._get_option(config, _settings_file_exists, 'config',
+                                                              'checkpoint_flush_messages', 100))
+        self.checkpoint_flush_seconds = float(self._get_option(config, _settings_file_exists, 'config',
+                                                               'checkpoint_flush_seconds', 10))
+        if self.checkpoint_flush_messages < 1 or self.checkpoint_flush_seconds <= 0:
+            raise SettingsError()
+
+        self.state_db_file = os.environ.get('WORKDIR') + '/' + self._get_option(config, _settings_file_exists, 'config',
+                                                                                'state_db_file', 'state/state.db')
+        self.state_batch_size = int(self._get_option(config, _settings_file_exists, 'config',
+                                                     'state_batch_size', 500))
+        self.state_flush_seconds = float(self._get_option(config, _settings_file_exists, 'config',
+                                                          'state_flush_seconds', 5))
+        if self.state_batch_size < 1 or self.state_flush_seconds <= 0:
+            raise SettingsError()
+
+        self.channels_concurrency = int(self._get_option(config, _settings_file_exists, 'migration',
+                                                         'channels_concurrency', 4))
+        if self.channels_concurrency < 1:
+            raise SettingsError()
+
+        # Worker processes a migration is split across, channels are shared out through leases
+        self.shard_workers = int(self._get_option(config, _settings_file_exists, 'migration', 'shard_workers', 1))
+        self.lease_db_file = os.environ.get('WORKDIR') + '/' + self._get_option(config, _settings_file_exists, 'config',
+                                                                                'lease_db_file', 'state/leases.db')
+        # Worker processes write their Prometheus metrics there, the process serving /metrics adds them up
+        self.worker_metrics_dir = os.environ.get('WORKDIR') + '/' + self._get_option(
+            config, _settings_file_exists, 'config', 'worker_metrics_dir', 'state/worker_metrics')
+        self.lease_seconds = float(self._get_option(config, _settings_file_exists, 'migration', 'lease_seconds', 60))
+        self.lease_max_attempts = int(self._get_option(config, _settings_file_exists, 'migration',
+                                                       'lease_max_attempts', 3))
+        if self.shard_workers < 1 or self.lease_seconds <= 0 or self.lease_max_attempts < 1:
+            raise SettingsError()
+
+        self.pipeline_queue_size = int(self._get_option(config, _settings_file_exists, 'migration',
+                                                        'pipeline_queue_size', 200))
+        if self.pipeline_queue_size < 1:
+            raise SettingsError()
+
+        self.attachment_chunk_size = int(self._get_option(config, _settings_file_exists, 'migration',
+                                                          'attachment_chunk_size', 65536))
+        if self.attachment_chunk_size < 1:
+            raise SettingsError()
+
+        self.attachment_workers = int(self._get_option(config, _settings_file_exists, 'migration',
+                                                       'attachment_workers', 4))
+        if self.attachment_workers < 1:
+            raise SettingsError()
+
+        self.attachment_cache_dir = os.environ.get('WORKDIR') + '/' + self._get_option(
+            config, _settings_file_exists, 'migration', 'attachment_cache_dir', 'attachment_cache')
+        self.attachment_cache_bytes = int(self._get_option(config, _settings_file_exists, 'migration',
+                                                           'attachment_cache_bytes', 512 * 1024 * 1024))
+        if self.attachment_cache_bytes < 0:
+            raise SettingsError()
+
+        self.slack_backend = self._get_option(config, _settings_file_exists, 'slack', 'slack_backend', 'sync')
+        if self.slack_backend not in ('sync', 'async'):
+            raise SettingsError()
+
+        # Messages come from the Slack Web API, or from a workspace export archive for backfills
+        self.slack_source = self._get_option(config, _settings_file_exists, 'slack', 'slack_source', 'api')
+        self.slack_export_file = os.environ.get('WORKDIR') + '/' + self._get_option(
+            config, _settings_file_exists, 'slack', 'slack_export_file', 'slack_export.zip')
+        if self.slack_source not in ('api', 'export'):
+            raise SettingsError()
+
+        # Base URL of the Slack Web API, pointed elsewhere for local stand-ins
+        self.slack_api_url = self._get_option(config, _settings_file_exists, 'slack', 'slack_api_url',
+                                              'https://slack.com/api/')
+
+        self.slack_async_concurrency = int(self._get_option(config, _settings_file_exists, 'slack',
+                                                            'slack_async_concurrency', 100))
+        if self.slack_async_concurrency < 1:
+            raise SettingsError()
+
+        self.slack_thread_concurrency = int(self._get_option(config, _settings_file_exists, 'slack',
+                                                             'slack_thread_concurrency', 8))
+        self.slack_thread_lookback_days = float(self._get_option(config, _settings_file_exists, 'slack',
+                                                                 'slack_thread_lookback_days', 7))
+        # Threads started before the lookback are looked up one by one if they had replies within this many
+        # days, 0 looks up every known thread
+        self.slack_thread_recheck_days = float(self._get_option(config, _settings_file_exists, 'slack',
+                                                                'slack_thread_recheck_days', 90))
+        if self.slack_thread_concurrency < 1 or self.slack_thread_lookback_days < 0 \
+                or self.slack_thread_recheck_days < 0:
+            raise SettingsError()
+
+        # Requests per minute for each Slack Web API tier, e.g. "1:1,2:20,3:50,4:100"
+        tier_rates = self._get_option(config, _settings_file_exists, 'slack', 'slack_tier_rates',
+                                      '1:1,2:20,3:50,4:100')
+        try:
+            self.slack_tier_rates = {int(tier): float(rate) for tier, rate in
+                                     (item.split(':') for item in tier_rates.split(','))}
+        except ValueError:
+            raise SettingsError()
+        if any(rate <= 0 for rate in self.slack_tier_rates.values()) \
+                or not {1, 2, 3, 4} <= set(self.slack_tier_rates):
+            raise SettingsError()
+
+        self.slack_max_retries = int(self._get_option(config, _settings_file_exists, 'slack',
+                                                      'slack_max_retries', 10))
+
+        self.mattermost_connect_timeout = float(self._get_option(config, _settings_file_exists, 'mattermost',
+                                                                 'mattermost_connect_timeout', 5))
+        self.mattermost_read_timeout = float(self._get_option(config, _settings_file_exists, 'mattermost',
+                                                              'mattermost_read_timeout', 60))
+        self.mattermost_max_retries = int(self._get_option(config, _settings_file_exists, 'mattermost',
+                                                           'mattermost_max_retries', 5))
+
+        self.mattermost_sink = self._get_option(config, _settings_file_exists, 'mattermost', 'mattermost_sink', 'rest')
+        self.mattermost_team_name = self._get_option(config, _settings_file_exists, 'mattermost',
+                                                     'mattermost_team_name', None)
+        self.bulk_import_dir = os.environ.get('WORKDIR') + '/' + self._get_option(
+            config, _settings_file_exists, 'mattermost', 'bulk_import_dir', 'bulk_import')
+        if self.mattermost_sink not in ('rest', 'bulk_import') or (
+                self.mattermost_sink == 'bulk_import' and not self.mattermost_team_name):
+            raise SettingsError()
+        # The bulk import archive has a single writer
+        if self.mattermost_sink == 'bulk_import' and self.shard_workers > 1:
+            raise SettingsError()
+
+        # Records the Slack and Mattermost HTTP traffic to a cassette, or replays one instead of the network
+        self.http_cassette_mode = self._get_option(config, _settings_file_exists, 'config', 'http_cassette_mode',
+                                                   'off')
+        self.http_cassette_file = os.environ.get('WORKDIR') + '/' + self._get_option(
+            config, _settings_file_exists, 'config', 'http_cassette_file', 'cassettes/http_cassette.jsonl.gz')
+        self.http_cassette_speed = float(self._get_option(config, _settings_file_exists, 'config',
+                                                          'http_cassette_speed', 1))
+        if self.http_cassette_mode not in ('off', 'record', 'replay') or self.http_cassette_speed < 0:
+            raise SettingsError()
+        # The cassette has a single writer too
+        if self.http_cassette_mode == 'record' and self.shard_workers > 1:
+            raise SettingsError()
+
+    @staticmethod
+    def _get_option(config, settings_file_exists, section, option, default):
+        env_value = os.environ.get(option.upper())
+        if (env_value == '' or env_value is None) and settings_file_exists and config.has_option(section, option):
+            return config[section][option]
+        if env_value == '' or env_value is None:
+            return default
+        return env_value
+
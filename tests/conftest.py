@@ -0,0 +1,85 @@
+"""Fixtures running migrations against the local Slack and Mattermost stand-ins of benchmarks/fake_servers.py.
+
+The fake servers run in the test process, so a test can inject faults and read
+what was posted. Every migration runs in a child process of its own, as the
+settings and the Containers singletons are made for one run of the application.
+"""
+import argparse
+import multiprocessing
+import os
+
+import pytest
+
+from benchmarks import bench_migration, check_resume, fake_servers
+
+
+class FakeDeployment:
+    """The fake servers and a WORKDIR configured for them, see bench_migration.configure."""
+
+    def __init__(self, args, workdir: str):
+        self.args = args
+        self.workdir = workdir
+        self.slack, self.mattermost = fake_servers.make_servers(args)
+        self.mm_url = f"http://127.0.0.1:{self.mattermost.server_address[1]}"
+        bench_migration.configure(args, workdir, self.slack.server_address[1], self.mattermost.server_address[1])
+
+    @property
+    def workspace(self) -> fake_servers.SyntheticWorkspace:
+        return self.slack.workspace
+
+    @property
+    def slack_faults(self) -> fake_servers.FaultInjector:
+        return self.slack.faults
+
+    def migrate(self) -> int:
+        """Runs an "all channels" job to the end, returns 0 when it finished."""
+        migration = multiprocessing.Process(target=check_resume.migrate)
+        migration.start()
+        migration.join()
+        return migration.exitcode
+
+    def migrate_until_killed(self, kill_after: int) -> int:
+        """Runs an "all channels" job and kills it once kill_after posts were made, returns the posts made."""
+        return check_resume.run_until_killed(self.mm_url, kill_after)
+
+    def posted_ts(self) -> dict:
+        """Maps each Slack channel id to the slack_ts of its top level posts, in the order they were created."""
+        return check_resume.load_posted_ts(self.mm_url)
+
+    def replies_of(self, slack_ts: str) -> list:
+        posts = list(self.mattermost.state.posts.values())
+        root_ids = [post["id"] for post in posts if post["props"].get("slack_ts") == slack_ts]
+        return [post for post in posts if post["root_id"] and post["root_id"] in root_ids]
+
+    def close(self):
+        for server in (self.slack, self.mattermost):
+            server.shutdown()
+            server.server_close()
+
+
+@pytest.fixture
+def deploy(tmp_path):
+    """Starts the fake servers with a workspace of the given fake_servers options, e.g. deploy(messages=150)."""
+    environ = dict(os.environ)
+    deployments = []
+
+    def start(backend="sync", **options) -> FakeDeployment:
+        parser = argparse.ArgumentParser()
+        fake_servers.add_arguments(parser)
+        parser.set_defaults(**dict({"channels": 2, "messages": 350}, **options))
+        args = parser.parse_args([])
+        # What configure() expects of the benchmark's arguments
+        args.backend = backend
+        args.sink = "rest"
+        args.concurrency = args.channels
+        args.slack_tier_rates = bench_migration.NO_TIER_LIMITS
+        args.log_level = "INFO"
+        deployment = FakeDeployment(args, str(tmp_path / f"workdir{len(deployments)}"))
+        deployments.append(deployment)
+        return deployment
+
+    yield start
+    for deployment in deployments:
+        deployment.close()
+    os.environ.clear()
+    os.environ.update(environ)
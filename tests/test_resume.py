@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from benchmarks import check_resume
+from src.repository.state_store import StateStore
+
+
+def channel_watermark(slack_channel_id: str) -> float:
+    state_store = StateStore()
+    try:
+        return state_store.get_channel_watermark(slack_channel_id)
+    finally:
+        state_store.close()
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_killed_migration_resumes_without_duplicate_posts(deploy, backend):
+    deployment = deploy(backend=backend)
+    # Saved often, so the kill lands after some of the checkpoint is written, and read back less than
+    # the synthetic history spans, so messages the checkpoint moved past are not read again
+    os.environ["CHECKPOINT_FLUSH_MESSAGES"] = "10"
+    os.environ["SLACK_THREAD_LOOKBACK_DAYS"] = "0.01"
+
+    killed_at = deployment.migrate_until_killed(kill_after=150)
+    assert killed_at < 2 * 350
+
+    assert deployment.migrate() == 0
+    assert check_resume.check(deployment.args, deployment.posted_ts()) == []
+
+
+@pytest.mark.parametrize("backend", ["sync", "async"])
+def test_failed_thread_keeps_the_watermark_before_its_parent(deploy, backend):
+    deployment = deploy(backend=backend, channels=1, messages=150)
+    channel_id = deployment.workspace.channel_id(0)
+    expected = [deployment.workspace.message(channel_id, index)["ts"] for index in range(150)]
+    deployment.slack_faults.fail_next("conversations.replies", 500, ts=expected[50])
+
+    deployment.migrate()
+    posted = deployment.posted_ts()[channel_id]
+    # The parent is not posted without its replies, the messages after it are
+    assert sorted(set(expected) - set(posted), key=float) == [expected[50]]
+    assert float(expected[49]) <= channel_watermark(channel_id) < float(expected[50])
+
+    assert deployment.migrate() == 0
+    assert sorted(deployment.posted_ts()[channel_id], key=float) == expected
+    assert len(deployment.replies_of(expected[50])) == deployment.args.replies
+
+
+def test_failed_attachment_keeps_the_watermark_before_its_message(deploy):
+    deployment = deploy(channels=1, messages=150, file_every=10, file_bytes=1024)
+    channel_id = deployment.workspace.channel_id(0)
+    expected = [deployment.workspace.message(channel_id, index)["ts"] for index in range(150)]
+    file_id = deployment.workspace.message(channel_id, 50)["files"][0]["id"]
+    # Read into the attachment cache first, then streamed
+    deployment.slack_faults.fail_next("files", 500, count=2, file=file_id)
+
+    deployment.migrate()
+    posted = deployment.posted_ts()[channel_id]
+    assert sorted(set(expected) - set(posted), key=float) == [expected[50]]
+    assert float(expected[49]) <= channel_watermark(channel_id) < float(expected[50])
+
+    assert deployment.migrate() == 0
+    assert sorted(deployment.posted_ts()[channel_id], key=float) == expected
+    # Every file reached Mattermost once, the rerun only copied the one that failed
+    stats = deployment.mattermost.calls
+    assert stats["POST /files"] == 150 // 10
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks import check_resume
+from src.controller.containers import Containers
+from src.util.settings_parser import SettingsParser
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def create_run(run_id: str):
+    containers = Containers()
+    load_messages = containers.slack_load_messages()
+    channels = load_messages.select_channels()
+    lease_store = containers.channel_lease_store()
+    lease_store.create_run(run_id, "all", channels, SettingsParser().slack_tier_rates,
+                           load_messages.get_workspace(channels))
+    return lease_store
+
+
+def test_expired_lease_is_claimed_by_another_worker(deploy):
+    deploy(channels=1)
+    os.environ["LEASE_SECONDS"] = "0.5"
+    lease_store = create_run("run")
+
+    slack_channel_id = lease_store.claim("run", "worker-1")
+    assert lease_store.claim("run", "worker-2") is None
+    time.sleep(0.6)
+
+    assert lease_store.claim("run", "worker-2") == slack_channel_id
+    # The first worker learns it lost the channel with its next renewal
+    assert lease_store.renew("run", "worker-1", {slack_channel_id: 10}) == set()
+    assert lease_store.renew("run", "worker-2", {slack_channel_id: 10}) == {slack_channel_id}
+
+
+def test_channel_of_a_dead_worker_is_migrated_by_the_others(deploy):
+    deployment = deploy(channels=3, messages=150)
+    os.environ["LEASE_SECONDS"] = "1"
+    lease_store = create_run("run")
+    # Leased by a worker that died before posting anything
+    lease_store.claim("run", "dead-worker")
+
+    workers = [subprocess.Popen([sys.executable, "-m", "src.controller.shard_worker", "run"], cwd=REPOSITORY_DIR)
+               for _ in range(2)]
+    assert [worker.wait(timeout=120) for worker in workers] == [0, 0]
+
+    assert lease_store.get_progress("run")["done"] == 3
+    assert check_resume.check(deployment.args, deployment.posted_ts()) == []
@@ -0,0 +1,36 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from slack_sdk import WebClient
+
+from src.controller.containers import Containers
+
+
+def test_retry_after_pauses_only_the_bucket_of_its_method(deploy):
+    deployment = deploy(retry_after=2)
+    rate_limiter = Containers().slack_rate_limiter()
+    web_client = WebClient(token="xoxb-test", base_url=os.environ["SLACK_API_URL"])
+    channel_id = deployment.workspace.channel_id(0)
+    thread_ts = deployment.workspace.message(channel_id, 0)["ts"]
+    deployment.slack_faults.fail_next("conversations.replies", 429)
+
+    def load_replies():
+        rate_limiter.call("conversations_replies", web_client.conversations_replies, channel=channel_id,
+                          ts=thread_ts)
+        return time.monotonic() - started
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        started = time.monotonic()
+        replies = executor.submit(load_replies)
+        while deployment.slack.calls["rate_limited"] == 0:
+            time.sleep(0.01)
+        rate_limiter.call("conversations_history", web_client.conversations_history, channel=channel_id)
+        history_seconds = time.monotonic() - started
+        next_replies = executor.submit(load_replies)
+
+        # The 429 answered call is repeated after Retry-After, other calls of its method wait as well
+        assert replies.result() >= 2
+        assert next_replies.result() >= 2
+    assert history_seconds < 1
+    assert deployment.slack.calls["conversations.replies"] == 2